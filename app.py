@@ -2,10 +2,30 @@ import streamlit as st
 import pandas as pd
 import os
 import io
+import math
 import qrcode
 import json
+import zlib
+import base64
+import sqlite3
 import hashlib
+import hmac
+import time
+import uuid
+import random
+import re
+import socket
+import ssl
+import threading
+import functools
+import atexit
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from urllib.parse import quote, urlparse, unquote
 from reportlab.platypus import (
     SimpleDocTemplate, Paragraph, Spacer, Image, Table, KeepTogether, PageBreak
 )
@@ -13,6 +33,13 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import cm
 from reportlab.lib import colors
+from build_assets import costruisci_asset, chiave_esercizio
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = os.path.join(BASE_DIR, "images")
+VIDEO_DIR = os.path.join(BASE_DIR, "videos")
+STATIC_DIR = os.path.join(BASE_DIR, "static")  # servita da Streamlit su /app/static (server.enableStaticServing)
+URL_STATIC = "/app/static"
 
 # --------------------------------------------------
 # STREAMLIT CONFIG + PWA
@@ -24,16 +51,37 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
+# --------------------------------------------------
+# ASSET STATICI (immagini ottimizzate, nome con hash del contenuto)
+# --------------------------------------------------
+# Streamlit non manda Cache-Control su /app/static: il nome con hash evita asset
+# vecchi, ma la cache lunga va impostata sul reverse proxy (vedi build_assets.py)
+@st.cache_resource
+def get_mappa_asset():
+    """Asset generati da build_assets.py (ricostruiti all'avvio solo se le sorgenti cambiano)"""
+    try:
+        return costruisci_asset()
+    except Exception:
+        # Senza asset ottimizzati si usano i file originali
+        return {}
+
+def url_asset(nome, fallback=None):
+    """URL statico dell'asset ottimizzato; se non c'è (o lo static serving è spento) il fallback"""
+    percorso = get_mappa_asset().get(nome)
+    if percorso and st.get_option("server.enableStaticServing"):
+        return f"{URL_STATIC}/{percorso}"
+    return fallback
+
 # PWA Manifest e Meta Tags per installabilità
-st.markdown("""
+st.markdown(f"""
 <head>
     <meta name="apple-mobile-web-app-capable" content="yes">
     <meta name="apple-mobile-web-app-status-bar-style" content="black-translucent">
     <meta name="apple-mobile-web-app-title" content="RR Fisioterapia">
-    <link rel="apple-touch-icon" href="./app/static/logo.png">
+    <link rel="apple-touch-icon" href=".{url_asset('icona-192', '/app/static/logo.png')}">
     <meta name="mobile-web-app-capable" content="yes">
     <meta name="theme-color" content="#1e3c72">
-    <link rel="manifest" href="./manifest.json">
+    <link rel="manifest" href=".{URL_STATIC if get_mappa_asset() else ''}/manifest.json">
 </head>
 """, unsafe_allow_html=True)
 
@@ -188,60 +236,460 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# --------------------------------------------------
+# CONFIGURAZIONE
+# --------------------------------------------------
+def leggi_config(chiave, default=None):
+    """Valore di configurazione: variabile d'ambiente (MAIUSCOLA) o Streamlit secrets"""
+    valore = os.environ.get(chiave.upper())
+    if valore is not None:
+        return valore
+    try:
+        return st.secrets.get(chiave, default)
+    except Exception:
+        # Nessun secrets.toml (es. sviluppo locale)
+        return default
+
+# --------------------------------------------------
+# TRACING (tempi delle operazioni per rerun)
+# --------------------------------------------------
+TRACE_FILE = os.path.join(BASE_DIR, "trace.jsonl")
+TRACE_MAX_BYTES = 5 * 1024 * 1024  # Oltre 5MB il file viene ruotato
+
+# Ogni esecuzione dello script ha il suo id: gli span dello stesso rerun sono raggruppati
+RERUN_ID = uuid.uuid4().hex[:12]
+
+@st.cache_resource
+def get_trace_lock():
+    """Lock condiviso tra sessioni per scrivere il file di trace"""
+    return threading.Lock()
+
+def scrivi_span(nome, durata_ms, esito, rerun_id):
+    """Aggiunge uno span al file JSON-lines di trace"""
+    riga = json.dumps({
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "rerun": rerun_id,
+        "span": nome,
+        "ms": round(durata_ms, 2),
+        "esito": esito
+    }, ensure_ascii=False)
+    try:
+        with get_trace_lock():
+            if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) > TRACE_MAX_BYTES:
+                os.replace(TRACE_FILE, TRACE_FILE + ".1")
+            with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                f.write(riga + "\n")
+    except Exception:
+        # Il tracing non deve mai bloccare l'app
+        pass
+
+@contextmanager
+def traccia(nome):
+    """Misura il tempo di un blocco di codice e lo registra come span"""
+    inizio = time.perf_counter()
+    esito = "ok"
+    try:
+        yield
+    except Exception:
+        esito = "errore"
+        raise
+    finally:
+        scrivi_span(nome, (time.perf_counter() - inizio) * 1000, esito, RERUN_ID)
+
+def tracciato(nome):
+    """Decoratore: registra ogni chiamata della funzione come span"""
+    def decoratore(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with traccia(nome):
+                return func(*args, **kwargs)
+        return wrapper
+    return decoratore
+
+def percentile(valori, p):
+    """Percentile nearest-rank su una lista già ordinata"""
+    if not valori:
+        return 0
+    indice = min(len(valori) - 1, max(0, math.ceil(p * len(valori) / 100) - 1))
+    return valori[indice]
+
+def riepilogo_trace(max_righe=5000):
+    """Legge le ultime righe del trace e calcola p50/p95 per span"""
+    if not os.path.exists(TRACE_FILE):
+        return [], 0
+
+    with open(TRACE_FILE, encoding="utf-8") as f:
+        righe = f.readlines()[-max_righe:]
+
+    durate = {}
+    reruns = set()
+    for riga in righe:
+        try:
+            span = json.loads(riga)
+        except ValueError:
+            continue
+        durate.setdefault(span["span"], []).append(span["ms"])
+        reruns.add(span["rerun"])
+
+    riepilogo = []
+    for nome, valori in durate.items():
+        valori.sort()
+        riepilogo.append({
+            "span": nome,
+            "chiamate": len(valori),
+            "p50 (ms)": percentile(valori, 50),
+            "p95 (ms)": percentile(valori, 95),
+            "max (ms)": valori[-1]
+        })
+    riepilogo.sort(key=lambda x: x["p95 (ms)"], reverse=True)
+    return riepilogo, len(reruns)
+
+# --------------------------------------------------
+# I/O CONCORRENTE (chiamate indipendenti in parallelo)
+# --------------------------------------------------
+# Le chiamate di rete indipendenti (URL firmati, letture, email) partono insieme:
+# la pagina attende la più lenta invece della somma. Le funzioni eseguite nel
+# pool non devono disegnare elementi Streamlit, solo ritornare valori.
+IO_THREAD_MAX = 8
+IO_PREFISSO_THREAD = "io"
+
+@st.cache_resource
+def get_pool_io():
+    """Pool di thread unico per processo, condiviso tra le sessioni"""
+    return ThreadPoolExecutor(max_workers=IO_THREAD_MAX, thread_name_prefix=IO_PREFISSO_THREAD)
+
+def in_parallelo(funzione, elementi, massimo=None):
+    """funzione(elemento) per ogni elemento, in parallelo; risultati nello stesso ordine.
+
+    massimo limita le chiamate contemporanee (es. connessioni SMTP). Un'eccezione
+    viene rilanciata dopo aver atteso tutte le altre chiamate.
+    """
+    elementi = list(elementi)
+    # Da un thread del pool si esegue in sequenza: attendere il pool dal pool può bloccarlo
+    if len(elementi) <= 1 or threading.current_thread().name.startswith(IO_PREFISSO_THREAD + "_"):
+        return [funzione(elemento) for elemento in elementi]
+    if massimo is not None:
+        semaforo = threading.BoundedSemaphore(massimo)
+        def limitata(elemento):
+            with semaforo:
+                return funzione(elemento)
+    else:
+        limitata = funzione
+    futuri = [get_pool_io().submit(limitata, elemento) for elemento in elementi]
+    errori = [futuro.exception() for futuro in futuri]
+    for errore in errori:
+        if errore is not None:
+            raise errore
+    return [futuro.result() for futuro in futuri]
+
+def is_admin():
+    """Pannello admin nascosto: visibile solo con ?admin=<admin_token dei secrets>"""
+    token = st.query_params.get("admin")
+    atteso = leggi_config("admin_token", "")
+    if not token or not atteso:
+        return False
+    return hmac.compare_digest(str(token), str(atteso))
+
+def mostra_pannello_admin():
+    """Pannello admin con il riepilogo dei tempi (p50/p95)"""
+    with st.expander("🛠️ Admin · Tempi operazioni"):
+        spans, num_rerun = riepilogo_trace()
+        if spans:
+            st.caption(f"Ultimi {num_rerun} rerun · file: {TRACE_FILE}")
+            st.dataframe(pd.DataFrame(spans), hide_index=True, width="stretch")
+        else:
+            st.info("Nessuno span registrato ancora")
+
+    with st.expander("🛠️ Admin · Quota Google Sheets"):
+        metriche = get_quota_sheets().metriche()
+        col_q1, col_q2, col_q3 = st.columns(3)
+        with col_q1:
+            st.metric("Letture ultimo minuto", f"{metriche['letture_ultimo_minuto']}/{SHEETS_LETTURE_AL_MINUTO}")
+        with col_q2:
+            st.metric("Scritture ultimo minuto", f"{metriche['scritture_ultimo_minuto']}/{SHEETS_SCRITTURE_AL_MINUTO}")
+        with col_q3:
+            st.metric("Errori 429", metriche["errori_429"])
+        st.caption(f"Ricaricamenti evitati (dati invariati): {get_snapshot_database().ricariche_evitate}")
+        st.json(metriche, expanded=False)
+
+    with st.expander("🛠️ Admin · Riscaldamento cache"):
+        riscaldamento = get_riscaldamento()
+        st.metric("Cache", "pronte" if riscaldamento.pronto.is_set() else "in riscaldamento")
+        st.json(riscaldamento.fasi, expanded=False)
+
+    with st.expander("🛠️ Admin · Codici paziente"):
+        col_c1, col_c2 = st.columns(2)
+        with col_c1:
+            st.metric("Codici sconosciuti in cache", len(get_cache_negativa().scadenze))
+        with col_c2:
+            st.metric("Ricerche bloccate", get_limitatore_tentativi().rifiutati)
+
+    with st.expander("🛠️ Admin · Dimensione celle"):
+        righe = rapporto_celle(carica_database())
+        vicine = [r for r in righe if r["caratteri"] >= LIMITE_CELLA_SHEETS * SOGLIA_AVVISO_CELLA]
+        for r in vicine:
+            st.warning(f"⚠️ {r['nome']} ({r['codice']}): cella '{r['colonna']}' al {r['% limite']}% del limite di {LIMITE_CELLA_SHEETS} caratteri")
+        if righe:
+            st.caption(f"Codifica celle: {CELLE_COMPATTE} · compressione oltre {CELLA_COMPRIMI_OLTRE} caratteri")
+            st.dataframe(pd.DataFrame(righe), hide_index=True, width="stretch")
+        else:
+            st.info("Nessun paziente")
+
+    storage = get_storage()
+    if hasattr(storage, "stato_sync"):
+        with st.expander("🛠️ Admin · Sincronizzazione cache locale"):
+            stato = storage.stato_sync()
+            if stato["operazioni_scartate"]:
+                st.warning(
+                    f"⚠️ {stato['operazioni_scartate']} operazioni non inviate al foglio dopo "
+                    f"{SYNC_TENTATIVI_MAX} errori (salvate nella tabella journal_scartate)"
+                )
+            st.json(stato)
+
 # --------------------------------------------------
 # DATABASE PAZIENTI (GOOGLE SHEETS)
 # --------------------------------------------------
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import TransportError
 from google.cloud import storage
 
+# --------------------------------------------------
+# QUOTA GOOGLE SHEETS (rate limit, coalescing, backoff)
+# --------------------------------------------------
+# Limiti Google: circa 60 letture e 60 scritture al minuto per utente
+SHEETS_LETTURE_AL_MINUTO = 60
+SHEETS_SCRITTURE_AL_MINUTO = 60
+SHEETS_MAX_TENTATIVI = 5
+SHEETS_BACKOFF_BASE = 1.0  # secondi
+SHEETS_BACKOFF_MAX = 32.0  # secondi
+
+class TokenBucket:
+    """Token bucket thread-safe: capacita token, ricaricati a velocità costante"""
+
+    def __init__(self, capacita, ricarica_al_secondo):
+        self.capacita = capacita
+        self.ricarica_al_secondo = ricarica_al_secondo
+        self.token = float(capacita)
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _ricarica(self):
+        adesso = time.monotonic()
+        self.token = min(self.capacita, self.token + (adesso - self.ultimo) * self.ricarica_al_secondo)
+        self.ultimo = adesso
+
+    def acquisisci(self):
+        """Attende finché un token è disponibile; ritorna i secondi di attesa"""
+        attesa_totale = 0.0
+        while True:
+            with self.lock:
+                self._ricarica()
+                if self.token >= 1:
+                    self.token -= 1
+                    return attesa_totale
+                attesa = (1 - self.token) / self.ricarica_al_secondo
+            time.sleep(attesa)
+            attesa_totale += attesa
+
+class _ChiamataInCorso:
+    """Lettura in corso condivisa tra i chiamanti con la stessa chiave"""
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.risultato = None
+        self.errore = None
+
+class QuotaSheets:
+    """Gestore quota davanti a tutte le chiamate gspread"""
+
+    def __init__(self):
+        self.bucket_letture = TokenBucket(SHEETS_LETTURE_AL_MINUTO, SHEETS_LETTURE_AL_MINUTO / 60)
+        self.bucket_scritture = TokenBucket(SHEETS_SCRITTURE_AL_MINUTO, SHEETS_SCRITTURE_AL_MINUTO / 60)
+        self.lock = threading.Lock()
+        self.in_corso = {}
+        self.storico_letture = deque()
+        self.storico_scritture = deque()
+        self.contatori = {
+            "letture": 0,
+            "scritture": 0,
+            "letture_coalescenti": 0,
+            "ritentativi": 0,
+            "errori_429": 0,
+            "errori_5xx": 0,
+            "secondi_in_attesa": 0.0
+        }
+
+    def leggi(self, chiave, funzione):
+        """Esegue una lettura; letture identiche concorrenti condividono una sola chiamata"""
+        with self.lock:
+            chiamata = self.in_corso.get(chiave)
+            if chiamata is not None:
+                self.contatori["letture_coalescenti"] += 1
+                leader = False
+            else:
+                chiamata = _ChiamataInCorso()
+                self.in_corso[chiave] = chiamata
+                leader = True
+
+        if not leader:
+            chiamata.evento.wait()
+            if chiamata.errore is not None:
+                raise chiamata.errore
+            return chiamata.risultato
+
+        try:
+            chiamata.risultato = self._esegui(funzione, self.bucket_letture, self.storico_letture, "letture")
+        except Exception as e:
+            chiamata.errore = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_corso[chiave]
+            chiamata.evento.set()
+        return chiamata.risultato
+
+    def scrivi(self, funzione):
+        """Esegue una scrittura rispettando il limite e con backoff"""
+        return self._esegui(funzione, self.bucket_scritture, self.storico_scritture, "scritture")
+
+    def _esegui(self, funzione, bucket, storico, contatore):
+        tentativo = 0
+        while True:
+            attesa = bucket.acquisisci()
+            with self.lock:
+                self.contatori[contatore] += 1
+                self.contatori["secondi_in_attesa"] += attesa
+                storico.append(time.monotonic())
+            try:
+                return funzione()
+            except gspread.exceptions.APIError as e:
+                status = getattr(e.response, "status_code", e.code)
+                ritentabile = status == 429 or status >= 500
+                with self.lock:
+                    if status == 429:
+                        self.contatori["errori_429"] += 1
+                    elif status >= 500:
+                        self.contatori["errori_5xx"] += 1
+                tentativo += 1
+                if not ritentabile or tentativo >= SHEETS_MAX_TENTATIVI:
+                    raise
+                # Backoff esponenziale con jitter completo
+                with self.lock:
+                    self.contatori["ritentativi"] += 1
+                time.sleep(random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** tentativo)))
+
+    def metriche(self):
+        """Contatori e quota usata nell'ultimo minuto"""
+        limite = time.monotonic() - 60
+        with self.lock:
+            for storico in (self.storico_letture, self.storico_scritture):
+                while storico and storico[0] < limite:
+                    storico.popleft()
+            metriche = dict(self.contatori)
+            metriche["secondi_in_attesa"] = round(metriche["secondi_in_attesa"], 2)
+            metriche["letture_ultimo_minuto"] = len(self.storico_letture)
+            metriche["scritture_ultimo_minuto"] = len(self.storico_scritture)
+        return metriche
+
+@st.cache_resource
+def get_quota_sheets():
+    """Un solo gestore quota per processo (condiviso tra le sessioni)"""
+    return QuotaSheets()
+
 # Setup Google Sheets
-def get_google_sheet():
-    """Connessione a Google Sheets usando secrets"""
+@st.cache_resource
+def _apri_spreadsheet():
+    """Apre lo spreadsheet una volta per processo: evita auth e metadati ad ogni chiamata"""
+    # Credenziali da Streamlit secrets
+    credentials_dict = dict(st.secrets["gcp_service_account"])
+    
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    
+    credentials = Credentials.from_service_account_info(
+        credentials_dict,
+        scopes=scopes
+    )
+    
+    client = gspread.authorize(credentials)
+    quota = get_quota_sheets()
+    
+    # Apri il foglio usando l'ID
+    sheet_id = st.secrets["sheet_id"]
+    return quota.leggi(("open_by_key", sheet_id), lambda: client.open_by_key(sheet_id))
+
+@st.cache_resource
+def _apri_worksheet():
+    """Foglio principale con una riga per paziente"""
+    spreadsheet = _apri_spreadsheet()
+    return get_quota_sheets().leggi(("sheet1", spreadsheet.id), lambda: spreadsheet.sheet1)
+
+@st.cache_resource
+def _apri_worksheet_eventi():
+    """Foglio append-only degli eventi (creato al primo utilizzo)"""
+    spreadsheet = _apri_spreadsheet()
+    quota = get_quota_sheets()
     try:
-        # Credenziali da Streamlit secrets
-        credentials_dict = dict(st.secrets["gcp_service_account"])
-        
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        credentials = Credentials.from_service_account_info(
-            credentials_dict,
-            scopes=scopes
-        )
-        
-        client = gspread.authorize(credentials)
-        
-        # Apri il foglio usando l'ID
-        sheet_id = st.secrets["sheet_id"]
-        spreadsheet = client.open_by_key(sheet_id)
-        worksheet = spreadsheet.sheet1
-        
+        return quota.leggi(("worksheet", FOGLIO_EVENTI), lambda: spreadsheet.worksheet(FOGLIO_EVENTI))
+    except gspread.exceptions.WorksheetNotFound:
+        worksheet = quota.scrivi(lambda: spreadsheet.add_worksheet(FOGLIO_EVENTI, rows=1000, cols=len(COLONNE_EVENTI)))
+        quota.scrivi(lambda: worksheet.append_row(COLONNE_EVENTI))
         return worksheet
-    except Exception as e:
-        st.error(f"Errore connessione Google Sheets: {e}")
-        return None
 
 # --------------------------------------------------
 # CLOUD STORAGE (VIDEO PAZIENTI)
 # --------------------------------------------------
 BUCKET_NAME = "schede-pazienti-video"
 
+@st.cache_resource
+def _client_cloud_storage():
+    """Client Cloud Storage unico per processo (autenticazione e pool HTTP riusati)"""
+    credentials_dict = dict(st.secrets["gcp_service_account"])
+    credentials = Credentials.from_service_account_info(credentials_dict)
+    return storage.Client(credentials=credentials, project=credentials_dict['project_id'])
+
 def get_storage_client():
     """Connessione a Cloud Storage"""
     try:
-        credentials_dict = dict(st.secrets["gcp_service_account"])
-        credentials = Credentials.from_service_account_info(credentials_dict)
-        client = storage.Client(credentials=credentials, project=credentials_dict['project_id'])
-        return client
+        return _client_cloud_storage()
     except Exception as e:
         st.error(f"Errore connessione Cloud Storage: {e}")
         return None
 
-def upload_video_to_cloud(file_data, paziente_code, esercizio_nome, timestamp):
-    """Upload video su Cloud Storage"""
+HASH_BLOCCO_BYTES = 1024 * 1024
+
+@tracciato("impronta_video")
+def impronta_video(file_data):
+    """SHA-256 del contenuto, letto a blocchi (il file resta pronto per l'upload)"""
+    h = hashlib.sha256()
+    file_data.seek(0)
+    for blocco in iter(lambda: file_data.read(HASH_BLOCCO_BYTES), b""):
+        h.update(blocco)
+    file_data.seek(0)
+    return h.hexdigest()
+
+def video_con_impronta(paziente, impronta):
+    """(esercizio, video) già caricato dal paziente con lo stesso contenuto, o None"""
+    for esercizio, video_list in paziente.get("video_pazienti", {}).items():
+        for video in video_list:
+            if video.get("sha256") == impronta:
+                return esercizio, video
+    return None
+
+def blob_usato_altrove(paziente, blob_name, esercizio):
+    """True se lo stesso blob è collegato anche a un altro esercizio del paziente"""
+    return any(
+        video.get("blob_name") == blob_name
+        for nome, video_list in paziente.get("video_pazienti", {}).items() if nome != esercizio
+        for video in video_list
+    )
+
+@tracciato("upload_video_to_cloud")
+def upload_video_to_cloud(file_data, paziente_code, impronta):
+    """Upload video su Cloud Storage (saltato se lo stesso contenuto è già nel bucket)"""
     try:
         client = get_storage_client()
         if not client:
@@ -249,34 +697,43 @@ def upload_video_to_cloud(file_data, paziente_code, esercizio_nome, timestamp):
         
         bucket = client.bucket(BUCKET_NAME)
         
-        # Nome file unico: paziente_esercizio_timestamp.ext
-        file_extension = file_data.name.split('.')[-1]
-        blob_name = f"{paziente_code}/{esercizio_nome.replace(' ', '_')}_{timestamp}.{file_extension}"
+        # Nome dal contenuto: ricaricare lo stesso video (es. dopo un upload interrotto
+        # o non registrato) ritrova il blob già presente invece di crearne uno nuovo
+        file_extension = file_data.name.split('.')[-1].lower()
+        blob_name = f"{paziente_code}/{impronta}.{file_extension}"
         
         blob = bucket.blob(blob_name)
         
-        # Upload
-        file_data.seek(0)
-        blob.upload_from_file(file_data, content_type=file_data.type)
-        
-        # Rendi accessibile (signed URL valido 7 giorni)
-        url = blob.generate_signed_url(
-            version="v4",
-            expiration=datetime.timedelta(days=365),
-            method="GET"
-        )
+        # Upload (se il controllo di esistenza fallisce si carica comunque: stesso nome, stesso contenuto)
+        try:
+            riusato = blob.exists()
+        except Exception:
+            riusato = False
+        if not riusato:
+            file_data.seek(0)
+            blob.upload_from_file(file_data, content_type=file_data.type)
         
+        # Nessun URL firmato qui: get_video_url lo genera (max 7 giorni) quando serve
         return {
             "blob_name": blob_name,
-            "url": url,
-            "size_mb": round(file_data.size / (1024*1024), 2)
+            "sha256": impronta,
+            "size_mb": round(file_data.size / (1024*1024), 2),
+            "riusato": riusato
         }
     except Exception as e:
         st.error(f"Errore upload video: {e}")
         return None
 
+@tracciato("get_video_url")
 def get_video_url(blob_name):
-    """Ottieni URL firmato per visualizzare video"""
+    """Ottieni URL firmato per visualizzare video (riusato dalla cache condivisa finché è valido)"""
+    chiave = chiave_condivisa("url_firmato", blob_name)
+    try:
+        salvato = get_cache_condivisa().leggi(chiave)
+        if salvato:
+            return salvato.decode("utf-8")
+    except Exception:
+        pass
     try:
         client = get_storage_client()
         if not client:
@@ -288,13 +745,21 @@ def get_video_url(blob_name):
         # URL valido 7 giorni
         url = blob.generate_signed_url(
             version="v4",
-            expiration=datetime.timedelta(days=7),
+            expiration=timedelta(days=7),
             method="GET"
         )
-        
-        return url
     except Exception as e:
         return None
+    try:
+        get_cache_condivisa().scrivi(chiave, url.encode("utf-8"), URL_FIRMATO_CACHE_SECONDI)
+    except Exception:
+        pass
+    return url
+
+def get_video_urls(blob_names):
+    """URL firmati di più video, richiesti tutti insieme (blob_name -> URL o None)"""
+    blob_names = list(dict.fromkeys(b for b in blob_names if b))
+    return dict(zip(blob_names, in_parallelo(get_video_url, blob_names)))
 
 def delete_video_from_cloud(blob_name):
     """Elimina video da Cloud Storage"""
@@ -319,6 +784,9 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+SMTP_CONNESSIONI_MAX = 3  # Gmail rifiuta troppe connessioni contemporanee
+
+@tracciato("invia_email_notifica")
 def invia_email_notifica(destinatario, oggetto, corpo):
     """Invia email usando Gmail SMTP"""
     try:
@@ -413,1502 +881,3553 @@ def invia_promemoria_paziente(nome_paziente, email_paziente, link_scheda):
     """
     return invia_email_notifica(email_paziente, oggetto, corpo)
     
-@st.cache_data(ttl=10)  # Cache per 10 secondi
-def carica_database():
-    """Carica tutti i pazienti da Google Sheets"""
+# --------------------------------------------------
+# LOG EVENTI (append-only: completamenti, note, video)
+# --------------------------------------------------
+# Storico, progressi, note, email e video del paziente sono ricostruiti dagli eventi:
+# le celle JSON della riga restano come base storica e non vengono più riscritte
+FOGLIO_EVENTI = "eventi"
+COLONNE_EVENTI = ['id', 'timestamp', 'codice', 'tipo', 'esercizio', 'valore']
+CAMPI_DA_EVENTI = ['storico', 'progressi', 'note', 'email', 'video_pazienti']
+TIPI_EVENTO_JSON = {"video_aggiunto", "video_feedback"}
+
+def nuovo_evento(tipo, esercizio="", valore=""):
+    """Crea un evento con id univoco (serve per applicarlo una sola volta)"""
+    return {
+        "id": uuid.uuid4().hex,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "tipo": tipo,
+        "esercizio": esercizio,
+        "valore": valore
+    }
+
+def applica_evento(paziente, evento):
+    """Applica un evento ai dati di un paziente (idempotente)"""
+    tipo = evento["tipo"]
+    esercizio = evento.get("esercizio")
+    valore = evento.get("valore")
+    
+    if tipo == "completamento":
+        storico = paziente.setdefault("storico", {}).setdefault(esercizio, [])
+        if valore not in storico:
+            storico.append(valore)
+        paziente.setdefault("progressi", {})[esercizio] = True
+    elif tipo == "annulla_completamento":
+        storico = paziente.setdefault("storico", {}).setdefault(esercizio, [])
+        if valore in storico:
+            storico.remove(valore)
+    elif tipo == "nota":
+        paziente.setdefault("note", {})[esercizio] = valore
+    elif tipo == "email":
+        paziente["email"] = valore
+    elif tipo == "video_aggiunto":
+        video_list = paziente.setdefault("video_pazienti", {}).setdefault(esercizio, [])
+        if not any(v.get("blob_name") == valore.get("blob_name") for v in video_list):
+            video_list.append(dict(valore))
+    elif tipo == "video_rimosso":
+        video_list = paziente.setdefault("video_pazienti", {}).setdefault(esercizio, [])
+        video_list[:] = [v for v in video_list if v.get("blob_name") != valore]
+    elif tipo == "video_feedback":
+        for video in paziente.get("video_pazienti", {}).get(esercizio, []):
+            if video.get("blob_name") == valore.get("blob_name"):
+                video["feedback_fisio"] = valore.get("feedback", "")
+
+def materializza_eventi(db, eventi):
+    """Ricostruisce i dati dei pazienti applicando gli eventi in ordine di scrittura"""
+    visti = set()
+    for evento in eventi:
+        if evento["id"] in visti:
+            continue
+        visti.add(evento["id"])
+        if evento["codice"] in db:
+            applica_evento(db[evento["codice"]], evento)
+    return db
+
+def _riga_da_evento(evento):
+    """Converte un evento nella riga del log"""
+    valore = evento["valore"]
+    if evento["tipo"] in TIPI_EVENTO_JSON:
+        valore = json.dumps(valore, ensure_ascii=False)
+    return [evento["id"], evento["timestamp"], evento["codice"], evento["tipo"], evento["esercizio"], valore]
+
+def _evento_da_riga(riga):
+    """Converte una riga del log in evento (None se la riga non è valida)"""
+    riga = list(riga) + [''] * (len(COLONNE_EVENTI) - len(riga))
+    evento = dict(zip(COLONNE_EVENTI, riga))
+    if not evento['id'] or not evento['codice']:
+        return None
+    if evento['tipo'] in TIPI_EVENTO_JSON:
+        try:
+            evento['valore'] = json.loads(evento['valore'])
+        except ValueError:
+            return None
+    return evento
+
+# --------------------------------------------------
+# RIGHE PAZIENTE (conversione riga <-> dizionario)
+# --------------------------------------------------
+SCHEMA_VERSIONE = 2
+
+# Colonne della riga paziente. Le nuove colonne si aggiungono solo in fondo:
+# i fogli esistenti vengono estesi a destra, senza riscrivere le righe.
+# Tipo: str = testo semplice, list/dict = JSON (il tipo dà anche il default)
+SCHEMA_PAZIENTI = [
+    ('codice', str), ('nome', str), ('motivo', str), ('data_creazione', str),
+    ('scheda', list), ('progressi', dict), ('note', dict), ('storico', dict),
+    # v2
+    ('email', str), ('data_scadenza', str), ('video_pazienti', dict),
+    ('extra', dict),            # campi non previsti dallo schema (passthrough)
+    ('versione_schema', str),
+]
+INTESTAZIONE_PAZIENTI = [nome for nome, _ in SCHEMA_PAZIENTI]
+INTESTAZIONE_PAZIENTI_V1 = INTESTAZIONE_PAZIENTI[:8]
+
+# Campi salvati come JSON nella riga e loro valore di default
+CAMPI_JSON = {nome: tipo for nome, tipo in SCHEMA_PAZIENTI if tipo is not str and nome != 'extra'}
+
+def _migra_v1(record):
+    """v1 -> v2: le colonne aggiunte mancano nelle righe vecchie, valgono vuote"""
+    return {**{colonna: '' for colonna in INTESTAZIONE_PAZIENTI[8:]}, **record}
+
+# versione di partenza -> funzione che porta il record alla versione successiva
+MIGRAZIONI_SCHEMA = {1: _migra_v1}
+
+def _migra_record(record):
+    """Porta un record letto (colonna -> cella) alla versione corrente dello schema"""
     try:
-        worksheet = get_google_sheet()
-        if not worksheet:
-            st.warning("[!] Impossibile connettersi a Google Sheets")
-            return {}
-        
-        # Ottieni tutti i record
-        records = worksheet.get_all_records()
-        
-        if not records:
-            st.info("ℹ️ Nessun paziente nel database")
-            return {}
+        versione = int(record.get('versione_schema') or 1)
+    except (TypeError, ValueError):
+        versione = 1
+    while versione < SCHEMA_VERSIONE:
+        record = MIGRAZIONI_SCHEMA[versione](record)
+        versione += 1
+    return record
+
+# Codifica compatta delle celle JSON (prefisso di versione, le celle JSON semplici restano valide):
+#   d1:<json>          storico con le date come differenze in giorni
+#   z1:<base64(zlib)>  contenuto compresso (può contenere a sua volta d1:)
+# Modalità: "no" = sempre JSON semplice, "auto" = solo celle oltre la soglia, "sempre"
+CELLE_COMPATTE = leggi_config("celle_compatte", "auto")
+CELLA_COMPRIMI_OLTRE = 4000        # caratteri
+LIMITE_CELLA_SHEETS = 50000        # limite di Google Sheets per singola cella
+SOGLIA_AVVISO_CELLA = 0.8          # avviso oltre l'80% del limite
+ORIGINE_DATE = datetime(2020, 1, 1)
+
+def _codifica_date_delta(storico):
+    """{esercizio: [date]} -> {esercizio: [giorni dalla data origine, differenze...]}; None se non applicabile"""
+    if not isinstance(storico, dict):
+        return None
+    compatto = {}
+    for esercizio, date in storico.items():
+        try:
+            giorni = [(datetime.strptime(d, "%d/%m/%Y") - ORIGINE_DATE).days for d in date]
+        except (TypeError, ValueError):
+            return None
+        compatto[esercizio] = giorni[:1] + [b - a for a, b in zip(giorni, giorni[1:])]
+    return "d1:" + json.dumps(compatto, ensure_ascii=False, separators=(",", ":"))
+
+def _decodifica_date_delta(compatto):
+    storico = {}
+    for esercizio, delta in compatto.items():
+        date, giorni = [], 0
+        for i, d in enumerate(delta):
+            giorni = d if i == 0 else giorni + d
+            date.append((ORIGINE_DATE + timedelta(days=giorni)).strftime("%d/%m/%Y"))
+        storico[esercizio] = date
+    return storico
+
+def codifica_cella(campo, valore, modo=None):
+    """Testo da salvare nella cella per un campo JSON"""
+    modo = modo or CELLE_COMPATTE
+    testo = json.dumps(valore, ensure_ascii=False)
+    if modo == "no" or (modo == "auto" and len(testo) <= CELLA_COMPRIMI_OLTRE):
+        return testo
+    if campo == 'storico':
+        testo = _codifica_date_delta(valore) or testo
+    if modo == "sempre" or len(testo) > CELLA_COMPRIMI_OLTRE:
+        compresso = "z1:" + base64.b64encode(zlib.compress(testo.encode("utf-8"), 9)).decode("ascii")
+        if len(compresso) < len(testo):
+            testo = compresso
+    return testo
+
+def decodifica_cella(testo):
+    """Inverso di codifica_cella (accetta anche il JSON semplice delle righe vecchie)"""
+    if testo.startswith("z1:"):
+        testo = zlib.decompress(base64.b64decode(testo[3:])).decode("utf-8")
+    if testo.startswith("d1:"):
+        return _decodifica_date_delta(json.loads(testo[3:]))
+    return json.loads(testo)
+
+def ricodifica_cella(campo, testo, modo=None):
+    """Cella già salvata riportata alla codifica corrente (riscrivendo una riga senza leggerne il JSON)"""
+    modo = modo or CELLE_COMPATTE
+    if not testo or campo not in CAMPI_JSON:
+        return testo
+    compatta = testo.startswith(("z1:", "d1:"))
+    if compatta and modo != "no":
+        return testo
+    if not compatta and (modo == "no" or (modo == "auto" and len(testo) <= CELLA_COMPRIMI_OLTRE)):
+        return testo
+    try:
+        return codifica_cella(campo, decodifica_cella(testo), modo)
+    except (TypeError, ValueError, zlib.error):
+        # Cella illeggibile: si conserva com'è
+        return testo
+
+def _decodifica_campo(campo, testo):
+    """Decodifica una cella JSON (default vuoto se la cella è vuota o non valida)"""
+    if not testo:
+        return CAMPI_JSON[campo]()
+    try:
+        return decodifica_cella(testo)
+    except (TypeError, ValueError, zlib.error):
+        return CAMPI_JSON[campo]()
+
+class RecordPaziente(MutableMapping):
+    """Paziente che tiene le celle JSON grezze e le decodifica al primo accesso.
+
+    Elencare i pazienti per nome non decodifica scheda e storico; un record
+    congelato (vedi congela) è in sola lettura ma continua a decodificare pigramente.
+    """
+    __slots__ = ("_valori", "_grezzi", "_congelato")
+
+    def __init__(self, valori, grezzi, congelato=False):
+        self._valori = valori    # campo -> valore già decodificato
+        self._grezzi = grezzi    # campo -> testo JSON non ancora letto
+        self._congelato = congelato
+
+    def __getitem__(self, campo):
+        try:
+            return self._valori[campo]
+        except KeyError:
+            if campo not in self._grezzi:
+                raise
+        valore = _decodifica_campo(campo, self._grezzi[campo])
+        if self._congelato:
+            valore = congela(valore)
+        self._valori[campo] = valore
+        return valore
+
+    def __contains__(self, campo):
+        return campo in self._valori or campo in self._grezzi
+
+    def __iter__(self):
+        yield from self._valori
+        yield from (campo for campo in self._grezzi if campo not in self._valori)
+
+    def __len__(self):
+        return len(self._valori) + sum(1 for campo in self._grezzi if campo not in self._valori)
+
+    def __setitem__(self, campo, valore):
+        if self._congelato:
+            raise TypeError("dati paziente in sola lettura: usa gli eventi o invalida_paziente")
+        self._valori[campo] = valore
+
+    def __delitem__(self, campo):
+        if self._congelato:
+            raise TypeError("dati paziente in sola lettura: usa gli eventi o invalida_paziente")
+        if campo not in self:
+            raise KeyError(campo)
+        self._valori.pop(campo, None)
+        self._grezzi.pop(campo, None)
+
+    def cella_grezza(self, campo):
+        """Testo JSON originale del campo, o None se è già stato decodificato"""
+        if campo in self._valori:
+            return None
+        return self._grezzi.get(campo)
+
+    def congelato(self):
+        """Copia in sola lettura; i campi ancora grezzi restano da decodificare"""
+        if self._congelato:
+            return self
+        return RecordPaziente({k: congela(v) for k, v in self._valori.items()}, dict(self._grezzi), True)
+
+    def modificabile(self):
+        """Copia modificabile; decodifica solo i campi già letti"""
+        return RecordPaziente({k: scongela(v) for k, v in self._valori.items()}, dict(self._grezzi))
+
+def _paziente_da_record(record):
+    """Converte un record (colonna -> valore cella) nel paziente, senza decodificare il JSON"""
+    record = _migra_record(record)
+    valori = {
+        campo: record.get(campo, '')
+        for campo, tipo in SCHEMA_PAZIENTI
+        if tipo is str and campo not in ('codice', 'versione_schema')
+    }
+    # Celle originali: al salvataggio si riscrive la base, non lo stato materializzato
+    valori['_celle'] = {campo: record.get(campo, '') for campo in CAMPI_DA_EVENTI}
+    
+    # Campi sconosciuti: colonne aggiunte a mano al foglio e contenuto di 'extra'
+    for campo, valore in record.items():
+        if campo and campo not in INTESTAZIONE_PAZIENTI and not str(campo).startswith('_'):
+            valori[campo] = valore
+    if record.get('extra'):
+        try:
+            extra = json.loads(record['extra'])
+        except (TypeError, ValueError):
+            extra = {}
+        if isinstance(extra, dict):
+            for campo, valore in extra.items():
+                if campo not in INTESTAZIONE_PAZIENTI:
+                    valori.setdefault(campo, valore)
+    
+    return RecordPaziente(valori, {campo: record.get(campo, '') for campo in CAMPI_JSON})
+
+def lettera_colonna(indice):
+    """Lettera di colonna A1 per un indice 0-based (0 -> A, 26 -> AA)"""
+    lettere = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        lettere = chr(ord("A") + resto) + lettere
+    return lettere
+
+def mappa_colonne(intestazione):
+    """Campo -> lettera di colonna secondo l'intestazione effettiva del foglio"""
+    return {
+        str(nome).strip(): lettera_colonna(indice)
+        for indice, nome in enumerate(intestazione)
+        if str(nome).strip()
+    }
+
+def proietta_paziente(paziente, campi):
+    """Solo i campi richiesti (quelli assenti vengono omessi, non inventati)"""
+    return {campo: paziente[campo] for campo in campi if campo in paziente}
+
+def _record_da_paziente(codice, data):
+    """Converte il paziente nel record da salvare (colonna -> cella), secondo lo schema corrente"""
+    def cella(campo, tipo):
+        if campo in data.get('_celle', {}):
+            # Cella base dei campi da eventi: si riscrive com'era, ma con la codifica corrente
+            return ricodifica_cella(campo, data['_celle'][campo])
+        if tipo is str:
+            return data.get(campo, '')
+        if hasattr(data, "cella_grezza") and data.cella_grezza(campo) is not None:
+            # Campo mai letto: la cella originale è già il JSON da salvare
+            return ricodifica_cella(campo, data.cella_grezza(campo))
+        return codifica_cella(campo, data.get(campo, tipo()))
+    
+    # Tutto ciò che lo schema non conosce viaggia in 'extra' (senza decodificare i campi JSON)
+    extra = {
+        campo: data[campo] for campo in data
+        if campo not in INTESTAZIONE_PAZIENTI and not str(campo).startswith('_')
+    }
+    
+    record = {}
+    for campo, tipo in SCHEMA_PAZIENTI:
+        if campo == 'codice':
+            record[campo] = codice
+        elif campo == 'extra':
+            record[campo] = json.dumps(extra, ensure_ascii=False) if extra else ''
+        elif campo == 'versione_schema':
+            record[campo] = str(SCHEMA_VERSIONE)
+        else:
+            record[campo] = cella(campo, tipo)
+    return record
+
+def _riga_da_paziente(codice, data):
+    """Converte il paziente nella riga da salvare (colonne in ordine di schema)"""
+    record = _record_da_paziente(codice, data)
+    return [record[colonna] for colonna in INTESTAZIONE_PAZIENTI]
+
+def celle_oltre_soglia(record, soglia=SOGLIA_AVVISO_CELLA):
+    """Celle del record vicine al limite di Google Sheets: [(colonna, caratteri)]"""
+    minimo = LIMITE_CELLA_SHEETS * soglia
+    return [(c, len(str(v))) for c, v in record.items() if v is not None and len(str(v)) >= minimo]
+
+def rapporto_celle(db, max_righe=20):
+    """Cella più grande di ogni paziente (come verrebbe salvata), dalla più grande"""
+    righe = []
+    for codice, paziente in db.items():
+        record = _record_da_paziente(codice, paziente)
+        colonna, caratteri = max(((c, len(str(v))) for c, v in record.items()), key=lambda x: x[1])
+        righe.append({
+            "codice": codice,
+            "nome": paziente.get('nome', ''),
+            "colonna": colonna,
+            "caratteri": caratteri,
+            "% limite": round(caratteri / LIMITE_CELLA_SHEETS * 100, 1)
+        })
+    righe.sort(key=lambda r: r["caratteri"], reverse=True)
+    return righe[:max_righe]
+
+def riga_per_intestazione(record, intestazione):
+    """Dispone un record secondo l'intestazione effettiva del foglio.
+
+    Le colonne sconosciute prendono il valore dal campo omonimo in 'extra';
+    se il campo non c'è la cella vale None (il foglio la lascia invariata).
+    """
+    try:
+        extra = json.loads(record.get('extra') or '{}')
+    except (TypeError, ValueError):
+        extra = {}
+    riga = []
+    for colonna in intestazione:
+        colonna = str(colonna).strip()
+        if colonna in record and colonna != 'extra':
+            riga.append(record[colonna])
+        elif colonna in extra:
+            valore = extra.pop(colonna)
+            riga.append(valore if isinstance(valore, str) else json.dumps(valore, ensure_ascii=False))
+        else:
+            riga.append(None)
+    if 'extra' in intestazione:
+        riga[intestazione.index('extra')] = json.dumps(extra, ensure_ascii=False) if extra else ''
+    return riga
+
+# --------------------------------------------------
+# STORAGE BACKEND (Google Sheets o SQLite locale)
+# --------------------------------------------------
+class StorageBackend:
+    """Interfaccia comune per la persistenza di pazienti ed eventi"""
+
+    # True se get_paziente non richiede di leggere tutto il database
+    letture_puntuali = False
+
+    def lista_pazienti(self):
+        """Tutti i pazienti (codice -> dati) con gli eventi già applicati"""
+        raise NotImplementedError
+
+    def get_paziente(self, codice):
+        """Un solo paziente, o None se il codice non esiste"""
+        return self.lista_pazienti().get(codice)
+
+    def riepilogo_pazienti(self, campi):
+        """Tutti i pazienti con i soli campi richiesti (per le viste elenco)"""
+        return {codice: proietta_paziente(p, campi) for codice, p in self.lista_pazienti().items()}
+
+    def upsert_paziente(self, codice, dati):
+        """Crea o aggiorna la riga di un paziente"""
+        raise NotImplementedError
+
+    def elimina_paziente(self, codice):
+        """Elimina la riga di un paziente"""
+        raise NotImplementedError
+
+    def append_eventi(self, eventi):
+        """Accoda eventi al log (gli id già presenti vengono ignorati in lettura)"""
+        raise NotImplementedError
+
+    def firma_modifiche(self):
+        """Valore economico da leggere che cambia quando cambiano i dati, o None se non disponibile"""
+        return None
+
+class BackendGoogleSheets(StorageBackend):
+    """Pazienti sul primo foglio, eventi sul foglio 'eventi'"""
+
+    def _leggi_eventi(self):
+        worksheet = _apri_worksheet_eventi()
+        righe = get_quota_sheets().leggi(("eventi", worksheet.id), worksheet.get_all_values)
+        return [e for e in (_evento_da_riga(riga) for riga in righe[1:]) if e]
+
+    def _riga_di(self, worksheet, codice):
+        """Numero di riga (1-based) del paziente, o None"""
+        codici = get_quota_sheets().leggi(("codici", worksheet.id), lambda: worksheet.col_values(1))
+        for idx, valore in enumerate(codici):
+            if idx > 0 and str(valore).strip() == codice:
+                return idx + 1
+        return None
+
+    def _leggi_righe(self):
+        """Pazienti come sono nelle righe del foglio (senza eventi)"""
+        worksheet = _apri_worksheet()
+        # Ottieni tutti i record (letture concorrenti identiche condividono la chiamata)
+        records = get_quota_sheets().leggi(("get_all_records", worksheet.id), worksheet.get_all_records)
         
         # Converti in dizionario con codice come chiave
         db = {}
         for idx, record in enumerate(records):
             try:
-                codice = record.get('codice', '').strip()
+                codice = str(record.get('codice', '')).strip()
                 if not codice:
                     continue
-                
-                # Parse JSON con gestione errori
-                try:
-                    scheda = json.loads(record.get('scheda', '[]')) if record.get('scheda') else []
-                except:
-                    scheda = []
-                
-                try:
-                    progressi = json.loads(record.get('progressi', '{}')) if record.get('progressi') else {}
-                except:
-                    progressi = {}
-                
-                try:
-                    note = json.loads(record.get('note', '{}')) if record.get('note') else {}
-                except:
-                    note = {}
-                
-                try:
-                    storico = json.loads(record.get('storico', '{}')) if record.get('storico') else {}
-                except:
-                    storico = {}
-                
-                db[codice] = {
-                    'nome': record.get('nome', ''),
-                    'motivo': record.get('motivo', ''),
-                    'data_creazione': record.get('data_creazione', ''),
-                    'scheda': scheda,
-                    'progressi': progressi,
-                    'note': note,
-                    'storico': storico
-                }
+                db[codice] = _paziente_da_record(record)
             except Exception as e:
                 st.warning(f"[!] Errore caricamento riga {idx+2}: {e}")
                 continue
         
         return db
-    except Exception as e:
-        st.error(f"❌ Errore caricamento database: {e}")
-        import traceback
-        st.code(traceback.format_exc())
-        return {}
 
-def salva_database(db):
-    """Salva l'intero database su Google Sheets"""
-    try:
-        worksheet = get_google_sheet()
-        if not worksheet:
-            return False
+    def lista_pazienti(self):
+        return materializza_eventi(self._leggi_righe(), self._leggi_eventi())
+
+    def firma_modifiche(self):
+        # modifiedTime di Drive: una chiamata leggera, fuori dalla quota di lettura di Sheets,
+        # che cambia anche con le modifiche fatte a mano sul foglio
+        return _apri_spreadsheet().get_lastUpdateTime()
+
+    def _intestazione(self, worksheet):
+        """Intestazione effettiva del foglio (può avere colonne spostate o aggiunte a mano)"""
+        return get_quota_sheets().leggi(("intestazione", worksheet.id), lambda: worksheet.row_values(1))
+
+    def _colonne(self, worksheet):
+        """Mappa campo -> colonna letta dall'intestazione (le colonne possono essere spostate)"""
+        return mappa_colonne(self._intestazione(worksheet) or INTESTAZIONE_PAZIENTI)
+
+    def _migra_intestazione(self, worksheet):
+        """Aggiunge in fondo all'intestazione le colonne dello schema che mancano.
+
+        È la migrazione online: le righe esistenti non vengono riscritte,
+        le celle nuove restano vuote finché il paziente non viene salvato.
+        """
+        intestazione = [str(c).strip() for c in self._intestazione(worksheet)]
+        mancanti = [c for c in INTESTAZIONE_PAZIENTI if c not in intestazione]
+        if mancanti:
+            inizio = lettera_colonna(len(intestazione))
+            get_quota_sheets().scrivi(lambda: worksheet.update(range_name=f"{inizio}1", values=[mancanti]))
+            intestazione += mancanti
+        return intestazione
+
+    def riepilogo_pazienti(self, campi):
+        worksheet = _apri_worksheet()
+        colonne = self._colonne(worksheet)
+        if "codice" not in colonne:
+            return super().riepilogo_pazienti(campi)
         
-        # Prepara i dati per Google Sheets
-        rows = []
-        for codice, data in db.items():
-            rows.append([
-                codice,
-                data.get('nome', ''),
-                data.get('motivo', ''),
-                data.get('data_creazione', ''),
-                json.dumps(data.get('scheda', []), ensure_ascii=False),
-                json.dumps(data.get('progressi', {}), ensure_ascii=False),
-                json.dumps(data.get('note', {}), ensure_ascii=False),
-                json.dumps(data.get('storico', {}), ensure_ascii=False)
-            ])
-        
-        # Cancella tutto tranne l'intestazione
-        worksheet.clear()
-        
-        # Scrivi intestazione CON storico
-        worksheet.append_row(['codice', 'nome', 'motivo', 'data_creazione', 'scheda', 'progressi', 'note', 'storico'])
-        
-        # Scrivi i dati
-        if rows:
-            worksheet.append_rows(rows)
+        # Solo le colonne richieste, in un'unica chiamata
+        da_leggere = ["codice"] + [c for c in campi if c in colonne and c != "codice"]
+        intervalli = [f"{colonne[c]}2:{colonne[c]}" for c in da_leggere]
+        blocchi = get_quota_sheets().leggi(
+            ("batch_get", worksheet.id, tuple(intervalli)), lambda: worksheet.batch_get(intervalli)
+        )
+        valori = [[riga[0] if riga else '' for riga in blocco] for blocco in blocchi]
         
-        return True
-    except Exception as e:
-        st.error(f"Errore salvataggio database: {e}")
-        return False
+        db = {}
+        for idx, codice in enumerate(valori[0]):
+            codice = str(codice).strip()
+            if not codice:
+                continue
+            record = {campo: (col[idx] if idx < len(col) else '') for campo, col in zip(da_leggere, valori)}
+            db[codice] = _paziente_da_record(record)
+        
+        # Email, video e attività recenti arrivano dal log eventi
+        materializza_eventi(db, self._leggi_eventi())
+        return {codice: proietta_paziente(p, campi) for codice, p in db.items()}
 
-def genera_codice_paziente(nome_paziente):
-    """Genera un codice univoco per il paziente"""
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    raw = f"{nome_paziente}{timestamp}"
-    return hashlib.md5(raw.encode()).hexdigest()[:8]
+    def upsert_paziente(self, codice, dati):
+        self._scrivi_record(codice, _record_da_paziente(codice, dati))
 
-# --------------------------------------------------
-# LOAD CSV
-# --------------------------------------------------
-@st.cache_data
-def load_csv():
-    df = pd.read_csv("esercizi.csv")
-    df = df.fillna("")
-    df["distretto"] = df["distretto"].astype(str)
-    return df
+    def _verifica_celle(self, record):
+        """Meglio un errore chiaro prima della scrittura che un rifiuto dell'API a metà"""
+        oltre = celle_oltre_soglia(record, 1.0)
+        if oltre:
+            dettaglio = ", ".join(f"{c} ({n} caratteri)" for c, n in oltre)
+            raise ValueError(f"Paziente {record.get('codice')}: celle oltre il limite di Google Sheets: {dettaglio}")
 
-df = load_csv()
+    def _scrivi_record(self, codice, record):
+        self._verifica_celle(record)
+        worksheet = _apri_worksheet()
+        quota = get_quota_sheets()
+        riga = riga_per_intestazione(record, self._migra_intestazione(worksheet))
+        numero = self._riga_di(worksheet, codice)
+        if numero:
+            quota.scrivi(lambda: worksheet.update(range_name=f"A{numero}", values=[riga]))
+        else:
+            quota.scrivi(lambda: worksheet.append_row(['' if v is None else v for v in riga]))
 
-# --------------------------------------------------
-# ROUTING: FISIOTERAPISTA vs PAZIENTE
-# --------------------------------------------------
-# Supporta sia ?paziente=xxx che p=xxx (più corto per URL installabili)
-query_params = st.query_params
-# Cerca parametro p nell'URL
-paziente_code = st.query_params.get("p")
+    def elimina_paziente(self, codice):
+        worksheet = _apri_worksheet()
+        numero = self._riga_di(worksheet, codice)
+        if numero:
+            get_quota_sheets().scrivi(lambda: worksheet.delete_rows(numero))
 
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-IMAGE_DIR = os.path.join(BASE_DIR, "images")
-VIDEO_DIR = os.path.join(BASE_DIR, "videos")
+    def append_eventi(self, eventi):
+        self._append_righe_eventi([_riga_da_evento(evento) for evento in eventi])
 
-def trova_immagine(nome_esercizio):
-    nome_norm = nome_esercizio.strip().lower().replace(" ", "")
-    if not os.path.exists(IMAGE_DIR):
-        return None
-    for file in os.listdir(IMAGE_DIR):
-        file_norm = os.path.splitext(file)[0].strip().lower().replace(" ", "")
-        if nome_norm == file_norm:
-            return os.path.join(IMAGE_DIR, file)
-    return None
+    def _append_righe_eventi(self, righe):
+        worksheet = _apri_worksheet_eventi()
+        get_quota_sheets().scrivi(lambda: worksheet.append_rows(righe, value_input_option="RAW"))
+
+    def _riscrivi_record(self, records):
+        """Riscrive tutto il foglio: serve solo a inviare le voci 'salva_tutti' dei journal
+        scritti quando l'app salvava ancora l'intero database"""
+        for record in records:
+            self._verifica_celle(record)
+        worksheet = _apri_worksheet()
+        quota = get_quota_sheets()
+        
+        # Colonne aggiunte a mano al foglio restano (i valori arrivano da 'extra')
+        intestazione = [str(c).strip() for c in self._intestazione(worksheet)]
+        intestazione += [c for c in INTESTAZIONE_PAZIENTI if c not in intestazione]
+        rows = [['' if v is None else v for v in riga_per_intestazione(r, intestazione)] for r in records]
+        
+        # Cancella tutto e riscrivi intestazione + dati
+        quota.scrivi(worksheet.clear)
+        quota.scrivi(lambda: worksheet.append_row(intestazione))
+        if rows:
+            quota.scrivi(lambda: worksheet.append_rows(rows))
+
+SQLITE_PATH = os.path.join(BASE_DIR, "pazienti.db")
+
+# Upsert che aggiorna solo le colonne dello schema (eventuali colonne in più restano)
+SQL_UPSERT_PAZIENTE = (
+    f"INSERT INTO pazienti ({', '.join(INTESTAZIONE_PAZIENTI)}) "
+    f"VALUES ({', '.join('?' for _ in INTESTAZIONE_PAZIENTI)}) "
+    f"ON CONFLICT(codice) DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in INTESTAZIONE_PAZIENTI[1:])}"
+)
+
+class BackendSQLite(StorageBackend):
+    """Database SQLite locale (WAL) con le stesse colonne del foglio"""
+
+    letture_puntuali = True
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self.locale = threading.local()
+        self.lock_versione = threading.Lock()
+        self.conn_versione = None  # connessione riservata a PRAGMA data_version
+        conn = self._conn()
+        colonne = ", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in INTESTAZIONE_PAZIENTI[1:])
+        conn.executescript(f"""
+            CREATE TABLE IF NOT EXISTS pazienti (codice TEXT PRIMARY KEY, {colonne});
+            CREATE TABLE IF NOT EXISTS eventi (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                timestamp TEXT, codice TEXT NOT NULL, tipo TEXT, esercizio TEXT, valore TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_eventi_codice ON eventi(codice, seq);
+        """)
+        # Migrazione online: le colonne nuove dello schema si aggiungono alla tabella esistente
+        esistenti = {riga["name"] for riga in conn.execute("PRAGMA table_info(pazienti)")}
+        with conn:
+            for colonna in INTESTAZIONE_PAZIENTI:
+                if colonna not in esistenti:
+                    conn.execute(f"ALTER TABLE pazienti ADD COLUMN {colonna} TEXT NOT NULL DEFAULT ''")
+
+    def _conn(self):
+        """Una connessione per thread (le sessioni Streamlit girano su thread diversi)"""
+        conn = getattr(self.locale, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.locale.conn = conn
+        return conn
+
+    def _eventi(self, codice=None):
+        sql = f"SELECT {', '.join(COLONNE_EVENTI)} FROM eventi"
+        parametri = ()
+        if codice is not None:
+            sql += " WHERE codice = ?"
+            parametri = (codice,)
+        righe = self._conn().execute(sql + " ORDER BY seq", parametri).fetchall()
+        return [e for e in (_evento_da_riga(tuple(riga)) for riga in righe) if e]
+
+    def lista_pazienti(self):
+        righe = self._conn().execute("SELECT * FROM pazienti ORDER BY rowid").fetchall()
+        db = {riga["codice"]: _paziente_da_record(dict(riga)) for riga in righe}
+        return materializza_eventi(db, self._eventi())
+
+    def get_paziente(self, codice):
+        riga = self._conn().execute("SELECT * FROM pazienti WHERE codice = ?", (codice,)).fetchone()
+        if riga is None:
+            return None
+        db = {codice: _paziente_da_record(dict(riga))}
+        return materializza_eventi(db, self._eventi(codice))[codice]
+
+    def riepilogo_pazienti(self, campi):
+        colonne = ["codice"] + [c for c in campi if c in INTESTAZIONE_PAZIENTI and c != "codice"]
+        righe = self._conn().execute(f"SELECT {', '.join(colonne)} FROM pazienti ORDER BY rowid").fetchall()
+        db = {riga["codice"]: _paziente_da_record(dict(riga)) for riga in righe}
+        materializza_eventi(db, self._eventi())
+        return {codice: proietta_paziente(p, campi) for codice, p in db.items()}
+
+    def upsert_paziente(self, codice, dati):
+        with self._conn() as conn:
+            conn.execute(SQL_UPSERT_PAZIENTE, _riga_da_paziente(codice, dati))
+
+    def elimina_paziente(self, codice):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM pazienti WHERE codice = ?", (codice,))
+
+    def append_eventi(self, eventi):
+        with self._conn() as conn:
+            conn.executemany(
+                f"INSERT OR IGNORE INTO eventi ({', '.join(COLONNE_EVENTI)}) VALUES (?, ?, ?, ?, ?, ?)",
+                [_riga_da_evento(evento) for evento in eventi]
+            )
+
+    def firma_modifiche(self):
+        # data_version cambia a ogni commit di un'altra connessione, anche di altri processi:
+        # su questa connessione non si scrive mai, quindi conta ogni modifica
+        with self.lock_versione:
+            if self.conn_versione is None:
+                self.conn_versione = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            return self.conn_versione.execute("PRAGMA data_version").fetchone()[0]
+
+CACHE_LOCALE_PATH = os.path.join(BASE_DIR, "cache_locale.db")
+
+def _record_da_journal(payload):
+    """Record salvato nel journal (le voci scritte prima dello schema v2 sono liste di 8 celle)"""
+    if isinstance(payload, list):
+        return dict(zip(INTESTAZIONE_PAZIENTI_V1, payload))
+    return payload
+
+SYNC_PULL_SECONDI = 60  # Ogni quanto riallineare la cache con le modifiche fatte sul foglio
+SYNC_RITENTA_SECONDI = 15
+SYNC_TENTATIVI_MAX = 5  # errori non transitori dopo i quali un'operazione viene scartata
+
+def errore_transitorio(e):
+    """True per errori di rete o del servizio (429/5xx) che un nuovo tentativo può risolvere"""
+    if isinstance(e, gspread.exceptions.APIError):
+        status = getattr(e.response, "status_code", e.code)
+        return status == 429 or status >= 500
+    return isinstance(e, (OSError, TimeoutError, TransportError))
+
+class BackendCacheLocale(StorageBackend):
+    """Cache SQLite locale davanti a Google Sheets: letture locali, scritture sincronizzate in background"""
+
+    letture_puntuali = True
+
+    def __init__(self, path=CACHE_LOCALE_PATH, remoto=None):
+        self.locale = BackendSQLite(path)
+        self.remoto = remoto or BackendGoogleSheets()
+        self.lock_sync = threading.Lock()
+        self.sveglia = threading.Event()
+        self.stato = {"ultimo_push": None, "ultimo_pull": None, "ultimo_errore": None}
+        conn = self.locale._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS journal (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                operazione TEXT NOT NULL, codice TEXT, payload TEXT NOT NULL, creato TEXT,
+                tentativi INTEGER NOT NULL DEFAULT 0, errore TEXT
+            );
+            CREATE TABLE IF NOT EXISTS journal_scartate (
+                seq INTEGER PRIMARY KEY,
+                operazione TEXT NOT NULL, codice TEXT, payload TEXT NOT NULL, creato TEXT,
+                tentativi INTEGER, errore TEXT, scartata TEXT
+            );
+        """)
+        # Migrazione: i journal creati prima del conteggio degli errori non hanno queste colonne
+        esistenti = {riga["name"] for riga in conn.execute("PRAGMA table_info(journal)")}
+        with conn:
+            if "tentativi" not in esistenti:
+                conn.execute("ALTER TABLE journal ADD COLUMN tentativi INTEGER NOT NULL DEFAULT 0")
+            if "errore" not in esistenti:
+                conn.execute("ALTER TABLE journal ADD COLUMN errore TEXT")
+
+    def avvia(self):
+        """Primo allineamento (se la cache è vuota) e avvio del worker di sincronizzazione"""
+        vuota = self.locale._conn().execute("SELECT COUNT(*) FROM pazienti").fetchone()[0] == 0
+        if vuota:
+            self.pull()
+        threading.Thread(target=self._worker, name="sync-sheets", daemon=True).start()
+        return self
+
+    # ---- letture: sempre dalla cache locale ----
+    def lista_pazienti(self):
+        return self.locale.lista_pazienti()
+
+    def get_paziente(self, codice):
+        return self.locale.get_paziente(codice)
+
+    def riepilogo_pazienti(self, campi):
+        return self.locale.riepilogo_pazienti(campi)
+
+    def firma_modifiche(self):
+        # Anche il pull dal foglio scrive nella cache locale
+        return self.locale.firma_modifiche()
+
+    # ---- scritture: cache locale + journal nella stessa transazione ----
+    def _scrivi(self, operazione, codice, payload, applica):
+        with self.locale._conn() as conn:
+            applica(conn)
+            conn.execute(
+                "INSERT INTO journal (operazione, codice, payload, creato) VALUES (?, ?, ?, ?)",
+                (operazione, codice, json.dumps(payload, ensure_ascii=False), datetime.now().isoformat(timespec="seconds"))
+            )
+        self.sveglia.set()
+
+    def upsert_paziente(self, codice, dati):
+        record = _record_da_paziente(codice, dati)
+        riga = [record[colonna] for colonna in INTESTAZIONE_PAZIENTI]
+        self._scrivi("upsert", codice, record, lambda conn: conn.execute(SQL_UPSERT_PAZIENTE, riga))
+
+    def elimina_paziente(self, codice):
+        self._scrivi("elimina", codice, None, lambda conn: conn.execute(
+            "DELETE FROM pazienti WHERE codice = ?", (codice,)
+        ))
+
+    def append_eventi(self, eventi):
+        righe = [_riga_da_evento(evento) for evento in eventi]
+        self._scrivi("eventi", None, righe, lambda conn: conn.executemany(
+            f"INSERT OR IGNORE INTO eventi ({', '.join(COLONNE_EVENTI)}) VALUES (?, ?, ?, ?, ?, ?)", righe
+        ))
+
+    # ---- sincronizzazione con Google Sheets ----
+    def _invia(self, gruppo):
+        """Invia al foglio un gruppo di voci del journal (più voci solo se tutte di eventi)"""
+        voce = gruppo[0]
+        if voce["operazione"] == "eventi":
+            righe = [riga for v in gruppo for riga in json.loads(v["payload"])]
+            self.remoto._append_righe_eventi(righe)
+            return
+        payload = json.loads(voce["payload"])
+        if voce["operazione"] == "upsert":
+            self.remoto._scrivi_record(voce["codice"], _record_da_journal(payload))
+        elif voce["operazione"] == "elimina":
+            self.remoto.elimina_paziente(voce["codice"])
+        elif voce["operazione"] == "salva_tutti":
+            # Voci rimaste dai journal precedenti: l'app non ne crea più
+            self.remoto._riscrivi_record([_record_da_journal(r) for r in payload])
+        else:
+            raise ValueError(f"operazione sconosciuta nel journal: {voce['operazione']}")
+
+    def _prova(self, gruppo):
+        """Invia il gruppo; ritorna l'eccezione invece di sollevarla"""
+        try:
+            self._invia(gruppo)
+        except Exception as e:
+            return e
+        return None
+
+    def _rimuovi(self, conn, voci):
+        with conn:
+            conn.executemany("DELETE FROM journal WHERE seq = ?", [(v["seq"],) for v in voci])
+
+    def _registra_errore(self, conn, voce, errore):
+        """Conta l'errore sulla voce; oltre SYNC_TENTATIVI_MAX la sposta tra le scartate"""
+        descrizione = f"{type(errore).__name__}: {errore}"
+        with conn:
+            if voce["tentativi"] + 1 < SYNC_TENTATIVI_MAX:
+                conn.execute(
+                    "UPDATE journal SET tentativi = tentativi + 1, errore = ? WHERE seq = ?", (descrizione, voce["seq"])
+                )
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO journal_scartate SELECT seq, operazione, codice, payload, creato, "
+                "tentativi + 1, ?, ? FROM journal WHERE seq = ?",
+                (descrizione, datetime.now().isoformat(timespec="seconds"), voce["seq"])
+            )
+            conn.execute("DELETE FROM journal WHERE seq = ?", (voce["seq"],))
+        return True
+
+    def push(self):
+        """Invia al foglio le operazioni del journal in ordine.
+
+        Un errore transitorio (rete, 429, 5xx) ferma l'invio fino al prossimo tentativo.
+        Una voce che fallisce sempre (payload non valido, cella rifiutata) dopo
+        SYNC_TENTATIVI_MAX tentativi finisce in journal_scartate e la coda prosegue.
+        """
+        with self.lock_sync:
+            conn = self.locale._conn()
+            voci = conn.execute(
+                "SELECT seq, operazione, codice, payload, tentativi FROM journal ORDER BY seq"
+            ).fetchall()
+            i = 0
+            while i < len(voci):
+                # Eventi consecutivi: una sola append_rows
+                gruppo = [voci[i]]
+                if voci[i]["operazione"] == "eventi":
+                    while i + len(gruppo) < len(voci) and voci[i + len(gruppo)]["operazione"] == "eventi":
+                        gruppo.append(voci[i + len(gruppo)])
+                errore = self._prova(gruppo)
+                if errore is None:
+                    inviate = gruppo
+                elif errore_transitorio(errore):
+                    raise errore
+                else:
+                    inviate = []
+                    for voce in gruppo:
+                        # Un gruppo di eventi si ritenta una voce alla volta per isolare quella che fallisce
+                        errore_voce = errore if len(gruppo) == 1 else self._prova([voce])
+                        if errore_voce is None:
+                            inviate.append(voce)
+                        elif errore_transitorio(errore_voce) or not self._registra_errore(conn, voce, errore_voce):
+                            # Le voci successive aspettano: l'ordine delle scritture va rispettato
+                            self._rimuovi(conn, inviate)
+                            raise errore_voce
+                self._rimuovi(conn, inviate)
+                i += len(gruppo)
+            self.stato["ultimo_push"] = datetime.now().isoformat(timespec="seconds")
+
+    def pull(self):
+        """Riallinea la cache con il foglio (modifiche fatte direttamente su Google Sheets)"""
+        with self.lock_sync:
+            righe_remote = self.remoto._leggi_righe()
+            eventi_remoti = self.remoto._leggi_eventi()
+            conn = self.locale._conn()
+            # I pazienti con operazioni ancora da inviare restano come sono in locale
+            in_attesa = {r[0] for r in conn.execute("SELECT DISTINCT codice FROM journal WHERE codice IS NOT NULL")}
+            if conn.execute("SELECT 1 FROM journal WHERE operazione = 'salva_tutti' LIMIT 1").fetchone():
+                return
+            with conn:
+                locali = {r[0] for r in conn.execute("SELECT codice FROM pazienti")}
+                for codice in locali - set(righe_remote) - in_attesa:
+                    conn.execute("DELETE FROM pazienti WHERE codice = ?", (codice,))
+                conn.executemany(
+                    SQL_UPSERT_PAZIENTE,
+                    [_riga_da_paziente(codice, data) for codice, data in righe_remote.items() if codice not in in_attesa]
+                )
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO eventi ({', '.join(COLONNE_EVENTI)}) VALUES (?, ?, ?, ?, ?, ?)",
+                    [_riga_da_evento(evento) for evento in eventi_remoti]
+                )
+            self.stato["ultimo_pull"] = datetime.now().isoformat(timespec="seconds")
+
+    def _worker(self):
+        ultimo_pull = time.monotonic()
+        while True:
+            self.sveglia.wait(timeout=SYNC_PULL_SECONDI)
+            self.sveglia.clear()
+            # Push e pull sono indipendenti: un invio bloccato non ferma il riallineamento
+            errori = []
+            try:
+                self.push()
+            except Exception as e:
+                errori.append(e)
+            if time.monotonic() - ultimo_pull >= SYNC_PULL_SECONDI:
+                try:
+                    self.pull()
+                    ultimo_pull = time.monotonic()
+                except Exception as e:
+                    errori.append(e)
+            if errori:
+                self.stato["ultimo_errore"] = f"{datetime.now().isoformat(timespec='seconds')}: {'; '.join(map(str, errori))}"
+                time.sleep(SYNC_RITENTA_SECONDI)
+                self.sveglia.set()
+            else:
+                self.stato["ultimo_errore"] = None
+
+    def stato_sync(self):
+        """Stato della sincronizzazione per il pannello admin"""
+        conn = self.locale._conn()
+        in_coda = conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]
+        in_errore = conn.execute(
+            "SELECT seq, operazione, codice, tentativi, errore FROM journal WHERE tentativi > 0 ORDER BY seq"
+        ).fetchall()
+        scartate = conn.execute(
+            "SELECT seq, operazione, codice, tentativi, errore, scartata FROM journal_scartate ORDER BY seq DESC"
+        ).fetchall()
+        return dict(
+            self.stato,
+            operazioni_in_coda=in_coda,
+            operazioni_in_errore=[dict(r) for r in in_errore],
+            operazioni_scartate=len(scartate),
+            ultime_scartate=[dict(r) for r in scartate[:10]]
+        )
+
+BACKEND_DISPONIBILI = {
+    "sheets": BackendGoogleSheets,
+    "sqlite": BackendSQLite,
+    "cache": BackendCacheLocale
+}
+
+@st.cache_resource
+def get_storage():
+    """Backend scelto da config: storage_backend = "sheets" (default), "sqlite" o "cache" """
+    nome = leggi_config("storage_backend", "sheets")
+    if nome not in BACKEND_DISPONIBILI:
+        raise ValueError(f"storage_backend sconosciuto: {nome}")
+    if nome == "sqlite":
+        return BackendSQLite(leggi_config("sqlite_path", SQLITE_PATH))
+    if nome == "cache":
+        return BackendCacheLocale(leggi_config("cache_path", CACHE_LOCALE_PATH)).avvia()
+    return BACKEND_DISPONIBILI[nome]()
+
+# --------------------------------------------------
+# CACHE CONDIVISA TRA REPLICHE (memoria, file SQLite o Redis)
+# --------------------------------------------------
+# Con più repliche dietro un bilanciatore ognuna caricherebbe il database per conto
+# suo: lo snapshot caricato da una replica finisce nella cache condivisa e le altre
+# lo riusano. Ogni scrittura incrementa la generazione, così le altre repliche
+# scartano il proprio snapshot. Di base la cache vive solo nel processo.
+CACHE_CONDIVISA_PATH = os.path.join(BASE_DIR, "cache_condivisa.db")
+CONDIVISA_PREFISSO = "rrfisio"
+CONDIVISA_CONTROLLO_SECONDI = 2.0     # ogni quanto una replica rilegge la generazione
+CONDIVISA_ATTESA_CARICAMENTO = 10.0   # attesa massima dello snapshot caricato da un'altra replica
+CONDIVISA_MEMORIA_MAX = 1000          # voci oltre le quali la cache in memoria elimina le scadute
+REDIS_TIMEOUT_SECONDI = 5
+URL_FIRMATO_CACHE_SECONDI = 6 * 24 * 3600  # gli URL firmati valgono 7 giorni
+PDF_CACHE_SECONDI = 24 * 3600
+
+def chiave_condivisa(*parti):
+    return ":".join([CONDIVISA_PREFISSO, *map(str, parti)])
+
+class CacheCondivisa:
+    """Cache chiave -> bytes con scadenza e contatori, solo in questo processo.
+
+    CacheCondivisaSQLite e CacheCondivisaRedis hanno la stessa interfaccia e sono
+    condivise tra processi (condivisa = True).
+    """
+
+    condivisa = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.valori = {}  # chiave -> (valore, scadenza epoch o None)
+
+    def _viva(self, chiave):
+        voce = self.valori.get(chiave)
+        if voce is not None and voce[1] is not None and voce[1] <= time.time():
+            del self.valori[chiave]
+            return None
+        return voce
+
+    def _imposta(self, chiave, valore, ttl):
+        self.valori[chiave] = (valore, time.time() + ttl if ttl else None)
+        if len(self.valori) > CONDIVISA_MEMORIA_MAX:
+            for vecchia in list(self.valori):
+                self._viva(vecchia)
+
+    def leggi(self, chiave):
+        with self.lock:
+            voce = self._viva(chiave)
+            return voce[0] if voce else None
+
+    def scrivi(self, chiave, valore, ttl=None):
+        with self.lock:
+            self._imposta(chiave, valore, ttl)
+
+    def scrivi_se_assente(self, chiave, valore, ttl=None):
+        """True se la chiave non c'era (serve come lock tra repliche)"""
+        with self.lock:
+            if self._viva(chiave) is not None:
+                return False
+            self._imposta(chiave, valore, ttl)
+            return True
+
+    def incrementa(self, chiave):
+        with self.lock:
+            voce = self._viva(chiave)
+            valore = int(voce[0]) + 1 if voce else 1
+            self._imposta(chiave, str(valore).encode(), None)
+            return valore
+
+    def intero(self, chiave):
+        valore = self.leggi(chiave)
+        return int(valore) if valore else 0
+
+class CacheCondivisaSQLite(CacheCondivisa):
+    """Cache in un file SQLite: condivisa dalle repliche sullo stesso host e nei test"""
+
+    condivisa = True
+
+    def __init__(self, path=CACHE_CONDIVISA_PATH):
+        self.path = path
+        self.locale = threading.local()
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS cache (chiave TEXT PRIMARY KEY, valore BLOB NOT NULL, scadenza REAL)"
+        )
+
+    def _conn(self):
+        """Una connessione per thread, come BackendSQLite"""
+        conn = getattr(self.locale, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.locale.conn = conn
+        return conn
+
+    @staticmethod
+    def _scadenza(ttl):
+        return time.time() + ttl if ttl else None
+
+    def leggi(self, chiave):
+        riga = self._conn().execute(
+            "SELECT valore FROM cache WHERE chiave = ? AND (scadenza IS NULL OR scadenza > ?)", (chiave, time.time())
+        ).fetchone()
+        return bytes(riga[0]) if riga else None
+
+    def scrivi(self, chiave, valore, ttl=None):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM cache WHERE scadenza <= ?", (time.time(),))
+            conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", (chiave, valore, self._scadenza(ttl)))
+
+    def scrivi_se_assente(self, chiave, valore, ttl=None):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM cache WHERE chiave = ? AND scadenza <= ?", (chiave, time.time()))
+            cursore = conn.execute("INSERT OR IGNORE INTO cache VALUES (?, ?, ?)", (chiave, valore, self._scadenza(ttl)))
+            return cursore.rowcount == 1
+
+    def incrementa(self, chiave):
+        with self._conn() as conn:
+            return int(conn.execute(
+                "INSERT INTO cache VALUES (?, 1, NULL) "
+                "ON CONFLICT(chiave) DO UPDATE SET valore = CAST(valore AS INTEGER) + 1 RETURNING valore",
+                (chiave,)
+            ).fetchone()[0])
+
+    def intero(self, chiave):
+        riga = self._conn().execute("SELECT CAST(valore AS INTEGER) FROM cache WHERE chiave = ?", (chiave,)).fetchone()
+        return int(riga[0]) if riga else 0
+
+class CacheCondivisaRedis(CacheCondivisa):
+    """Client minimo del protocollo Redis (RESP): GET, SET con EX/NX, INCR.
+
+    Una connessione per processo, serializzata da un lock; riconnessione
+    automatica. URL: redis://[:password@]host:porta/db (rediss:// per TLS).
+    """
+
+    condivisa = True
+
+    def __init__(self, url):
+        self.url = urlparse(url)
+        self.lock = threading.Lock()
+        self.sock = None
+        self.file = None
+
+    def _connetti(self):
+        sock = socket.create_connection((self.url.hostname or "localhost", self.url.port or 6379), REDIS_TIMEOUT_SECONDI)
+        if self.url.scheme == "rediss":
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.url.hostname)
+        self.sock, self.file = sock, sock.makefile("rb")
+        if self.url.password:
+            utente = [unquote(self.url.username)] if self.url.username else []
+            self._invia("AUTH", *utente, unquote(self.url.password))
+        database = self.url.path.strip("/")
+        if database and database != "0":
+            self._invia("SELECT", database)
+
+    def _chiudi(self):
+        try:
+            if self.sock is not None:
+                self.sock.close()
+        finally:
+            self.sock = self.file = None
+
+    def _invia(self, *parti):
+        dati = [p if isinstance(p, bytes) else str(p).encode() for p in parti]
+        self.sock.sendall(b"*%d\r\n" % len(dati) + b"".join(b"$%d\r\n%s\r\n" % (len(d), d) for d in dati))
+        return self._risposta()
+
+    def _risposta(self):
+        riga = self.file.readline()
+        if not riga.endswith(b"\r\n"):
+            raise ConnectionError("connessione Redis chiusa")
+        tipo, resto = riga[:1], riga[1:-2]
+        if tipo == b"+":
+            return resto
+        if tipo == b"-":
+            raise RuntimeError(f"Redis: {resto.decode(errors='replace')}")
+        if tipo == b":":
+            return int(resto)
+        if tipo == b"$":
+            lunghezza = int(resto)
+            return None if lunghezza < 0 else self.file.read(lunghezza + 2)[:-2]
+        if tipo == b"*":
+            lunghezza = int(resto)
+            return None if lunghezza < 0 else [self._risposta() for _ in range(lunghezza)]
+        raise ConnectionError(f"risposta Redis non valida: {riga[:40]!r}")
+
+    def _comando(self, *parti):
+        with self.lock:
+            for tentativo in range(2):
+                try:
+                    if self.sock is None:
+                        self._connetti()
+                    return self._invia(*parti)
+                except (OSError, ConnectionError):
+                    # Connessione caduta (es. timeout o riavvio di Redis): un nuovo tentativo
+                    self._chiudi()
+                    if tentativo:
+                        raise
+
+    def leggi(self, chiave):
+        return self._comando("GET", chiave)
+
+    def scrivi(self, chiave, valore, ttl=None):
+        if ttl:
+            self._comando("SET", chiave, valore, "EX", max(1, int(ttl)))
+        else:
+            self._comando("SET", chiave, valore)
+
+    def scrivi_se_assente(self, chiave, valore, ttl=None):
+        opzioni = ("EX", max(1, int(ttl))) if ttl else ()
+        return self._comando("SET", chiave, valore, "NX", *opzioni) is not None
+
+    def incrementa(self, chiave):
+        return self._comando("INCR", chiave)
+
+CACHE_CONDIVISE = {
+    "memoria": CacheCondivisa,
+    "sqlite": CacheCondivisaSQLite,
+    "redis": CacheCondivisaRedis
+}
+
+@st.cache_resource
+def get_cache_condivisa():
+    """Cache scelta da config: cache_condivisa = "memoria" (default), "sqlite" o "redis" """
+    nome = leggi_config("cache_condivisa", "memoria")
+    if nome not in CACHE_CONDIVISE:
+        raise ValueError(f"cache_condivisa sconosciuta: {nome}")
+    if nome == "sqlite":
+        return CacheCondivisaSQLite(leggi_config("cache_condivisa_path", CACHE_CONDIVISA_PATH))
+    if nome == "redis":
+        return CacheCondivisaRedis(leggi_config("redis_url", "redis://localhost:6379/0"))
+    return CacheCondivisa()
+
+class AllineamentoRepliche:
+    """Generazione condivisa: una scrittura su una replica invalida lo snapshot delle altre"""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.nota = None          # ultima generazione vista da questa replica
+        self.controllato_il = 0.0
+        if cache.condivisa:
+            try:
+                self.nota = cache.intero(chiave_condivisa("generazione"))
+            except Exception:
+                pass
+
+    def controlla(self):
+        """Prima di leggere lo snapshot; al massimo un accesso alla cache ogni CONDIVISA_CONTROLLO_SECONDI"""
+        if not self.cache.condivisa:
+            return
+        with self.lock:
+            if time.monotonic() - self.controllato_il < CONDIVISA_CONTROLLO_SECONDI:
+                return
+            self.controllato_il = time.monotonic()
+        try:
+            generazione = self.cache.intero(chiave_condivisa("generazione"))
+        except Exception:
+            # Cache condivisa irraggiungibile: si prosegue con i dati locali
+            return
+        self._allinea(generazione, propria=False)
+
+    def scrittura(self):
+        """Dopo una scrittura di questa replica: nuova generazione per tutte le altre"""
+        if not self.cache.condivisa:
+            return
+        try:
+            generazione = self.cache.incrementa(chiave_condivisa("generazione"))
+        except Exception:
+            return
+        self._allinea(generazione, propria=True)
+
+    def _allinea(self, generazione, propria):
+        with self.lock:
+            nota, self.nota = self.nota, generazione
+        # Una generazione diversa da quella attesa vuol dire scritture di altre repliche
+        if nota is not None and generazione != nota + (1 if propria else 0):
+            get_snapshot_database().invalida()
+
+@st.cache_resource
+def get_allineamento_repliche():
+    return AllineamentoRepliche(get_cache_condivisa())
+
+def segnala_scrittura():
+    """Da chiamare dopo ogni scrittura sul backend"""
+    get_allineamento_repliche().scrittura()
+
+def _codifica_snapshot(dati):
+    """Snapshot -> bytes; i campi JSON ancora non letti restano testo grezzo"""
+    pazienti = {}
+    for codice, paziente in dati.items():
+        grezzi = {}
+        if hasattr(paziente, "cella_grezza"):
+            grezzi = {campo: paziente.cella_grezza(campo) for campo in paziente if paziente.cella_grezza(campo) is not None}
+        pazienti[codice] = [{campo: paziente[campo] for campo in paziente if campo not in grezzi}, grezzi]
+    return zlib.compress(json.dumps(pazienti, ensure_ascii=False).encode("utf-8"))
+
+def _decodifica_snapshot(blob):
+    pazienti = json.loads(zlib.decompress(blob).decode("utf-8"))
+    return {codice: RecordPaziente(valori, grezzi) for codice, (valori, grezzi) in pazienti.items()}
+
+def carica_condiviso(nome, carica):
+    """Snapshot della generazione corrente dalla cache condivisa; se manca lo legge una sola replica"""
+    cache = get_cache_condivisa()
+    if not cache.condivisa:
+        return carica()
+    try:
+        generazione = cache.intero(chiave_condivisa("generazione"))
+        chiave = chiave_condivisa("snapshot", nome, generazione)
+        blob = cache.leggi(chiave)
+        if blob is None and not cache.scrivi_se_assente(
+            chiave_condivisa("caricamento", nome, generazione), b"1", CONDIVISA_ATTESA_CARICAMENTO
+        ):
+            # Un'altra replica sta già leggendo il backend: si aspetta il suo snapshot
+            scadenza = time.monotonic() + CONDIVISA_ATTESA_CARICAMENTO
+            while blob is None and time.monotonic() < scadenza:
+                time.sleep(0.2)
+                blob = cache.leggi(chiave)
+        if blob is not None:
+            with traccia("cache_condivisa.snapshot"):
+                return _decodifica_snapshot(blob)
+    except Exception:
+        # Cache condivisa non disponibile: si legge direttamente il backend
+        return carica()
+    
+    dati = carica()
+    try:
+        # Scade con il TTL soft: le modifiche fatte a mano sul foglio arrivano comunque
+        cache.scrivi(chiave, _codifica_snapshot(dati), DB_TTL_SOFT)
+    except Exception:
+        pass
+    return dati
+
+# --------------------------------------------------
+# SNAPSHOT DATABASE (single-flight + stale-while-revalidate)
+# --------------------------------------------------
+DB_TTL_SOFT = 10    # secondi: oltre, si serve lo snapshot attuale e si aggiorna in background
+DB_TTL_HARD = 300   # secondi: oltre, chi legge attende il nuovo caricamento
+DB_RICARICA_MASSIMA = 900  # secondi: oltre, si riscarica tutto anche se il segnale di modifica è fermo
+
+# Campi letti dall'area fisioterapista: una sola proiezione per statistiche,
+# promemoria ed elenco (una lettura del foglio e del log eventi per pagina)
+CAMPI_FISIOTERAPISTA = (
+    "nome", "motivo", "data_creazione", "email",
+    "scheda", "progressi", "storico", "video_pazienti",
+)
+
+class DizionarioCongelato(dict):
+    """Dizionario in sola lettura: lo snapshot è condiviso tra tutte le sessioni.
+
+    Resta un dict (json.dumps e le letture funzionano come prima); per modificare
+    un paziente si passa dagli eventi o da invalida_paziente.
+    """
+    __slots__ = ()
+
+    def _sola_lettura(self, *args, **kwargs):
+        raise TypeError("dati paziente in sola lettura: usa gli eventi o invalida_paziente")
+
+    __setitem__ = __delitem__ = __ior__ = _sola_lettura
+    clear = pop = popitem = setdefault = update = _sola_lettura
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return scongela(self)
+
+def congela(valore):
+    """Copia in sola lettura (dict -> DizionarioCongelato, liste -> tuple)"""
+    if isinstance(valore, DizionarioCongelato):
+        return valore
+    # Duck typing: Streamlit riesegue lo script a ogni rerun, quindi i record tenuti
+    # nelle cache condivise possono essere istanze della classe di un run precedente
+    if hasattr(valore, "congelato"):
+        return valore.congelato()
+    if isinstance(valore, dict):
+        return DizionarioCongelato((k, congela(v)) for k, v in valore.items())
+    if isinstance(valore, (list, tuple)):
+        return tuple(congela(v) for v in valore)
+    return valore
+
+def scongela(valore):
+    """Copia modificabile di un valore congelato (dict e liste normali)"""
+    if hasattr(valore, "modificabile"):
+        return valore.modificabile()
+    if isinstance(valore, dict):
+        return {k: scongela(v) for k, v in valore.items()}
+    if isinstance(valore, (list, tuple)):
+        return [scongela(v) for v in valore]
+    return valore
+
+def _patch_copy_on_write(dati, codici, patch):
+    """Applica una patch scongelando solo i pazienti toccati; ritorna il nuovo snapshot"""
+    dati = dict(dati)
+    for codice in codici:
+        if codice in dati:
+            dati[codice] = scongela(dati[codice])
+    patch(dati)
+    for codice in codici:
+        if codice in dati:
+            dati[codice] = congela(dati[codice])
+    return DizionarioCongelato(dati)
+
+class SnapshotDatabase:
+    """Snapshot del database condiviso tra sessioni, con un solo caricamento alla volta.
+
+    Le scritture non svuotano la cache: aggiornano solo i pazienti toccati
+    (versione per paziente); la generazione cambia solo con invalida()
+    (es. scritture arrivate da altre repliche).
+    Lo snapshot è congelato e viene restituito senza copie: ogni modifica ne
+    crea uno nuovo che condivide i pazienti non toccati.
+    """
+
+    def __init__(self, carica, campi=None):
+        self.carica = carica
+        self.campi = campi     # None = pazienti completi, altrimenti solo questi campi
+        self.derivati = []     # snapshot proiettati che ricevono le stesse modifiche
+        self.lock = threading.Lock()
+        self.dati = None
+        self.caricato_il = 0.0
+        self.invalidato = False
+        self.in_corso = None   # threading.Event del caricamento in corso
+        self.ultimo_errore = None
+        self.generazione = 0
+        self.versioni = {}     # codice -> versione
+        self.patch_in_volo = None  # patch arrivate durante un caricamento
+        self.controlla = None      # eventuale verifica prima di ogni lettura (es. AllineamentoRepliche)
+        self.firma = None          # eventuale segnale economico di modifica (StorageBackend.firma_modifiche)
+        self.firma_dati = None     # segnale letto prima dell'ultimo caricamento completo
+        self.scaricato_il = 0.0
+        self.ricariche_evitate = 0
+
+    def _eta(self):
+        return time.monotonic() - self.caricato_il
+
+    def disponibile(self):
+        """True se leggi() risponderebbe senza attendere un caricamento"""
+        with self.lock:
+            return self.dati is not None and not self.invalidato and self._eta() < DB_TTL_HARD
+
+    def leggi(self):
+        """Ritorna lo snapshot; al massimo un caricamento per scadenza.
+
+        Tra DB_TTL_SOFT e DB_TTL_HARD si serve lo snapshot e si ricarica in
+        background; se è invalidato o più vecchio di DB_TTL_HARD si attende
+        il caricamento (proprio o già in corso).
+        """
+        if self.controlla is not None:
+            self.controlla()
+        with self.lock:
+            fresco = self.dati is not None and not self.invalidato
+            if fresco and self._eta() < DB_TTL_SOFT:
+                return self.dati
+            if self.in_corso is not None:
+                # Qualcun altro sta già caricando: lo snapshot precedente si serve solo
+                # se è ancora entro DB_TTL_HARD e non invalidato, altrimenti si attende
+                if fresco and self._eta() < DB_TTL_HARD:
+                    return self.dati
+                evento = self.in_corso
+                leader = False
+            else:
+                evento = self.in_corso = threading.Event()
+                leader = True
+                if fresco and self._eta() < DB_TTL_HARD:
+                    # Stale-while-revalidate: aggiorna in background
+                    threading.Thread(target=self._ricarica, args=(evento,), daemon=True).start()
+                    return self.dati
+
+        if leader:
+            self._ricarica(evento)
+        else:
+            evento.wait()
+        with self.lock:
+            if self.dati is None:
+                raise RuntimeError(self.ultimo_errore or "database non disponibile")
+            return self.dati
+
+    def _invariato(self):
+        """Legge il segnale di modifica; True se i dati non sono cambiati dall'ultimo caricamento"""
+        with self.lock:
+            confrontabile = (
+                self.dati is not None and not self.invalidato
+                and time.monotonic() - self.scaricato_il < DB_RICARICA_MASSIMA
+            )
+        try:
+            with traccia("carica_database.firma"):
+                firma = self.firma()
+        except Exception:
+            # Segnale non disponibile: si scarica tutto
+            firma = None
+        invariato = confrontabile and firma is not None and firma == self.firma_dati
+        return invariato, firma
+
+    def _ricarica(self, evento):
+        with self.lock:
+            self.patch_in_volo = []
+            generazione = self.generazione
+        try:
+            firma = None
+            if self.firma is not None:
+                # Il segnale si legge prima dei dati: una modifica durante il download
+                # lo fa cambiare di nuovo e provoca un altro caricamento
+                invariato, firma = self._invariato()
+                if invariato:
+                    with self.lock:
+                        self.caricato_il = time.monotonic()
+                        self.ultimo_errore = None
+                        self.ricariche_evitate += 1
+                    return
+            with traccia("carica_database.ricarica"):
+                dati = self.carica()
+            dati = DizionarioCongelato((codice, congela(paziente)) for codice, paziente in dati.items())
+            with self.lock:
+                # Le scritture avvenute durante la lettura potrebbero mancare: riapplicale
+                for codici, patch in self.patch_in_volo:
+                    dati = _patch_copy_on_write(dati, codici, patch)
+                self.dati = dati
+                self.caricato_il = self.scaricato_il = time.monotonic()
+                self.firma_dati = firma
+                # Un invalida() arrivato durante il download richiede un altro caricamento
+                self.invalidato = self.generazione != generazione
+                self.ultimo_errore = None
+        except Exception as e:
+            # In caso di errore resta valido lo snapshot precedente
+            with self.lock:
+                self.ultimo_errore = str(e)
+        finally:
+            with self.lock:
+                self.in_corso = None
+                self.patch_in_volo = None
+            evento.set()
+
+    def _applica_patch(self, codici, patch):
+        """Copy-on-write dei soli pazienti toccati + incremento della loro versione"""
+        with self.lock:
+            if self.dati is not None:
+                self.dati = _patch_copy_on_write(self.dati, codici, patch)
+            if self.patch_in_volo is not None:
+                self.patch_in_volo.append((codici, patch))
+            for codice in codici:
+                self.versioni[codice] = self.versioni.get(codice, 0) + 1
+
+    def applica_eventi(self, eventi):
+        """Aggiorna lo snapshot con eventi appena scritti sul backend"""
+        self._applica_patch({e["codice"] for e in eventi}, lambda dati: materializza_eventi(dati, eventi))
+        for derivato in self.derivati:
+            derivato.applica_eventi(eventi)
+
+    def aggiorna_paziente(self, codice, paziente):
+        """Sostituisce (o elimina, se paziente è None) un paziente nello snapshot"""
+        def patch(dati):
+            if paziente is None:
+                dati.pop(codice, None)
+            elif self.campi is None:
+                dati[codice] = congela(paziente)
+            else:
+                dati[codice] = congela(proietta_paziente(paziente, self.campi))
+        self._applica_patch([codice], patch)
+        for derivato in self.derivati:
+            derivato.aggiorna_paziente(codice, paziente)
+
+    def versione(self, codice):
+        """Versione del paziente: cambia solo quando cambiano i suoi dati"""
+        with self.lock:
+            return (self.generazione, self.versioni.get(codice, 0))
+
+    def invalida(self):
+        """Riscrittura completa: nuova generazione, il prossimo lettore attende dati aggiornati"""
+        with self.lock:
+            self.invalidato = True
+            self.generazione += 1
+        for derivato in self.derivati:
+            derivato.invalida()
+
+@st.cache_resource
+def get_snapshot_database():
+    """Snapshot unico per processo (condiviso tra repliche se c'è la cache condivisa)"""
+    snapshot = SnapshotDatabase(lambda: carica_condiviso("database", get_storage().lista_pazienti))
+    snapshot.controlla = get_allineamento_repliche().controlla
+    snapshot.firma = lambda: get_storage().firma_modifiche()
+    return snapshot
+
+@st.cache_resource
+def get_snapshot_riepilogo(campi):
+    """Snapshot proiettato su alcuni campi, aggiornato insieme a quello completo"""
+    snapshot = SnapshotDatabase(
+        lambda: carica_condiviso(f"riepilogo:{','.join(campi)}", lambda: get_storage().riepilogo_pazienti(campi)),
+        campi=campi
+    )
+    snapshot.controlla = get_allineamento_repliche().controlla
+    snapshot.firma = lambda: get_storage().firma_modifiche()
+    get_snapshot_database().derivati.append(snapshot)
+    return snapshot
+
+def invalida_paziente(codice, paziente):
+    """Da chiamare dopo aver creato/aggiornato (o eliminato, con None) un paziente"""
+    get_snapshot_database().aggiorna_paziente(codice, paziente)
+    segnala_scrittura()
+    if paziente is not None:
+        get_cache_negativa().rimuovi(codice)
+
+@tracciato("carica_database")
+def carica_database():
+    """Pazienti dal backend con sopra gli eventi ancora nel buffer (in sola lettura)"""
+    try:
+        # Nessuna copia: lo snapshot è congelato e condiviso tra chiamate e sessioni
+        db = get_snapshot_database().leggi()
+    except Exception as e:
+        st.error(f"❌ Errore caricamento database: {e}")
+        return {}
+    
+    if not db:
+        st.info("ℹ️ Nessun paziente nel database")
+    
+    return get_buffer_scritture().sovrapponi(db)
+
+@tracciato("carica_riepilogo")
+def carica_riepilogo(campi):
+    """Solo i campi richiesti di tutti i pazienti, per dashboard ed elenchi (in sola lettura)"""
+    completo = get_snapshot_database()
+    try:
+        # Se il database completo è già in memoria non serve leggere altro
+        if completo.disponibile():
+            db = completo.leggi()
+        else:
+            db = get_snapshot_riepilogo(tuple(campi)).leggi()
+    except Exception as e:
+        st.error(f"❌ Errore caricamento database: {e}")
+        return {}
+    return get_buffer_scritture().sovrapponi(db)
+
+@tracciato("carica_paziente")
+def carica_paziente(codice):
+    """Un solo paziente (lettura puntuale se il backend la supporta)"""
+    storage = get_storage()
+    if not storage.letture_puntuali:
+        try:
+            paziente = get_snapshot_database().leggi().get(codice)
+        except Exception as e:
+            st.error(f"❌ Errore caricamento paziente: {e}")
+            return None
+        if paziente is None:
+            return None
+        return get_buffer_scritture().sovrapponi({codice: paziente})[codice]
+    try:
+        paziente = storage.get_paziente(codice)
+    except Exception as e:
+        st.error(f"❌ Errore caricamento paziente: {e}")
+        return None
+    if paziente is None:
+        return None
+    return get_buffer_scritture().sovrapponi({codice: congela(paziente)})[codice]
+
+# --------------------------------------------------
+# VERIFICA CODICI PAZIENTE (i codici sconosciuti non arrivano al backend)
+# --------------------------------------------------
+CODICE_PAZIENTE_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+CAMPI_CODICI = ("nome",)          # proiezione minima per l'indice dei codici
+NEGATIVI_TTL_SECONDI = 60         # un codice sconosciuto resta rifiutato senza riverifica
+NEGATIVI_MASSIMI = 10000
+TENTATIVI_BURST = 10              # ricerche di codici nuovi consentite di fila per client
+TENTATIVI_AL_SECONDO = 0.2        # poi una ogni 5 secondi
+CLIENT_MASSIMI = 10000
+
+class IndiceCodici:
+    """Codici paziente in memoria, indicizzati per digest e confrontati a tempo costante"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origine = None
+        self.digest = {}
+
+    @staticmethod
+    def _digest(codice):
+        return hashlib.sha256(codice.encode("utf-8")).digest()
+
+    def contiene(self, db, codice):
+        """True se il codice è tra le chiavi di db (l'indice si ricostruisce solo se db cambia)"""
+        with self.lock:
+            if db is not self.origine:
+                self.digest = {self._digest(c): c.encode("utf-8") for c in db}
+                self.origine = db
+            atteso = self.digest.get(self._digest(codice))
+        return atteso is not None and hmac.compare_digest(atteso, codice.encode("utf-8"))
+
+class CacheNegativa:
+    """Codici già risultati sconosciuti, con scadenza; la più vecchia esce quando è piena"""
+
+    def __init__(self, ttl=NEGATIVI_TTL_SECONDI, massimo=NEGATIVI_MASSIMI):
+        self.ttl = ttl
+        self.massimo = massimo
+        self.lock = threading.Lock()
+        self.scadenze = {}  # codice -> scadenza (ordine di inserimento)
+
+    def contiene(self, codice):
+        with self.lock:
+            scadenza = self.scadenze.get(codice)
+            if scadenza is None:
+                return False
+            if scadenza < time.monotonic():
+                del self.scadenze[codice]
+                return False
+            return True
+
+    def aggiungi(self, codice):
+        with self.lock:
+            self.scadenze.pop(codice, None)
+            self.scadenze[codice] = time.monotonic() + self.ttl
+            while len(self.scadenze) > self.massimo:
+                del self.scadenze[next(iter(self.scadenze))]
+
+    def rimuovi(self, codice):
+        with self.lock:
+            self.scadenze.pop(codice, None)
+
+class LimitatoreTentativi:
+    """Token bucket per client sulle ricerche di codici paziente"""
+
+    def __init__(self, burst=TENTATIVI_BURST, al_secondo=TENTATIVI_AL_SECONDO, massimo=CLIENT_MASSIMI):
+        self.burst = burst
+        self.al_secondo = al_secondo
+        self.massimo = massimo
+        self.lock = threading.Lock()
+        self.secchi = {}  # client -> (gettoni, ultimo aggiornamento)
+        self.rifiutati = 0
+
+    def consenti(self, client, costo=1):
+        """True se il client ha almeno un gettone; costo=0 controlla senza consumarlo"""
+        adesso = time.monotonic()
+        with self.lock:
+            gettoni, ultimo = self.secchi.pop(client, (self.burst, adesso))
+            gettoni = min(self.burst, gettoni + (adesso - ultimo) * self.al_secondo)
+            consentito = gettoni >= 1
+            if consentito:
+                gettoni -= costo
+            else:
+                self.rifiutati += 1
+            self.secchi[client] = (gettoni, adesso)
+            while len(self.secchi) > self.massimo:
+                del self.secchi[next(iter(self.secchi))]
+            return consentito
+
+@st.cache_resource
+def get_indice_codici():
+    return IndiceCodici()
+
+@st.cache_resource
+def get_cache_negativa():
+    return CacheNegativa()
+
+@st.cache_resource
+def get_limitatore_tentativi():
+    return LimitatoreTentativi()
+
+def id_client():
+    """Chiave del client per il limitatore: IP se noto, altrimenti la sessione"""
+    ip = st.context.ip_address
+    if ip:
+        return f"ip:{ip}"
+    return "sessione:" + st.session_state.setdefault("id_client", uuid.uuid4().hex)
+
+@tracciato("verifica_codice_paziente")
+def verifica_codice_paziente(codice):
+    """'ok', 'sconosciuto' o 'troppi_tentativi'; solo 'ok' autorizza la lettura del paziente"""
+    verificati = st.session_state.setdefault("codici_verificati", set())
+    if codice in verificati:
+        return "ok"
+    limitatore = get_limitatore_tentativi()
+    client = id_client()
+    # Solo i codici sbagliati consumano gettoni (i pazienti dietro lo stesso NAT entrano
+    # sempre), ma un client bloccato non viene servito nemmeno con un codice valido:
+    # la risposta non deve rivelare quali codici esistono
+    if not limitatore.consenti(client, costo=0):
+        return "troppi_tentativi"
+    negativi = get_cache_negativa()
+    if not CODICE_PAZIENTE_RE.fullmatch(codice) or negativi.contiene(codice):
+        limitatore.consenti(client)
+        return "sconosciuto"
+    
+    # Indice dal database completo se è già in memoria, altrimenti dalla proiezione minima
+    completo = get_snapshot_database()
+    snapshot = completo if completo.disponibile() else get_snapshot_riepilogo(CAMPI_CODICI)
+    if not get_indice_codici().contiene(snapshot.leggi(), codice):
+        negativi.aggiungi(codice)
+        limitatore.consenti(client)
+        return "sconosciuto"
+    verificati.add(codice)
+    return "ok"
+
+# --------------------------------------------------
+# BUFFER SCRITTURE (write-behind azioni paziente)
+# --------------------------------------------------
+BUFFER_DEBOUNCE_SECONDI = 3.0
+BUFFER_RITENTA_SECONDI = 30.0
+BUFFER_ID_RICORDATI = 10000  # id di eventi già accettati: un reinvio (es. coda offline) viene ignorato
+
+class BufferScritture:
+    """Raccoglie gli eventi dei pazienti e li accoda al log in una sola scrittura"""
+
+    def __init__(self, debounce=BUFFER_DEBOUNCE_SECONDI):
+        self.debounce = debounce
+        self.lock = threading.Lock()
+        self.lock_flush = threading.Lock()
+        self.pendenti = []     # eventi in ordine di arrivo
+        self.in_scrittura = [] # eventi in invio al backend, ancora visibili ai lettori
+        self.timer = None
+        self.id_visti = set()
+        self.ordine_id = deque()
+
+    def registra(self, codice, evento):
+        """Accoda un evento e (ri)avvia la finestra di debounce; False se l'id era già stato accettato"""
+        evento = dict(evento, codice=codice)
+        with self.lock:
+            if evento["id"] in self.id_visti:
+                return False
+            self.id_visti.add(evento["id"])
+            self.ordine_id.append(evento["id"])
+            if len(self.ordine_id) > BUFFER_ID_RICORDATI:
+                self.id_visti.discard(self.ordine_id.popleft())
+            self.pendenti.append(evento)
+            self._programma(self.debounce)
+        return True
+
+    def _programma(self, ritardo):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = threading.Timer(ritardo, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def sovrapponi(self, db):
+        """Applica al database letto gli eventi non ancora scritti (copy-on-write)"""
+        with self.lock:
+            pendenti = self.in_scrittura + self.pendenti
+        codici = {evento["codice"] for evento in pendenti if evento["codice"] in db}
+        if not codici:
+            return db
+        return _patch_copy_on_write(db, codici, lambda dati: materializza_eventi(dati, pendenti))
+
+    def flush(self):
+        """Scrive tutti gli eventi pendenti con un'unica append"""
+        with self.lock_flush:
+            with self.lock:
+                da_scrivere, self.pendenti = self.pendenti, []
+                self.in_scrittura = da_scrivere
+                self.timer = None
+            if not da_scrivere:
+                return True
+            
+            try:
+                get_storage().append_eventi(da_scrivere)
+            except Exception:
+                # Rimetti in coda prima degli eventi arrivati nel frattempo e riprova più tardi
+                with self.lock:
+                    self.pendenti = da_scrivere + self.pendenti
+                    self.in_scrittura = []
+                    self._programma(BUFFER_RITENTA_SECONDI)
+                return False
+            
+            # Solo i pazienti toccati cambiano versione: il resto della cache resta valido
+            get_snapshot_database().applica_eventi(da_scrivere)
+            segnala_scrittura()
+            with self.lock:
+                self.in_scrittura = []
+            return True
+
+@st.cache_resource
+def get_buffer_scritture():
+    """Buffer unico per processo; svuotato anche alla chiusura del server"""
+    buffer = BufferScritture()
+    atexit.register(buffer.flush)
+    return buffer
+
+def genera_codice_paziente(nome_paziente):
+    """Genera un codice univoco per il paziente"""
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    raw = f"{nome_paziente}{timestamp}"
+    return hashlib.md5(raw.encode()).hexdigest()[:8]
+
+# --------------------------------------------------
+# LOAD CSV
+# --------------------------------------------------
+YOUTUBE_ID_RE = re.compile(
+    r"(?:youtu\.be/|youtube(?:-nocookie)?\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/))([\w-]{6,20})"
+)
+
+# Cache di Streamlit e non lru_cache: lo script viene rieseguito a ogni rerun e una
+# lru_cache di modulo ripartirebbe vuota ogni volta
+@st.cache_data(show_spinner=False, max_entries=1024)
+def normalizza_video(link):
+    """Video YouTube canonico: (id, link embed, anteprima), o None se il link non è YouTube"""
+    match = YOUTUBE_ID_RE.search(str(link or ""))
+    if not match:
+        return None
+    video_id = match.group(1)
+    return (
+        video_id,
+        f"https://www.youtube.com/embed/{video_id}",
+        f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+    )
+
+@st.cache_data
+def load_csv():
+    df = pd.read_csv("esercizi.csv")
+    df = df.fillna("")
+    df["distretto"] = df["distretto"].astype(str)
+    # Link YouTube normalizzati una volta sola al caricamento del catalogo
+    video = df["link_video"].map(normalizza_video)
+    df["video_embed"] = video.map(lambda v: v[1] if v else "")
+    df["video_anteprima"] = video.map(lambda v: v[2] if v else "")
+    return df
+
+df = load_csv()
+
+# --------------------------------------------------
+# TEMPLATE SCHEDE
+# --------------------------------------------------
+# Template predefiniti con distretto associato
+TEMPLATES = {
+        "Nessun template (selezione manuale)": {
+            "esercizi": [],
+            "distretto": None
+        },
+        "Lombalgia acuta": {
+            "esercizi": [
+                {"nome": "Ponte glutei", "serie": 3, "ripetizioni": 12},
+                {"nome": "Plank", "serie": 3, "ripetizioni": 30},
+                {"nome": "Respirazione diaframmatica", "serie": 3, "ripetizioni": 10}
+            ],
+            "distretto": "schiena"
+        },
+        "Spalla dolorosa": {
+            "esercizi": [
+                {"nome": "Rotazioni spalla", "serie": 3, "ripetizioni": 10},
+                {"nome": "Elevazioni laterali braccia", "serie": 3, "ripetizioni": 12},
+                {"nome": "Stretching globale", "serie": 2, "ripetizioni": 30}
+            ],
+            "distretto": "spalla"
+        },
+        "Ginocchio post-trauma": {
+            "esercizi": [
+                {"nome": "Squat corpo libero", "serie": 3, "ripetizioni": 10},
+                {"nome": "Affondi", "serie": 3, "ripetizioni": 10},
+                {"nome": "Ponte glutei", "serie": 3, "ripetizioni": 12}
+            ],
+            "distretto": "ginocchio"
+        },
+        "Cervicalgia": {
+            "esercizi": [
+                {"nome": "Stretch laterale collo", "serie": 3, "ripetizioni": 10},
+                {"nome": "Rotazioni cervicali", "serie": 3, "ripetizioni": 5},
+                {"nome": "Respirazione diaframmatica", "serie": 3, "ripetizioni": 10}
+            ],
+            "distretto": "collo"
+        },
+        "Riabilitazione Core": {
+            "esercizi": [
+                {"nome": "Plank", "serie": 3, "ripetizioni": 30},
+                {"nome": "Crunch", "serie": 3, "ripetizioni": 15},
+                {"nome": "Ponte glutei", "serie": 3, "ripetizioni": 12}
+            ],
+            "distretto": "addome"
+        }
+}
 
 # --------------------------------------------------
-# MODALITÀ PAZIENTE
+# GENERA PDF MODERNO
 # --------------------------------------------------
-if paziente_code:
-    db = carica_database()
-    
-    if paziente_code not in db:
-        st.error("❌ Codice paziente non valido!")
-        st.warning(f"Il codice `{paziente_code}` non è stato trovato nel database.")
-        st.info(f"Codici disponibili: {', '.join(list(db.keys())[:5])}...")
-        st.stop()
-    
-    paziente_data = db[paziente_code]
-    
-    # Salva codice nel browser per accesso rapido dalla home
-    st.markdown(f"""
-    <script>
-        // Salva il codice paziente nel localStorage
-        localStorage.setItem('paziente_code', '{paziente_code}');
-    </script>
-    """, unsafe_allow_html=True)
-    
-    # Header con logo
-    logo_path = os.path.join(BASE_DIR, "logo.png")
-    if os.path.exists(logo_path):
-        col_logo, col_title = st.columns([1, 3])
-        with col_logo:
-            st.image(logo_path, width=150)
-        with col_title:
-            st.title(f"Benvenuto, {paziente_data['nome']}!")
-            st.markdown(f"**Motivo visita:** {paziente_data['motivo']}")
-            st.markdown(f"**Data scheda:** {paziente_data['data_creazione']}")
-    else:
-        st.title(f"Benvenuto, {paziente_data['nome']}!")
-        st.markdown(f"**Motivo visita:** {paziente_data['motivo']}")
-        st.markdown(f"**Data scheda:** {paziente_data['data_creazione']}")
-    st.divider()
-    
-    # Banner installazione app
-    st.info("""
-    [SUGGERIMENTO]: Aggiungi questa pagina alla Home del tuo telefono per un accesso più rapido!
-    
-    • **iPhone**: Safari → Condividi → "Aggiungi a Home"  
-    • **Android**: Chrome → Menu (⋮) → "Installa app"
-    """)
-    
-  # Carica progressi
-    if "progressi" not in paziente_data:
-        paziente_data["progressi"] = {}
-    
-    # Statistiche (prima del loop!)
-    scheda = paziente_data["scheda"]
-    totale = len(scheda)
-    completati = sum(1 for ex in scheda if paziente_data["progressi"].get(ex["nome"], False))
-    
-    col1, col2, col3 = st.columns(3)
-    with col1:
-        st.metric("Totale esercizi", totale)
-    with col2:
-        st.metric("Completati", completati)
-    with col3:
-        progresso = int((completati / totale) * 100) if totale > 0 else 0
-        st.metric("Progresso", f"{progresso}%")
-    
-    st.progress(progresso / 100)
-    st.divider()
-    
-    # --------------------------------------------------
-    # GRAFICI E ANALISI
-    # --------------------------------------------------
-    st.subheader("I tuoi progressi")
-    
-    # Raccolta dati per i grafici
-    storico_data = paziente_data.get("storico", {})
-    
-    # Calcola tutte le date uniche e conta esercizi per data
-    date_conteggio = {}
-    tutte_date = []
-    
-    for esercizio_nome, date_list in storico_data.items():
-        for data in date_list:
-            tutte_date.append(data)
-            if data in date_conteggio:
-                date_conteggio[data] += 1
-            else:
-                date_conteggio[data] = 1
-    
-    # Ordina le date
-    if tutte_date:
-        tutte_date_uniche = sorted(list(set(tutte_date)), key=lambda x: datetime.strptime(x, "%d/%m/%Y"))
-    else:
-        tutte_date_uniche = []
-    
-    # Calcola streak (giorni consecutivi)
-    def calcola_streak(date_list):
-        if not date_list:
-            return 0
-        
-        date_obj = [datetime.strptime(d, "%d/%m/%Y") for d in date_list]
-        date_obj_sorted = sorted(date_obj, reverse=True)
+def draw_background_and_footer(canvas, doc):
+        """Disegna sfondo e footer con design moderno"""
+        # Sfondo bianco pulito (opzionale: sfondo.png se presente)
+        bg_path = os.path.join(BASE_DIR, "background.png")
+        if os.path.exists(bg_path):
+            canvas.drawImage(bg_path, 0, 0, width=A4[0], height=A4[1], preserveAspectRatio=True, mask='auto')
         
-        streak = 1
-        oggi = datetime.now()
+        # Footer moderno
+        canvas.saveState()
+        canvas.setFont("Helvetica", 8)
+        canvas.setFillColorRGB(0.4, 0.4, 0.4)
         
-        # Check se l'ultima data è oggi o ieri
-        ultima = date_obj_sorted[0]
-        diff_giorni = (oggi - ultima).days
+        # Linea separatore footer
+        canvas.setStrokeColorRGB(0.12, 0.24, 0.45)  # Blu brand
+        canvas.setLineWidth(1)
+        canvas.line(2*cm, 1.8*cm, A4[0]-2*cm, 1.8*cm)
         
-        if diff_giorni > 1:
-            return 0  # Streak interrotto
+        # Testo footer
+        canvas.drawCentredString(A4[0]/2, 1.3*cm, "Riccardo Rispoli – Fisioterapista OMPT")
+        canvas.setFont("Helvetica", 7)
+        canvas.drawCentredString(A4[0]/2, 1.0*cm, "📧 riccardo.rspl@gmail.com  •  📱 +39 3313552300")
         
-        # Conta giorni consecutivi
-        for i in range(len(date_obj_sorted) - 1):
-            diff = (date_obj_sorted[i] - date_obj_sorted[i + 1]).days
-            if diff == 1:
-                streak += 1
-            else:
-                break
+        # Numero pagina
+        canvas.setFont("Helvetica-Bold", 8)
+        page_num = canvas.getPageNumber()
+        canvas.drawRightString(A4[0]-2*cm, 1.3*cm, f"Pagina {page_num}")
         
-        return streak
-    
-    streak_attuale = calcola_streak(tutte_date_uniche)
-    
-    # Mostra streak con badge
-    if streak_attuale > 0:
-        st.success(f"🔥 **Streak attuale: {streak_attuale} {'giorno' if streak_attuale == 1 else 'giorni'} consecutivi!** Continua così! 💪")
-    else:
-        st.info("[INFO] Inizia il tuo streak completando un esercizio oggi!")
-    
-    # Bottone Report PDF
-    st.markdown("---")
-    if st.button("📄 Genera Report Progresso", type="secondary", width="stretch"):
-        with st.spinner("Generazione report in corso..."):
-            report_pdf = genera_report_progresso(paziente_data, paziente_code)
-            st.download_button(
-                "⬇️ Scarica Report PDF",
-                report_pdf,
-                file_name=f"Report_{paziente_data['nome'].replace(' ', '_')}.pdf",
-                mime="application/pdf",
-                width="stretch"
-            )
-    st.markdown("---")
-    
-    # TAB per diversi grafici
-    tab1, tab2 = st.tabs(["📈 Andamento allenamenti", "📊 Dettaglio esercizi"])
-    
-    with tab1:
-        if tutte_date_uniche:
-            # Grafico a linee - Esercizi per giorno
-            import pandas as pd
-            
-            # Prepara dati per il grafico
-            date_per_grafico = []
-            conteggio_per_grafico = []
-            
-            for data in tutte_date_uniche:
-                date_per_grafico.append(data)
-                conteggio_per_grafico.append(date_conteggio[data])
-            
-            df_grafico = pd.DataFrame({
-                "Data": date_per_grafico,
-                "Esercizi completati": conteggio_per_grafico
-            })
-            
-            st.line_chart(df_grafico.set_index("Data"), height=300)
-            
-            # Statistiche aggiuntive
-            col_stat1, col_stat2, col_stat3 = st.columns(3)
-            with col_stat1:
-                st.metric("Giorni totali allenamento", len(tutte_date_uniche))
-            with col_stat2:
-                media_esercizi = sum(conteggio_per_grafico) / len(conteggio_per_grafico)
-                st.metric("Media esercizi/giorno", f"{media_esercizi:.1f}")
-            with col_stat3:
-                st.metric("Totale ripetizioni", sum(conteggio_per_grafico))
-        else:
-            st.info("📈 Il grafico apparirà quando inizierai a completare gli esercizi!")
-    
-    with tab2:
-        # Grafico a barre - Completamento per esercizio
-        if storico_data:
-            st.markdown("**Quante volte hai fatto ogni esercizio:**")
-            
-            for esercizio in scheda:
-                nome = esercizio["nome"]
-                volte = len(storico_data.get(nome, []))
-                
-                # Barra di progresso personalizzata
-                col_nome, col_barra, col_num = st.columns([3, 5, 1])
-                with col_nome:
-                    st.markdown(f"**{nome}**")
-                with col_barra:
-                    # Calcola percentuale rispetto al massimo
-                    max_volte = max([len(v) for v in storico_data.values()]) if storico_data else 1
-                    percentuale = (volte / max_volte) if max_volte > 0 else 0
-                    st.progress(percentuale)
-                with col_num:
-                    st.markdown(f"**{volte}x**")
-        else:
-            st.info("📊 I dettagli appariranno quando completi gli esercizi!")
-    
-    st.divider()
+        canvas.restoreState()
 
-    st.divider()
-    
-    # --------------------------------------------------
-    # IMPOSTAZIONI PAZIENTE
-    # --------------------------------------------------
-    with st.expander("⚙️ Impostazioni"):
-        st.markdown("**Configurazione promemoria**")
+@st.cache_data(show_spinner=False, max_entries=512)
+@tracciato("qr_png")
+def qr_png(dati, box_size=10, border=1):
+    """PNG del QR code (i link dei video del catalogo tornano in ogni PDF)"""
+    qr = qrcode.QRCode(version=1, box_size=box_size, border=border)
+    qr.add_data(dati)
+    qr.make(fit=True)
+    buffer = io.BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def genera_pdf_in_cache(scheda, nome_paziente, motivo):
+    """PDF già generato oggi (anche da un'altra replica) per gli stessi dati, o generato ora"""
+    impronta = hashlib.sha256(json.dumps(
+        [scheda, nome_paziente, motivo, datetime.now().strftime("%d/%m/%Y")],
+        ensure_ascii=False, sort_keys=True, default=str
+    ).encode("utf-8")).hexdigest()
+    chiave = chiave_condivisa("pdf", impronta)
+    try:
+        salvato = get_cache_condivisa().leggi(chiave)
+        if salvato:
+            return io.BytesIO(salvato)
+    except Exception:
+        pass
+    pdf = genera_pdf(scheda, nome_paziente, motivo)
+    try:
+        get_cache_condivisa().scrivi(chiave, pdf.getvalue(), PDF_CACHE_SECONDI)
+    except Exception:
+        pass
+    return pdf
+
+@tracciato("genera_pdf")
+def genera_pdf(scheda, nome_paziente, motivo):
+    return _componi_pdf(scheda, nome_paziente, motivo)
+
+def _componi_pdf(scheda, nome_paziente, motivo):
+        """Corpo di genera_pdf, senza span: il riscaldamento lo usa senza falsare i tempi del PDF"""
+        buffer = io.BytesIO()
+        doc = SimpleDocTemplate(
+            buffer,
+            pagesize=A4,
+            leftMargin=2*cm,
+            rightMargin=2*cm,
+            topMargin=1.5*cm,
+            bottomMargin=2.5*cm
+        )
+
+        # Stili moderni personalizzati
+        styles = getSampleStyleSheet()
+        
+        # Titolo principale
+        styles.add(ParagraphStyle(
+            name="ModernTitle",
+            fontName="Helvetica-Bold",
+            fontSize=24,
+            textColor=colors.HexColor("#1e3c72"),
+            spaceAfter=12,
+            leading=28
+        ))
+        
+        # Sottotitolo
+        styles.add(ParagraphStyle(
+            name="Subtitle",
+            fontName="Helvetica",
+            fontSize=11,
+            textColor=colors.HexColor("#666666"),
+            spaceAfter=20
+        ))
+        
+        # Titolo esercizio
+        styles.add(ParagraphStyle(
+            name="ExerciseTitle",
+            fontName="Helvetica-Bold",
+            fontSize=14,
+            textColor=colors.HexColor("#1e3c72"),
+            spaceAfter=8,
+            leading=16
+        ))
         
-        email_attuale = paziente_data.get("email", "")
+        # Testo descrizione
+        styles.add(ParagraphStyle(
+            name="Description",
+            fontName="Helvetica",
+            fontSize=10,
+            textColor=colors.HexColor("#333333"),
+            leading=14,
+            spaceAfter=8
+        ))
         
-        if email_attuale:
-            st.success(f"✅ Email configurata: {email_attuale}")
-        else:
-            st.info("📧 Aggiungi la tua email per ricevere promemoria!")
+        # Info esercizio (serie/rip)
+        styles.add(ParagraphStyle(
+            name="ExerciseInfo",
+            fontName="Helvetica-Bold",
+            fontSize=11,
+            textColor=colors.HexColor("#2a5298"),
+            spaceAfter=4
+        ))
         
-        nuova_email = st.text_input(
-            "Email per promemoria",
-            value=email_attuale,
-            placeholder="tuaemail@gmail.com",
-            key="email_setting"
-        )
+        story = []
+
+        # ============ HEADER MODERNO ============
+        logo_path = os.path.join(BASE_DIR, "logo.png")
         
-        if st.button("💾 Salva email", key="save_email"):
-            paziente_data["email"] = nuova_email
-            db[paziente_code] = paziente_data
-            salva_database(db)
-            st.success("✅ Email salvata! Ora riceverai i promemoria dal tuo fisioterapista!")
-            st.rerun()
-    
-    st.divider()
-    # --------------------------------------------------
-    # LISTA ESERCIZI INTERATTIVI
-    # --------------------------------------------------
-    st.subheader("I tuoi esercizi")
-    
-    for idx, ex in enumerate(scheda):
-        # Card container con styling
-        with st.container():
-            st.markdown(f"""
-            <div style='
-                background: white;
-                border-radius: 15px;
-                padding: 1.5rem;
-                margin: 1rem 0;
-                box-shadow: 0 4px 15px rgba(0,0,0,0.1);
-                border-left: 5px solid #2a5298;
-            '>
-                <h3 style='color: #1e3c72; margin-bottom: 1rem;'>{idx+1}. {ex['nome']}</h3>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            col_img, col_info = st.columns([1, 2])
-            
-            with col_img:
-                img_path = trova_immagine(ex['nome'])
-                if img_path and os.path.exists(img_path):
-                    st.image(img_path, width="stretch")
-            
-            with col_info:
-                st.markdown(f"**Descrizione:** {ex['descrizione']}")
-                st.markdown(f"   • Serie: {ex['serie']} | Ripetizioni: {ex['ripetizioni']}")
-                
-                # Badge difficoltà con colori
-                difficolta = ex.get('difficoltà', 'N/A')
-                color = {"Facile": "#4caf50", "Medio": "#ff9800", "Difficile": "#f44336"}.get(difficolta, "#9e9e9e")
-                st.markdown(f"**Difficoltà:** <span style='background:{color};color:white;padding:0.25rem 0.75rem;border-radius:20px;font-weight:600;'>{difficolta}</span>", unsafe_allow_html=True)
-            
-            # Video embedded
-            video_link = ex["link_video"]
+        if os.path.exists(logo_path):
+            logo = Image(logo_path, width=4*cm, height=4*cm, kind="proportional")
             
-            # FIX: Converti YouTube Shorts in link normale
-            if "/shorts/" in video_link:
-                video_id = video_link.split("/shorts/")[1].split("?")[0]
-                video_link = f"https://www.youtube.com/watch?v={video_id}"
+            # Info paziente a destra del logo
+            info_text = f"""
+            <para align="left" spaceBefore="0">
+            <font name="Helvetica-Bold" size="11" color="#1e3c72">PAZIENTE:</font>
+            <font name="Helvetica" size="11" color="#333333"> {nome_paziente}</font><br/>
+            <font name="Helvetica-Bold" size="11" color="#1e3c72">MOTIVO:</font>
+            <font name="Helvetica" size="11" color="#333333"> {motivo}</font><br/>
+            <font name="Helvetica-Bold" size="11" color="#1e3c72">DATA:</font>
+            <font name="Helvetica" size="11" color="#333333"> {datetime.now().strftime("%d/%m/%Y")}</font>
+            </para>
+            """
             
-            if "youtube.com" in video_link or "youtu.be" in video_link:
-                st.video(video_link)
-            else:
-                video_path = os.path.join(VIDEO_DIR, f"{ex['nome']}.mp4")
-                if os.path.exists(video_path):
-                    st.video(video_path)
-                else:
-                    st.info("Video non disponibile")
+            info_box = Paragraph(info_text, styles["Normal"])
             
-            # Sistema contatore con storico date
-            if "storico" not in paziente_data:
-                paziente_data["storico"] = {}
+            header_table = Table(
+                [[logo, info_box]],
+                colWidths=[5*cm, 12*cm],
+                style=[
+                    ("VALIGN", (0,0), (-1,-1), "TOP"),
+                    ("LEFTPADDING", (0,0), (-1,-1), 0),
+                    ("RIGHTPADDING", (0,0), (-1,-1), 0),
+                ]
+            )
+            story.append(header_table)
+        else:
+            # Solo testo se non c'è logo
+            story.append(Paragraph("Programma Esercizi Personalizzato", styles["ModernTitle"]))
+            story.append(Paragraph(f"Paziente: {nome_paziente} | Motivo: {motivo}", styles["Subtitle"]))
+        
+        # Linea separatore sotto header
+        story.append(Spacer(1, 10))
+        separator_line = Table(
+            [[""]],
+            colWidths=[17*cm],
+            style=[
+                ("LINEABOVE", (0,0), (-1,-1), 2, colors.HexColor("#2a5298")),
+                ("TOPPADDING", (0,0), (-1,-1), 0),
+                ("BOTTOMPADDING", (0,0), (-1,-1), 0)
+            ]
+        )
+        story.append(separator_line)
+        story.append(Spacer(1, 20))
+
+        # ============ ESERCIZI CON LAYOUT MODERNO ============
+        for idx, ex in enumerate(scheda):
+            # Numerazione esercizio
+            num_badge = Paragraph(
+                f'<para align="center"><font name="Helvetica-Bold" size="16" color="white">#{idx+1}</font></para>',
+                styles["Normal"]
+            )
             
-            if ex["nome"] not in paziente_data["storico"]:
-                paziente_data["storico"][ex["nome"]] = []
+            # Titolo esercizio
+            titolo = Paragraph(f"<b>{ex['nome']}</b>", styles["ExerciseTitle"])
             
-            storico_esercizio = paziente_data["storico"][ex["nome"]]
-            volte_fatto = len(storico_esercizio)
+            # Descrizione
+            descrizione = Paragraph(ex['descrizione'], styles["Description"])
             
-            # Mostra statistiche
-            col_stat1, col_stat2 = st.columns(2)
-            with col_stat1:
-                st.metric("Volte completato", volte_fatto)
-            with col_stat2:
-                if storico_esercizio:
-                    ultima_volta = storico_esercizio[-1]
-                    st.metric("Ultima volta", ultima_volta)
-                else:
-                    st.metric("Ultima volta", "Mai")
+            # Info serie e ripetizioni con icone
+            info_serie_rip = Paragraph(
+                f"""
+                <para>
+                <font name="Helvetica-Bold" size="10" color="#2a5298">Serie:</font> 
+                <font name="Helvetica-Bold" size="12" color="#1e3c72">{ex['serie']}</font>
+                &nbsp;&nbsp;&nbsp;&nbsp;
+                <font name="Helvetica-Bold" size="10" color="#2a5298">Ripetizioni:</font> 
+                <font name="Helvetica-Bold" size="12" color="#1e3c72">{ex['ripetizioni']}</font>
+                </para>
+                """,
+                styles["Normal"]
+            )
             
-            # Bottone per segnare come fatto OGGI
-            oggi = datetime.now().strftime("%d/%m/%Y")
+            # Difficoltà con badge colorato
+            difficolta = ex.get('difficoltà', 'N/A')
+            color_map = {
+                "Facile": "#4caf50",
+                "Medio": "#ff9800", 
+                "Difficile": "#f44336"
+            }
+            diff_color = color_map.get(difficolta, "#9e9e9e")
             
-            # Check se già fatto oggi
-            gia_fatto_oggi = oggi in storico_esercizio
+            badge_difficolta = Paragraph(
+                f'<para><font name="Helvetica-Bold" size="9" color="white" backColor="{diff_color}"> {difficolta.upper()} </font></para>',
+                styles["Normal"]
+            )
             
-            if gia_fatto_oggi:
-                st.success(f"✅ Già completato oggi ({oggi})! Ben fatto!")
-                
-                if st.button(f"Annulla completamento di oggi", key=f"undo_{paziente_code}_{idx}"):
-                    paziente_data["storico"][ex["nome"]].remove(oggi)
-                    db[paziente_code] = paziente_data
-                    salva_database(db)
-                    st.cache_data.clear()
-                    st.rerun()
+            # Immagine esercizio
+            img_path = trova_immagine(ex['nome'])
+            if img_path and os.path.exists(img_path):
+                esercizio_img = Image(img_path, width=5*cm, height=5*cm, kind="proportional")
             else:
-                if st.button(f"Segna come completato oggi", key=f"done_{paziente_code}_{idx}", type="primary"):
-                    paziente_data["storico"][ex["nome"]].append(oggi)
-                    
-                    if "progressi" not in paziente_data:
-                        paziente_data["progressi"] = {}
-                    paziente_data["progressi"][ex["nome"]] = True
-                    
-                    db[paziente_code] = paziente_data
-                    salva_database(db)
-                    st.cache_data.clear()
-                    st.success("✅ Esercizio completato registrato!")
-                    st.rerun()
-            
-            # Mostra storico completo (ultime 10 date)
-            if volte_fatto > 0:
-                with st.expander(f"📊 Storico completo ({volte_fatto} volte)"):
-                    ultimi_10 = storico_esercizio[-10:][::-1]  # Ultimi 10, dal più recente
-                    for data in ultimi_10:
-                        st.markdown(f"✅ {data}")
-                    if volte_fatto > 10:
-                        st.caption(f"... e altre {volte_fatto - 10} volte")
-            
-            # Note paziente
-            note_key = f"note_{paziente_code}_{ex['nome']}"
-            note_salvate = paziente_data.get("note", {}).get(ex["nome"], "")
-            
-            with st.expander("Aggiungi note personali"):
-                note = st.text_area(
-                    "Note o feedback su questo esercizio",
-                    value=note_salvate,
-                    key=note_key,
-                    height=100
+                # Placeholder se non c'è immagine
+                esercizio_img = Paragraph(
+                    '<para align="center"><font size="40" color="#cccccc">📷</font><br/><font size="8" color="#999999">Immagine<br/>non disponibile</font></para>',
+                    styles["Normal"]
                 )
-                
-                if st.button(f"Salva nota", key=f"save_{note_key}"):
-                    if "note" not in paziente_data:
-                        paziente_data["note"] = {}
-                    paziente_data["note"][ex["nome"]] = note
-                    db[paziente_code] = paziente_data
-                    salva_database(db)
-                    st.success("✓ Nota salvata!")
-            
-            st.divider()
-        
-        # Upload video esecuzione
-        with st.expander("📹 Carica video della tua esecuzione"):
-            st.markdown("""
-            **Carica un video mentre esegui l'esercizio**  
-            Il fisioterapista lo vedrà e potrà darti feedback sulla tua tecnica.
-            """)
-            
-            # Info video caricati
-            if "video_pazienti" not in paziente_data:
-                paziente_data["video_pazienti"] = {}
             
-            if ex["nome"] not in paziente_data["video_pazienti"]:
-                paziente_data["video_pazienti"][ex["nome"]] = []
-            
-            video_list = paziente_data["video_pazienti"][ex["nome"]]
+            # QR Code
+            qr_img = Image(io.BytesIO(qr_png(ex["link_video"])), width=3*cm, height=3*cm)
             
-            # Mostra video già caricati
-            if video_list:
-                st.markdown(f"**Video caricati ({len(video_list)}):**")
-                for vid_idx, video_data in enumerate(video_list):
-                    col_vid_info, col_vid_del = st.columns([4, 1])
-                    with col_vid_info:
-                        st.markdown(f"**{vid_idx + 1}.** Caricato il {video_data['data']} ({video_data.get('size_mb', 'N/A')} MB)")
-                        
-                        # Mostra video se disponibile
-                        if video_data.get('blob_name'):
-                            video_url = get_video_url(video_data['blob_name'])
-                            if video_url:
-                                st.video(video_url)
-                        
-                        if video_data.get('commento'):
-                            st.caption(f"💬 \"{video_data['commento']}\"")
-                        if video_data.get('feedback_fisio'):
-                            st.info(f"**Feedback fisioterapista:** {video_data['feedback_fisio']}")
-                    with col_vid_del:
-                        if st.button("🗑️", key=f"del_vid_{paziente_code}_{ex['nome']}_{vid_idx}"):
-                            # Elimina da cloud
-                            if video_data.get('blob_name'):
-                                delete_video_from_cloud(video_data['blob_name'])
-                            # Elimina da database
-                            paziente_data["video_pazienti"][ex["nome"]].pop(vid_idx)
-                            db[paziente_code] = paziente_data
-                            salva_database(db)
-                            st.rerun()
-                st.divider()
+            # Label QR
+            qr_label = Paragraph(
+                '<para align="center"><font name="Helvetica" size="7" color="#666666">Scansiona per<br/>vedere il video</font></para>',
+                styles["Normal"]
+            )
             
-            # Form upload nuovo video
-            st.markdown("**Carica nuovo video:**")
+            # Colonna sinistra: Badge numero + Info esercizio
+            left_content = [
+                [num_badge],
+                [titolo],
+                [descrizione],
+                [Spacer(1, 8)],
+                [info_serie_rip],
+                [Spacer(1, 4)],
+                [badge_difficolta]
+            ]
             
-            uploaded_file = st.file_uploader(
-                "Seleziona video (MP4, MOV, AVI - max 200MB)",
-                type=['mp4', 'mov', 'avi'],
-                key=f"upload_{paziente_code}_{ex['nome']}"
+            left_table = Table(
+                left_content,
+                colWidths=[9*cm],
+                style=[
+                    ("LEFTPADDING", (0,0), (-1,-1), 0),
+                    ("RIGHTPADDING", (0,0), (-1,-1), 0),
+                    ("TOPPADDING", (0,0), (-1,-1), 2),
+                    ("BOTTOMPADDING", (0,0), (-1,-1), 2),
+                    # Badge colorato
+                    ("BACKGROUND", (0,0), (0,0), colors.HexColor("#2a5298")),
+                    ("ALIGN", (0,0), (0,0), "CENTER"),
+                    ("VALIGN", (0,0), (0,0), "MIDDLE"),
+                    ("TOPPADDING", (0,0), (0,0), 8),
+                    ("BOTTOMPADDING", (0,0), (0,0), 8),
+                ]
             )
             
-            video_commento = st.text_area(
-                "Aggiungi un commento (opzionale)",
-                placeholder="Es: Prima volta che provo, il ginocchio fa ancora male...",
-                key=f"commento_vid_{paziente_code}_{ex['nome']}",
-                height=80
-            )
+            # Colonna destra: Immagine + QR
+            right_content = [
+                [esercizio_img],
+                [Spacer(1, 8)],
+                [qr_img],
+                [qr_label]
+            ]
             
-            if uploaded_file is not None:
-                # Preview video
-                st.video(uploaded_file)
-                
-                # Info dimensione
-                file_size_mb = uploaded_file.size / (1024*1024)
-                if file_size_mb > 200:
-                    st.error("⚠️ File troppo grande! Max 200MB")
-                else:
-                    st.caption(f"Dimensione: {file_size_mb:.2f} MB")
-                
-                if st.button("Carica video", key=f"upload_btn_{paziente_code}_{ex['nome']}", type="primary"):
-                    with st.spinner("Caricamento in corso..."):
-                        # Upload su Cloud Storage
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        cloud_data = upload_video_to_cloud(uploaded_file, paziente_code, ex['nome'], timestamp)
-                        
-                        if cloud_data:
-                            # Salva info video nel database
-                            video_info = {
-                                "nome_file": uploaded_file.name,
-                                "data": datetime.now().strftime("%d/%m/%Y %H:%M"),
-                                "commento": video_commento,
-                                "feedback_fisio": "",
-                                "blob_name": cloud_data['blob_name'],
-                                "size_mb": cloud_data['size_mb']
-                            }
-                            
-                            paziente_data["video_pazienti"][ex["nome"]].append(video_info)
-                            db[paziente_code] = paziente_data
-                            salva_database(db)
-                            
-                            st.success("✓ Video caricato con successo!")
-                            st.info("Il fisioterapista riceverà una notifica e potrà vedere il video.")
-                            st.rerun()
-                        else:
-                            st.error("Errore durante l'upload. Riprova.")
-        
-        st.divider()
-    
-    # Messaggio finale
-    if completati == totale and totale > 0:
-        st.success("Complimenti! Hai completato tutti gli esercizi!")
-
-# --------------------------------------------------
-# MODALITÀ FISIOTERAPISTA (creazione schede)
-# --------------------------------------------------
-else:
-    # Header con logo per fisioterapista
-    logo_path = os.path.join(BASE_DIR, "logo.png")
-    if os.path.exists(logo_path):
-        col_logo, col_title = st.columns([1, 4])
-        with col_logo:
-            st.image(logo_path, width=120)
-        with col_title:
-            st.title("🏥 Riccardo Rispoli - Fisioterapia")
-            st.markdown("**Area Fisioterapista** · Crea schede personalizzate per i tuoi pazienti")
-    else:
-        st.title("🏥 Programma esercizi personalizzato")
-        st.markdown("**Area Fisioterapista** - Crea schede per i tuoi pazienti")
-    
-    st.divider()
-    
-    # --------------------------------------------------
-    # DASHBOARD STATISTICHE
-    # --------------------------------------------------
-    st.subheader("📊 Dashboard Statistiche")
-    
-    db_stats = carica_database()
-    
-    if db_stats:
-        # Calcola metriche
-        totale_pazienti = len(db_stats)
-        
-        # Compliance media
-        compliance_list = []
-        pazienti_inattivi = []
-        video_da_vedere = 0
-        
-        oggi = datetime.now()
-        
-        for codice, data in db_stats.items():
-            # Compliance
-            tot_ex = len(data.get("scheda", []))
-            compl_ex = sum(1 for ex in data.get("scheda", []) if data.get("progressi", {}).get(ex["nome"], False))
-            if tot_ex > 0:
-                compliance_list.append((compl_ex / tot_ex) * 100)
+            right_table = Table(
+                right_content,
+                colWidths=[5*cm],
+                style=[
+                    ("ALIGN", (0,0), (-1,-1), "CENTER"),
+                    ("VALIGN", (0,0), (-1,-1), "TOP"),
+                    ("LEFTPADDING", (0,0), (-1,-1), 0),
+                    ("RIGHTPADDING", (0,0), (-1,-1), 0),
+                ]
+            )
             
-            # Inattività (nessun esercizio negli ultimi 7 giorni)
-            storico = data.get("storico", {})
-            tutte_date = []
-            for date_list in storico.values():
-                tutte_date.extend(date_list)
+            # Card esercizio completa
+            exercise_card = Table(
+                [[left_table, right_table]],
+                colWidths=[9.5*cm, 5.5*cm],
+                style=[
+                    ("BOX", (0,0), (-1,-1), 1.5, colors.HexColor("#2a5298")),
+                    ("BACKGROUND", (0,0), (-1,-1), colors.HexColor("#f8f9fa")),
+                    ("VALIGN", (0,0), (-1,-1), "TOP"),
+                    ("LEFTPADDING", (0,0), (-1,-1), 12),
+                    ("RIGHTPADDING", (0,0), (-1,-1), 12),
+                    ("TOPPADDING", (0,0), (-1,-1), 12),
+                    ("BOTTOMPADDING", (0,0), (-1,-1), 12),
+                ]
+            )
             
-            if tutte_date:
-                date_obj = [datetime.strptime(d, "%d/%m/%Y") for d in tutte_date]
-                ultima_data = max(date_obj)
-                giorni_inattivo = (oggi - ultima_data).days
-                if giorni_inattivo > 7:
-                    pazienti_inattivi.append((data.get('nome', 'N/A'), giorni_inattivo))
-            elif len(tutte_date) == 0 and data.get('data_creazione'):
-                # Mai fatto esercizi
-                pazienti_inattivi.append((data.get('nome', 'N/A'), 999))
+            story.append(KeepTogether([exercise_card]))
+            story.append(Spacer(1, 15))
             
-            # Video da vedere
-            video_pazienti = data.get("video_pazienti", {})
-            for ex_videos in video_pazienti.values():
-                for video in ex_videos:
-                    if not video.get('feedback_fisio'):
-                        video_da_vedere += 1
-        
-        compliance_media = sum(compliance_list) / len(compliance_list) if compliance_list else 0
-        
-        # Mostra metriche
-        col_m1, col_m2, col_m3, col_m4 = st.columns(4)
-        with col_m1:
-            st.metric("👥 Totale pazienti", totale_pazienti)
-        with col_m2:
-            st.metric("📊 Compliance media", f"{compliance_media:.0f}%")
-        with col_m3:
-            st.metric("⚠️ Pazienti inattivi", len(pazienti_inattivi))
-        with col_m4:
-            st.metric("📹 Video da vedere", video_da_vedere)
-        
-        # Pazienti inattivi (se ci sono)
-        if pazienti_inattivi:
-            with st.expander(f"⚠️ Pazienti inattivi ({len(pazienti_inattivi)})"):
-                for nome, giorni in sorted(pazienti_inattivi, key=lambda x: x[1], reverse=True):
-                    if giorni == 999:
-                        st.markdown(f"- **{nome}**: Mai iniziato")
-                    else:
-                        st.markdown(f"- **{nome}**: Inattivo da {giorni} giorni")
-        
-        st.divider()
-    else:
-        st.info("Nessun paziente registrato ancora")
-    
-    st.divider()
-
-    # --------------------------------------------------
-    # GESTIONE PROMEMORIA EMAIL
-    # --------------------------------------------------
-    st.subheader("📧 Gestione Promemoria")
+            # PageBreak ogni 3 esercizi
+            if (idx + 1) % 3 == 0 and idx < len(scheda) - 1:
+                story.append(PageBreak())
 
-    db_promemoria = carica_database()
+        # Build PDF
+        doc.build(
+            story,
+            onFirstPage=draw_background_and_footer,
+            onLaterPages=draw_background_and_footer
+        )
 
-    if db_promemoria:
-        # Separa pazienti con e senza email
-        pazienti_con_email = []
-        pazienti_senza_email = []
-    
-        for codice, data in db_promemoria.items():
-            email = data.get("email", "")
-            nome = data.get("nome", "N/A")
-        
-            # Calcola ultimo accesso (ultima data esercizio)
-            storico = data.get("storico", {})
-            tutte_date = []
-            for date_list in storico.values():
-                tutte_date.extend(date_list)
-        
-            if tutte_date:
-                date_obj = [datetime.strptime(d, "%d/%m/%Y") for d in tutte_date]
-                ultima_data = max(date_obj)
-                giorni_inattivo = (datetime.now() - ultima_data).days
-                ultimo_accesso_str = f"{giorni_inattivo} giorni fa" if giorni_inattivo > 0 else "oggi"
-            else:
-                giorni_inattivo = 999
-                ultimo_accesso_str = "mai"
-        
-            if email:
-                pazienti_con_email.append({
-                    "codice": codice,
-                    "nome": nome,
-                    "email": email,
-                    "giorni_inattivo": giorni_inattivo,
-                    "ultimo_accesso": ultimo_accesso_str
-                })
-            else:
-                pazienti_senza_email.append({
-                    "codice": codice,
-                    "nome": nome
-                })
-    
-        # Mostra pazienti con email
-        if pazienti_con_email:
-            st.markdown("**Pazienti con email configurata:**")
-        
-            # Filtri
-            col_filtro1, col_filtro2 = st.columns(2)
-            with col_filtro1:
-                mostra_tutti = st.checkbox("Mostra tutti", value=False)
-            with col_filtro2:
-                giorni_filtro = st.slider("Inattivi da almeno (giorni)", 0, 30, 2)
-        
-            # Lista pazienti
-            pazienti_selezionati = []
-        
-            for paz in sorted(pazienti_con_email, key=lambda x: x["giorni_inattivo"], reverse=True):
-                # Applica filtro
-                if not mostra_tutti and paz["giorni_inattivo"] < giorni_filtro:
-                    continue
-            
-                # Icona status
-                if paz["giorni_inattivo"] == 0:
-                    icona = "✅"
-                    color = "green"
-                elif paz["giorni_inattivo"] <= 2:
-                    icona = "🟡"
-                    color = "orange"
-                else:
-                    icona = "🔴"
-                    color = "red"
-            
-                # Checkbox per selezione
-                col_check, col_info = st.columns([1, 10])
-                with col_check:
-                    selected = st.checkbox(
-                        "",
-                        key=f"remind_{paz['codice']}",
-                        value=(paz["giorni_inattivo"] >= giorni_filtro)  # Pre-seleziona inattivi
-                    )
-                with col_info:
-                    st.markdown(f"{icona} **{paz['nome']}** - {paz['email']} - *ultimo accesso: {paz['ultimo_accesso']}*")
-            
-                if selected:
-                    pazienti_selezionati.append(paz)
-        
-            st.divider()
-        
-            # Pulsanti azione
-            col_btn1, col_btn2, col_btn3 = st.columns(3)
-        
-            with col_btn1:
-                if st.button(f"📧 Invia promemoria a {len(pazienti_selezionati)} pazienti", type="primary", disabled=len(pazienti_selezionati)==0):
-                    with st.spinner("Invio promemoria in corso..."):
-                        successi = 0
-                        for paz in pazienti_selezionati:
-                            # Recupera link paziente
-                            link_paziente = f"https://schede-pazienti-app.streamlit.app/?p={paz['codice']}"
-                        
-                            # Invia email
-                            if invia_promemoria_paziente(paz["nome"], paz["email"], link_paziente):
-                                successi += 1
-                    
-                        if successi == len(pazienti_selezionati):
-                            st.success(f"✅ {successi} promemoria inviati con successo!")
-                        else:
-                            st.warning(f"⚠️ Inviati {successi}/{len(pazienti_selezionati)} promemoria")
-        
-            with col_btn2:
-                if st.button("Seleziona tutti inattivi"):
-                    st.rerun()
-        
-            with col_btn3:
-                if st.button("Deseleziona tutti"):
-                    st.rerun()
-        
-        else:
-            st.info("Nessun paziente ha configurato l'email ancora")
-    
-        # Mostra pazienti senza email
-        if pazienti_senza_email:
-            with st.expander(f"⚠️ Pazienti SENZA email ({len(pazienti_senza_email)})"):
-                for paz in pazienti_senza_email:
-                    st.markdown(f"- **{paz['nome']}** - Modifica il paziente per aggiungere l'email")
-    
-        st.divider()
-    else:
-        st.info("Nessun paziente registrato")
-    
-    st.divider()
+        buffer.seek(0)
+        return buffer
 
 # --------------------------------------------------
-# INPUT PAZIENTE
+# ROUTING: FISIOTERAPISTA vs PAZIENTE
 # --------------------------------------------------
-col1, col2 = st.columns(2)
+# Supporta sia ?paziente=xxx che p=xxx (più corto per URL installabili)
+query_params = st.query_params
+# Cerca parametro p nell'URL
+paziente_code = st.query_params.get("p")
 
-with col1:
-    nome_paziente = st.text_input("Nome e cognome paziente", placeholder="Mario Rossi")
+@st.cache_resource(show_spinner=False, max_entries=4)
+def _indice_immagini(versione_cartella):
+    """Nome normalizzato -> immagine; ricostruito solo quando la cartella cambia"""
+    indice = {}
+    for file in os.listdir(IMAGE_DIR):
+        file_norm = os.path.splitext(file)[0].strip().lower().replace(" ", "")
+        indice.setdefault(file_norm, os.path.join(IMAGE_DIR, file))
+    return indice
 
-with col2:
-    motivo = st.text_input("🩺 Motivo della visita", placeholder="Lombalgia acuta")
+def trova_immagine(nome_esercizio):
+    nome_norm = nome_esercizio.strip().lower().replace(" ", "")
+    try:
+        versione_cartella = os.stat(IMAGE_DIR).st_mtime_ns
+    except OSError:
+        return None
+    return _indice_immagini(versione_cartella).get(nome_norm)
 
-email_paziente = st.text_input("📧 Email paziente (per promemoria)", placeholder="mario.rossi@gmail.com", help="Opzionale - serve per inviare promemoria automatici")
+def url_video_locale(nome_esercizio):
+    """URL statico del video locale dell'esercizio, o None se non c'è.
 
-st.divider()
+    Il file viene pubblicato (hard link, o copia) in static/videos: il browser lo
+    scarica a pezzi con richieste Range e lo rivalida con ETag, senza passare dal
+    media manager del websocket che terrebbe l'intero MP4 in memoria.
+    """
+    file = f"{nome_esercizio}.mp4"
+    sorgente = os.path.join(VIDEO_DIR, file)
+    if not os.path.exists(sorgente) or not st.get_option("server.enableStaticServing"):
+        return None
+    destinazione = os.path.join(STATIC_DIR, "videos", file)
+    try:
+        info = os.stat(sorgente)
+        pubblicato = os.stat(destinazione) if os.path.exists(destinazione) else None
+        if pubblicato is None or (pubblicato.st_size, pubblicato.st_mtime) != (info.st_size, info.st_mtime):
+            os.makedirs(os.path.dirname(destinazione), exist_ok=True)
+            temporaneo = f"{destinazione}.{uuid.uuid4().hex}.tmp"
+            try:
+                os.link(sorgente, temporaneo)
+            except OSError:
+                shutil.copy2(sorgente, temporaneo)
+            os.replace(temporaneo, destinazione)
+    except OSError:
+        return None
+    return f"{URL_STATIC}/videos/{quote(file)}"
 
 # --------------------------------------------------
-# TEMPLATE SCHEDE
+# MODALITÀ PAZIENTE
 # --------------------------------------------------
-st.subheader("Template Schede")
+# Fragment con i contatori, rieseguiti insieme alla card toccata
+FRAMMENTI_CONTATORI = ["statistiche_paziente", "scheda_completata"]
 
-# Template predefiniti con distretto associato
-TEMPLATES = {
-        "Nessun template (selezione manuale)": {
-            "esercizi": [],
-            "distretto": None
-        },
-        "Lombalgia acuta": {
-            "esercizi": [
-                {"nome": "Ponte glutei", "serie": 3, "ripetizioni": 12},
-                {"nome": "Plank", "serie": 3, "ripetizioni": 30},
-                {"nome": "Respirazione diaframmatica", "serie": 3, "ripetizioni": 10}
-            ],
-            "distretto": "schiena"
-        },
-        "Spalla dolorosa": {
-            "esercizi": [
-                {"nome": "Rotazioni spalla", "serie": 3, "ripetizioni": 10},
-                {"nome": "Elevazioni laterali braccia", "serie": 3, "ripetizioni": 12},
-                {"nome": "Stretching globale", "serie": 2, "ripetizioni": 30}
-            ],
-            "distretto": "spalla"
-        },
-        "Ginocchio post-trauma": {
-            "esercizi": [
-                {"nome": "Squat corpo libero", "serie": 3, "ripetizioni": 10},
-                {"nome": "Affondi", "serie": 3, "ripetizioni": 10},
-                {"nome": "Ponte glutei", "serie": 3, "ripetizioni": 12}
-            ],
-            "distretto": "ginocchio"
-        },
-        "Cervicalgia": {
-            "esercizi": [
-                {"nome": "Stretch laterale collo", "serie": 3, "ripetizioni": 10},
-                {"nome": "Rotazioni cervicali", "serie": 3, "ripetizioni": 5},
-                {"nome": "Respirazione diaframmatica", "serie": 3, "ripetizioni": 10}
-            ],
-            "distretto": "collo"
-        },
-        "Riabilitazione Core": {
-            "esercizi": [
-                {"nome": "Plank", "serie": 3, "ripetizioni": 30},
-                {"nome": "Crunch", "serie": 3, "ripetizioni": 15},
-                {"nome": "Ponte glutei", "serie": 3, "ripetizioni": 12}
-            ],
-            "distretto": "addome"
+def stato_paziente(paziente_code):
+    """Copia di sessione del paziente, condivisa dai fragment della pagina"""
+    return st.session_state[f"stato_paziente_{paziente_code}"]
+
+def registra_azione_paziente(paziente_code, tipo, esercizio="", valore=""):
+    """Evento nel buffer + stessa modifica sulla copia di sessione (niente rilettura del database)"""
+    evento = nuovo_evento(tipo, esercizio, valore)
+    get_buffer_scritture().registra(paziente_code, evento)
+    applica_evento(stato_paziente(paziente_code), evento)
+
+# ---- coda offline della PWA (static/avvio.html) ----
+OFFLINE_GIORNI_MAX = 14  # completamenti offline più vecchi vengono scartati
+ID_EVENTO_RE = re.compile(r"[0-9a-f]{32}")
+
+# Ponte con il browser: salva la scheda per la pagina offline, registra il service
+# worker e rimanda al server i completamenti accodati finché non sono confermati
+JS_SINCRONIZZA_OFFLINE = """
+export default function({ data, setTriggerValue }) {
+    try {
+        localStorage.setItem("rrfisio:codice", data.codice);
+        localStorage.setItem(`rrfisio:scheda:${data.codice}`, JSON.stringify(data.scheda));
+        const chiaveCoda = `rrfisio:coda:${data.codice}`;
+        const confermati = new Set(data.confermati);
+        const coda = JSON.parse(localStorage.getItem(chiaveCoda) || "[]").filter((e) => !confermati.has(e.id));
+        localStorage.setItem(chiaveCoda, JSON.stringify(coda));
+        // Un reinvio ogni 10 secondi al massimo finché il server non conferma
+        const inviati = window.__rrfisioInviati = window.__rrfisioInviati || new Map();
+        const daInviare = coda.filter((e) => !(Date.now() - (inviati.get(e.id) || 0) < 10000));
+        if (daInviare.length) {
+            daInviare.forEach((e) => inviati.set(e.id, Date.now()));
+            setTriggerValue("eventi", daInviare);
         }
+    } catch (e) {
+        // localStorage non disponibile (es. navigazione privata): niente modalità offline
+    }
+    if ("serviceWorker" in navigator) {
+        navigator.serviceWorker.register(data.service_worker, { scope: data.scope }).catch(() => {});
+    }
 }
+"""
+sincronizza_offline = st.components.v2.component("sincronizza_offline", js=JS_SINCRONIZZA_OFFLINE)
 
-# Selectbox template
-template_scelto = st.selectbox(
-        "Scegli un template o seleziona manualmente",
-        list(TEMPLATES.keys())
-)
-
-# Estrai dati template
-template_data = TEMPLATES[template_scelto]
-esercizi_template = template_data["esercizi"]
-distretto_suggerito = template_data["distretto"]
+def eventi_offline_validi(paziente, eventi):
+    """Solo completamenti di esercizi della scheda, con id e data plausibili"""
+    esercizi = {ex["nome"] for ex in paziente["scheda"]}
+    oggi = datetime.now().date()
+    validi = []
+    for evento in eventi if isinstance(eventi, list) else []:
+        if not isinstance(evento, dict) or evento.get("tipo") != "completamento":
+            continue
+        if not ID_EVENTO_RE.fullmatch(str(evento.get("id", ""))) or evento.get("esercizio") not in esercizi:
+            continue
+        try:
+            giorno = datetime.strptime(str(evento.get("valore", "")), "%d/%m/%Y").date()
+        except ValueError:
+            continue
+        if not oggi - timedelta(days=OFFLINE_GIORNI_MAX) <= giorno <= oggi + timedelta(days=1):
+            continue
+        validi.append(dict(nuovo_evento("completamento", evento["esercizio"], evento["valore"]), id=evento["id"]))
+    return validi
 
-if esercizi_template:
-        st.success(f"✅ Template '{template_scelto}' caricato! Distretto auto-selezionato: **{distretto_suggerito}**")
-        
-        # Mostra preview template
-        with st.expander("👁️ Preview esercizi del template"):
-            for ex in esercizi_template:
-                st.markdown(f"- **{ex['nome']}**: {ex['serie']} serie x {ex['ripetizioni']} rip")
+def applica_coda_offline(paziente_code, eventi):
+    """Applica i completamenti arrivati dalla coda offline; ritorna gli id da togliere dalla coda.
 
-st.divider()
+    Idempotente: l'id è generato dal browser, quindi un evento reinviato viene
+    scartato dal buffer e, se già scritto, ignorato alla lettura del log.
+    """
+    paziente = stato_paziente(paziente_code)
+    for evento in eventi_offline_validi(paziente, eventi):
+        if get_buffer_scritture().registra(paziente_code, evento):
+            applica_evento(paziente, evento)
+    # Anche gli eventi scartati vengono confermati: non ha senso reinviarli
+    return [str(evento.get("id")) for evento in eventi if isinstance(evento, dict)]
 
-# --------------------------------------------------
-# SELEZIONE ESERCIZI
-# --------------------------------------------------
+def mostra_sincronizzazione_offline(paziente_code):
+    """Monta il ponte con il browser; se arrivano eventi offline li applica e ridisegna la pagina"""
+    chiave_confermati = f"offline_confermati_{paziente_code}"
+    paziente = stato_paziente(paziente_code)
+    risultato = sincronizza_offline(
+        key=f"sincronizza_offline_{paziente_code}",
+        data={
+            "codice": paziente_code,
+            "scheda": [
+                {
+                    "nome": ex["nome"],
+                    "serie": ex.get("serie", ""),
+                    "ripetizioni": ex.get("ripetizioni", ""),
+                    "storico": list(paziente.get("storico", {}).get(ex["nome"], ())),
+                }
+                for ex in paziente["scheda"]
+            ],
+            "confermati": st.session_state.get(chiave_confermati, []),
+            "service_worker": f"{URL_STATIC}/sw.js",
+            "scope": f"{URL_STATIC}/",
+        },
+        on_eventi_change=lambda: None,
+    )
+    if risultato.eventi:
+        confermati = applica_coda_offline(paziente_code, risultato.eventi)
+        st.session_state[chiave_confermati] = (st.session_state.get(chiave_confermati, []) + confermati)[-500:]
+        st.rerun()
 
-# Auto-selezione distretto basata sul template
-distretti_disponibili = sorted(df["distretto"].unique())
+def _azione_e_aggiorna(paziente_code, tipo, esercizio, valore, frammenti):
+    """Callback dei bottoni: registra l'azione e riesegue solo i fragment indicati"""
+    registra_azione_paziente(paziente_code, tipo, esercizio, valore)
+    st.rerun(frammenti)
 
-if distretto_suggerito and distretto_suggerito in distretti_disponibili:
-        # Pre-seleziona il distretto del template
-        index_distretto = distretti_disponibili.index(distretto_suggerito)
-else:
-        # Default: primo distretto
-        index_distretto = 0
+@st.fragment(key="statistiche_paziente")
+def mostra_statistiche_paziente(paziente_code):
+    """Contatori in testa alla pagina"""
+    paziente = stato_paziente(paziente_code)
+    progressi_paziente = paziente.get("progressi", {})
+    scheda = paziente["scheda"]
+    totale = len(scheda)
+    completati = sum(1 for ex in scheda if progressi_paziente.get(ex["nome"], False))
+    
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Totale esercizi", totale)
+    with col2:
+        st.metric("Completati", completati)
+    with col3:
+        progresso = int((completati / totale) * 100) if totale > 0 else 0
+        st.metric("Progresso", f"{progresso}%")
+    
+    st.progress(progresso / 100)
 
-distretto = st.selectbox(
-        "Seleziona distretto",
-        distretti_disponibili,
-        index=index_distretto
-)
+@st.fragment(key="scheda_completata")
+def mostra_scheda_completata(paziente_code):
+    """Messaggio finale quando tutti gli esercizi sono completati"""
+    paziente = stato_paziente(paziente_code)
+    scheda = paziente["scheda"]
+    completati = sum(1 for ex in scheda if paziente.get("progressi", {}).get(ex["nome"], False))
+    if completati == len(scheda) and len(scheda) > 0:
+        st.success("Complimenti! Hai completato tutti gli esercizi!")
 
-# Mostra esercizi del distretto selezionato + esercizi "generale"
-df_distretto = df[(df["distretto"] == distretto) | (df["distretto"] == "generale")]
+def mostra_video_esercizio(idx, ex):
+    """Anteprima del video; il player (iframe YouTube o file locale) solo dopo il click"""
+    chiave = f"video_aperto_{idx}"
+    if ex.get("video_embed"):
+        # Normalizzato al caricamento del catalogo e salvato nella scheda
+        video = (None, ex["video_embed"], ex.get("video_anteprima", ""))
+    else:
+        # Schede create prima che la scheda salvasse i link normalizzati
+        video = normalizza_video(ex.get("link_video", ""))
+    video_path = os.path.join(VIDEO_DIR, f"{ex['nome']}.mp4")
+    if not video and not os.path.exists(video_path):
+        st.info("Video non disponibile")
+        return
+    
+    if not st.session_state.get(chiave):
+        if video and video[2]:
+            st.image(video[2], width="stretch")
+        if st.button("▶️ Guarda il video", key=f"apri_video_{idx}"):
+            st.session_state[chiave] = True
+        else:
+            return
+    
+    if video:
+        st.video(video[1])
+    else:
+        # Senza static serving attivo si ricade sul media manager di Streamlit
+        st.video(url_video_locale(ex["nome"]) or video_path)
 
-# Se ha scelto un template, pre-seleziona SOLO gli esercizi disponibili nel distretto
-if esercizi_template:
-        # Filtra solo esercizi che esistono nel distretto selezionato
-        esercizi_disponibili = df_distretto["nome"].tolist()
-        esercizi_template_nomi = [ex["nome"] for ex in esercizi_template if ex["nome"] in esercizi_disponibili]
+def mostra_card_esercizio(paziente_code, idx, ex):
+    """Card di un esercizio: eseguita come fragment, un click riesegue solo questa card"""
+    paziente = stato_paziente(paziente_code)
+    
+    # Card container con styling
+    with st.container():
+        st.markdown(f"""
+        <div style='
+            background: white;
+            border-radius: 15px;
+            padding: 1.5rem;
+            margin: 1rem 0;
+            box-shadow: 0 4px 15px rgba(0,0,0,0.1);
+            border-left: 5px solid #2a5298;
+        '>
+            <h3 style='color: #1e3c72; margin-bottom: 1rem;'>{idx+1}. {ex['nome']}</h3>
+        </div>
+        """, unsafe_allow_html=True)
         
-        if esercizi_template_nomi:
-            st.info(f"[INFO] {len(esercizi_template_nomi)} esercizi del template trovati nel distretto '{distretto}'")
+        col_img, col_info = st.columns([1, 2])
         
-        # Mostra warning se alcuni esercizi del template non sono disponibili
-        esercizi_mancanti = [ex["nome"] for ex in esercizi_template if ex["nome"] not in esercizi_disponibili]
-        if esercizi_mancanti:
-            st.warning(f"[!] Alcuni esercizi del template non sono in questo distretto: {', '.join(esercizi_mancanti)}")
-else:
-        esercizi_template_nomi = []
-
-esercizi_scelti = st.multiselect(
-        "Seleziona esercizi",
-        df_distretto["nome"].tolist(),
-        default=esercizi_template_nomi
-)
-
-scheda = []
-for nome in esercizi_scelti:
-        row = df_distretto[df_distretto["nome"] == nome].iloc[0]
+        with col_img:
+            img_path = url_asset(chiave_esercizio(ex['nome'])) or trova_immagine(ex['nome'])
+            if img_path:
+                st.image(img_path, width="stretch")
+        
+        with col_info:
+            st.markdown(f"**Descrizione:** {ex['descrizione']}")
+            st.markdown(f"   • Serie: {ex['serie']} | Ripetizioni: {ex['ripetizioni']}")
+            
+            # Badge difficoltà con colori
+            difficolta = ex.get('difficoltà', 'N/A')
+            color = {"Facile": "#4caf50", "Medio": "#ff9800", "Difficile": "#f44336"}.get(difficolta, "#9e9e9e")
+            st.markdown(f"**Difficoltà:** <span style='background:{color};color:white;padding:0.25rem 0.75rem;border-radius:20px;font-weight:600;'>{difficolta}</span>", unsafe_allow_html=True)
+        
+        # Video: anteprima leggera, il player si carica solo quando il paziente lo apre
+        mostra_video_esercizio(idx, ex)
+        
+        # Sistema contatore con storico date
+        storico_esercizio = paziente.get("storico", {}).get(ex["nome"], ())
+        volte_fatto = len(storico_esercizio)
+        
+        # Mostra statistiche
+        col_stat1, col_stat2 = st.columns(2)
+        with col_stat1:
+            st.metric("Volte completato", volte_fatto)
+        with col_stat2:
+            if storico_esercizio:
+                ultima_volta = storico_esercizio[-1]
+                st.metric("Ultima volta", ultima_volta)
+            else:
+                st.metric("Ultima volta", "Mai")
+        
+        # Bottone per segnare come fatto OGGI
+        oggi = datetime.now().strftime("%d/%m/%Y")
         
-        # Cerca se questo esercizio è nel template per usare i suoi valori
-        template_ex = next((ex for ex in esercizi_template if ex["nome"] == nome), None)
+        # Check se già fatto oggi
+        gia_fatto_oggi = oggi in storico_esercizio
         
-        if template_ex:
-            # Usa valori del template
-            default_serie = template_ex["serie"]
-            default_rip = template_ex["ripetizioni"]
+        if gia_fatto_oggi:
+            st.success(f"✅ Già completato oggi ({oggi})! Ben fatto!")
+            
+            st.button(
+                f"Annulla completamento di oggi",
+                key=f"undo_{paziente_code}_{idx}",
+                on_click=_azione_e_aggiorna,
+                args=(paziente_code, "annulla_completamento", ex["nome"], oggi, [f"esercizio_{idx}"] + FRAMMENTI_CONTATORI)
+            )
         else:
-            # Gestione sicura di serie e ripetizioni (possono essere vuote nel CSV)
-            try:
-                default_serie = int(row.get("serie", 3)) if row.get("serie") and str(row.get("serie")).strip() else 3
-            except (ValueError, TypeError):
-                default_serie = 3
+            # Salvataggio differito: il buffer scrive tutto insieme dopo pochi secondi
+            st.button(
+                f"Segna come completato oggi",
+                key=f"done_{paziente_code}_{idx}",
+                type="primary",
+                on_click=_azione_e_aggiorna,
+                args=(paziente_code, "completamento", ex["nome"], oggi, [f"esercizio_{idx}"] + FRAMMENTI_CONTATORI)
+            )
+        
+        # Mostra storico completo (ultime 10 date)
+        if volte_fatto > 0:
+            with st.expander(f"📊 Storico completo ({volte_fatto} volte)"):
+                ultimi_10 = storico_esercizio[-10:][::-1]  # Ultimi 10, dal più recente
+                for data in ultimi_10:
+                    st.markdown(f"✅ {data}")
+                if volte_fatto > 10:
+                    st.caption(f"... e altre {volte_fatto - 10} volte")
+        
+        # Note paziente
+        note_key = f"note_{paziente_code}_{ex['nome']}"
+        note_salvate = paziente.get("note", {}).get(ex["nome"], "")
+        
+        with st.expander("Aggiungi note personali"):
+            note = st.text_area(
+                "Note o feedback su questo esercizio",
+                value=note_salvate,
+                key=note_key,
+                height=100
+            )
             
-            try:
-                default_rip = int(row.get("ripetizioni", 10)) if row.get("ripetizioni") and str(row.get("ripetizioni")).strip() else 10
-            except (ValueError, TypeError):
-                default_rip = 10
-        
-        c1, c2 = st.columns(2)
-        with c1:
-            serie = st.number_input(f"Serie – {nome}", 1, 10, default_serie, key=f"serie_{nome}")
-        with c2:
-            rip = st.number_input(f"Ripetizioni – {nome}", 1, 30, default_rip, key=f"rip_{nome}")
-        
-        scheda.append({
-            "nome": row["nome"],
-            "descrizione": row["descrizione"],
-            "link_video": row["link_video"],
-            "difficoltà": row.get("difficoltà", ""),
-            "distretto": row["distretto"],
-            "serie": serie,
-            "ripetizioni": rip
-        })
-
-st.divider()
-
-# --------------------------------------------------
-# GENERA PDF MODERNO
-# --------------------------------------------------
-def draw_background_and_footer(canvas, doc):
-        """Disegna sfondo e footer con design moderno"""
-        # Sfondo bianco pulito (opzionale: sfondo.png se presente)
-        bg_path = os.path.join(BASE_DIR, "background.png")
-        if os.path.exists(bg_path):
-            canvas.drawImage(bg_path, 0, 0, width=A4[0], height=A4[1], preserveAspectRatio=True, mask='auto')
+            if st.button(f"Salva nota", key=f"save_{note_key}"):
+                registra_azione_paziente(paziente_code, "nota", ex["nome"], note)
+                st.success("✓ Nota salvata!")
         
-        # Footer moderno
-        canvas.saveState()
-        canvas.setFont("Helvetica", 8)
-        canvas.setFillColorRGB(0.4, 0.4, 0.4)
+        st.divider()
+    
+    # Upload video esecuzione
+    with st.expander("📹 Carica video della tua esecuzione"):
+        st.markdown("""
+        **Carica un video mentre esegui l'esercizio**  
+        Il fisioterapista lo vedrà e potrà darti feedback sulla tua tecnica.
+        """)
         
-        # Linea separatore footer
-        canvas.setStrokeColorRGB(0.12, 0.24, 0.45)  # Blu brand
-        canvas.setLineWidth(1)
-        canvas.line(2*cm, 1.8*cm, A4[0]-2*cm, 1.8*cm)
+        # Info video caricati
+        video_list = paziente.get("video_pazienti", {}).get(ex["nome"], ())
         
-        # Testo footer
-        canvas.drawCentredString(A4[0]/2, 1.3*cm, "Riccardo Rispoli – Fisioterapista OMPT")
-        canvas.setFont("Helvetica", 7)
-        canvas.drawCentredString(A4[0]/2, 1.0*cm, "📧 riccardo.rspl@gmail.com  •  📱 +39 3313552300")
+        # Mostra video già caricati
+        if video_list:
+            st.markdown(f"**Video caricati ({len(video_list)}):**")
+            url_video = get_video_urls(video_data.get('blob_name') for video_data in video_list)
+            for vid_idx, video_data in enumerate(video_list):
+                col_vid_info, col_vid_del = st.columns([4, 1])
+                with col_vid_info:
+                    st.markdown(f"**{vid_idx + 1}.** Caricato il {video_data['data']} ({video_data.get('size_mb', 'N/A')} MB)")
+                    
+                    # Mostra video se disponibile
+                    if video_data.get('blob_name'):
+                        video_url = url_video.get(video_data['blob_name'])
+                        if video_url:
+                            st.video(video_url)
+                    
+                    if video_data.get('commento'):
+                        st.caption(f"💬 \"{video_data['commento']}\"")
+                    if video_data.get('feedback_fisio'):
+                        st.info(f"**Feedback fisioterapista:** {video_data['feedback_fisio']}")
+                with col_vid_del:
+                    if st.button("🗑️", key=f"del_vid_{paziente_code}_{ex['nome']}_{vid_idx}"):
+                        # Elimina da cloud (se non è collegato anche a un altro esercizio)
+                        if video_data.get('blob_name') and not blob_usato_altrove(paziente, video_data['blob_name'], ex["nome"]):
+                            delete_video_from_cloud(video_data['blob_name'])
+                        # Elimina da database
+                        registra_azione_paziente(paziente_code, "video_rimosso", ex["nome"], video_data.get('blob_name', ''))
+                        st.rerun(scope="fragment")
+            st.divider()
         
-        # Numero pagina
-        canvas.setFont("Helvetica-Bold", 8)
-        page_num = canvas.getPageNumber()
-        canvas.drawRightString(A4[0]-2*cm, 1.3*cm, f"Pagina {page_num}")
+        # Form upload nuovo video
+        st.markdown("**Carica nuovo video:**")
+        chiave_esito = f"esito_upload_{paziente_code}_{ex['nome']}"
+        esito_upload = st.session_state.pop(chiave_esito, None)
+        if esito_upload:
+            st.success(esito_upload)
+            st.info("Il fisioterapista riceverà una notifica e potrà vedere il video.")
         
-        canvas.restoreState()
-
-def genera_pdf(scheda):
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(
-            buffer,
-            pagesize=A4,
-            leftMargin=2*cm,
-            rightMargin=2*cm,
-            topMargin=1.5*cm,
-            bottomMargin=2.5*cm
+        uploaded_file = st.file_uploader(
+            "Seleziona video (MP4, MOV, AVI - max 200MB)",
+            type=['mp4', 'mov', 'avi'],
+            key=f"upload_{paziente_code}_{ex['nome']}"
         )
+        
+        video_commento = st.text_area(
+            "Aggiungi un commento (opzionale)",
+            placeholder="Es: Prima volta che provo, il ginocchio fa ancora male...",
+            key=f"commento_vid_{paziente_code}_{ex['nome']}",
+            height=80
+        )
+        
+        if uploaded_file is not None:
+            # Preview video
+            st.video(uploaded_file)
+            
+            # Info dimensione
+            file_size_mb = uploaded_file.size / (1024*1024)
+            if file_size_mb > 200:
+                st.error("⚠️ File troppo grande! Max 200MB")
+            else:
+                st.caption(f"Dimensione: {file_size_mb:.2f} MB")
+            
+            if st.button("Carica video", key=f"upload_btn_{paziente_code}_{ex['nome']}", type="primary"):
+                with st.spinner("Caricamento in corso..."):
+                    # Impronta del contenuto prima del trasferimento: un video già caricato non si ricarica
+                    impronta = impronta_video(uploaded_file)
+                    esistente = video_con_impronta(paziente, impronta)
+                    if esistente is not None and esistente[0] == ex["nome"]:
+                        cloud_data = {"gia_presente": True}
+                    elif esistente is not None:
+                        # Già caricato per un altro esercizio: si collega lo stesso file
+                        cloud_data = {
+                            "blob_name": esistente[1]["blob_name"],
+                            "sha256": impronta,
+                            "size_mb": esistente[1].get("size_mb"),
+                            "riusato": True
+                        }
+                    else:
+                        # Upload su Cloud Storage
+                        cloud_data = upload_video_to_cloud(uploaded_file, paziente_code, impronta)
+                    
+                    if cloud_data and cloud_data.get("gia_presente"):
+                        st.info(f"Questo video è già stato caricato il {esistente[1]['data']}: nessun nuovo upload.")
+                    elif cloud_data:
+                        # Salva info video nel database
+                        video_info = {
+                            "nome_file": uploaded_file.name,
+                            "data": datetime.now().strftime("%d/%m/%Y %H:%M"),
+                            "commento": video_commento,
+                            "feedback_fisio": "",
+                            "blob_name": cloud_data['blob_name'],
+                            "size_mb": cloud_data['size_mb'],
+                            "sha256": cloud_data['sha256']
+                        }
+                        
+                        registra_azione_paziente(paziente_code, "video_aggiunto", ex["nome"], video_info)
+                        
+                        # Esito mostrato dopo il rerun del fragment
+                        st.session_state[chiave_esito] = (
+                            "✓ Video già presente: collegato senza caricarlo di nuovo!" if cloud_data["riusato"]
+                            else "✓ Video caricato con successo!"
+                        )
+                        st.rerun(scope="fragment")
+                    else:
+                        st.error("Errore durante l'upload. Riprova.")
+    
+    st.divider()
 
-        # Stili moderni personalizzati
-        styles = getSampleStyleSheet()
+def mostra_area_paziente(paziente_code):
+    """Pagina del paziente: legge e modifica solo i dati di quel paziente"""
+    try:
+        esito = verifica_codice_paziente(paziente_code)
+    except Exception as e:
+        st.error(f"❌ Errore caricamento paziente: {e}")
+        st.stop()
+    if esito == "troppi_tentativi":
+        st.error("⏳ Troppi tentativi con codici diversi: riprova tra qualche istante.")
+        st.stop()
+    
+    paziente_data = carica_paziente(paziente_code) if esito == "ok" else None
+    
+    if paziente_data is None:
+        st.error("❌ Codice paziente non valido!")
+        st.warning("Controlla il link ricevuto dal fisioterapista o scansiona di nuovo il QR code.")
+        st.stop()
+    
+    # Copia di sessione modificabile: i fragment la aggiornano senza ricaricare il database
+    st.session_state[f"stato_paziente_{paziente_code}"] = scongela(paziente_data)
+    
+    # Salva codice e scheda nel browser (avvio rapido e modalità offline) e
+    # sincronizza i completamenti segnati offline
+    mostra_sincronizzazione_offline(paziente_code)
+    
+    # Header con logo
+    logo_path = os.path.join(BASE_DIR, "logo.png")
+    if os.path.exists(logo_path):
+        col_logo, col_title = st.columns([1, 3])
+        with col_logo:
+            st.image(url_asset("logo", logo_path), width=150)
+        with col_title:
+            st.title(f"Benvenuto, {paziente_data['nome']}!")
+            st.markdown(f"**Motivo visita:** {paziente_data['motivo']}")
+            st.markdown(f"**Data scheda:** {paziente_data['data_creazione']}")
+    else:
+        st.title(f"Benvenuto, {paziente_data['nome']}!")
+        st.markdown(f"**Motivo visita:** {paziente_data['motivo']}")
+        st.markdown(f"**Data scheda:** {paziente_data['data_creazione']}")
+    st.divider()
+    
+    # Banner installazione app
+    st.info("""
+    [SUGGERIMENTO]: Aggiungi questa pagina alla Home del tuo telefono per un accesso più rapido!
+    
+    • **iPhone**: Safari → Condividi → "Aggiungi a Home"  
+    • **Android**: Chrome → Menu (⋮) → "Installa app"
+    """)
+    
+    # Statistiche (fragment: si aggiornano insieme alla card toccata)
+    scheda = paziente_data["scheda"]
+    mostra_statistiche_paziente(paziente_code)
+    st.divider()
+    
+    # --------------------------------------------------
+    # GRAFICI E ANALISI
+    # --------------------------------------------------
+    st.subheader("I tuoi progressi")
+    
+    # Raccolta dati per i grafici
+    storico_data = paziente_data.get("storico", {})
+    
+    # Calcola tutte le date uniche e conta esercizi per data
+    date_conteggio = {}
+    tutte_date = []
+    
+    for esercizio_nome, date_list in storico_data.items():
+        for data in date_list:
+            tutte_date.append(data)
+            if data in date_conteggio:
+                date_conteggio[data] += 1
+            else:
+                date_conteggio[data] = 1
+    
+    # Ordina le date
+    if tutte_date:
+        tutte_date_uniche = sorted(list(set(tutte_date)), key=lambda x: datetime.strptime(x, "%d/%m/%Y"))
+    else:
+        tutte_date_uniche = []
+    
+    # Calcola streak (giorni consecutivi)
+    def calcola_streak(date_list):
+        if not date_list:
+            return 0
         
-        # Titolo principale
-        styles.add(ParagraphStyle(
-            name="ModernTitle",
-            fontName="Helvetica-Bold",
-            fontSize=24,
-            textColor=colors.HexColor("#1e3c72"),
-            spaceAfter=12,
-            leading=28
-        ))
+        date_obj = [datetime.strptime(d, "%d/%m/%Y") for d in date_list]
+        date_obj_sorted = sorted(date_obj, reverse=True)
         
-        # Sottotitolo
-        styles.add(ParagraphStyle(
-            name="Subtitle",
-            fontName="Helvetica",
-            fontSize=11,
-            textColor=colors.HexColor("#666666"),
-            spaceAfter=20
-        ))
+        streak = 1
+        oggi = datetime.now()
+        
+        # Check se l'ultima data è oggi o ieri
+        ultima = date_obj_sorted[0]
+        diff_giorni = (oggi - ultima).days
+        
+        if diff_giorni > 1:
+            return 0  # Streak interrotto
+        
+        # Conta giorni consecutivi
+        for i in range(len(date_obj_sorted) - 1):
+            diff = (date_obj_sorted[i] - date_obj_sorted[i + 1]).days
+            if diff == 1:
+                streak += 1
+            else:
+                break
+        
+        return streak
+    
+    streak_attuale = calcola_streak(tutte_date_uniche)
+    
+    # Mostra streak con badge
+    if streak_attuale > 0:
+        st.success(f"🔥 **Streak attuale: {streak_attuale} {'giorno' if streak_attuale == 1 else 'giorni'} consecutivi!** Continua così! 💪")
+    else:
+        st.info("[INFO] Inizia il tuo streak completando un esercizio oggi!")
+    
+    # Bottone Report PDF
+    st.markdown("---")
+    if st.button("📄 Genera Report Progresso", type="secondary", width="stretch"):
+        with st.spinner("Generazione report in corso..."):
+            report_pdf = genera_report_progresso(paziente_data, paziente_code)
+            st.download_button(
+                "⬇️ Scarica Report PDF",
+                report_pdf,
+                file_name=f"Report_{paziente_data['nome'].replace(' ', '_')}.pdf",
+                mime="application/pdf",
+                width="stretch"
+            )
+    st.markdown("---")
+    
+    # TAB per diversi grafici
+    tab1, tab2 = st.tabs(["📈 Andamento allenamenti", "📊 Dettaglio esercizi"])
+    
+    with tab1:
+        if tutte_date_uniche:
+            # Grafico a linee - Esercizi per giorno
+            # Prepara dati per il grafico
+            date_per_grafico = []
+            conteggio_per_grafico = []
+            
+            for data in tutte_date_uniche:
+                date_per_grafico.append(data)
+                conteggio_per_grafico.append(date_conteggio[data])
+            
+            df_grafico = pd.DataFrame({
+                "Data": date_per_grafico,
+                "Esercizi completati": conteggio_per_grafico
+            })
+            
+            st.line_chart(df_grafico.set_index("Data"), height=300)
+            
+            # Statistiche aggiuntive
+            col_stat1, col_stat2, col_stat3 = st.columns(3)
+            with col_stat1:
+                st.metric("Giorni totali allenamento", len(tutte_date_uniche))
+            with col_stat2:
+                media_esercizi = sum(conteggio_per_grafico) / len(conteggio_per_grafico)
+                st.metric("Media esercizi/giorno", f"{media_esercizi:.1f}")
+            with col_stat3:
+                st.metric("Totale ripetizioni", sum(conteggio_per_grafico))
+        else:
+            st.info("📈 Il grafico apparirà quando inizierai a completare gli esercizi!")
+    
+    with tab2:
+        # Grafico a barre - Completamento per esercizio
+        if storico_data:
+            st.markdown("**Quante volte hai fatto ogni esercizio:**")
+            
+            for esercizio in scheda:
+                nome = esercizio["nome"]
+                volte = len(storico_data.get(nome, []))
+                
+                # Barra di progresso personalizzata
+                col_nome, col_barra, col_num = st.columns([3, 5, 1])
+                with col_nome:
+                    st.markdown(f"**{nome}**")
+                with col_barra:
+                    # Calcola percentuale rispetto al massimo
+                    max_volte = max([len(v) for v in storico_data.values()]) if storico_data else 1
+                    percentuale = (volte / max_volte) if max_volte > 0 else 0
+                    st.progress(percentuale)
+                with col_num:
+                    st.markdown(f"**{volte}x**")
+        else:
+            st.info("📊 I dettagli appariranno quando completi gli esercizi!")
+    
+    st.divider()
+
+    st.divider()
+    
+    # --------------------------------------------------
+    # IMPOSTAZIONI PAZIENTE
+    # --------------------------------------------------
+    with st.expander("⚙️ Impostazioni"):
+        st.markdown("**Configurazione promemoria**")
         
-        # Titolo esercizio
-        styles.add(ParagraphStyle(
-            name="ExerciseTitle",
-            fontName="Helvetica-Bold",
-            fontSize=14,
-            textColor=colors.HexColor("#1e3c72"),
-            spaceAfter=8,
-            leading=16
-        ))
+        email_attuale = paziente_data.get("email", "")
         
-        # Testo descrizione
-        styles.add(ParagraphStyle(
-            name="Description",
-            fontName="Helvetica",
-            fontSize=10,
-            textColor=colors.HexColor("#333333"),
-            leading=14,
-            spaceAfter=8
-        ))
+        if email_attuale:
+            st.success(f"✅ Email configurata: {email_attuale}")
+        else:
+            st.info("📧 Aggiungi la tua email per ricevere promemoria!")
         
-        # Info esercizio (serie/rip)
-        styles.add(ParagraphStyle(
-            name="ExerciseInfo",
-            fontName="Helvetica-Bold",
-            fontSize=11,
-            textColor=colors.HexColor("#2a5298"),
-            spaceAfter=4
-        ))
+        nuova_email = st.text_input(
+            "Email per promemoria",
+            value=email_attuale,
+            placeholder="tuaemail@gmail.com",
+            key="email_setting"
+        )
         
-        story = []
+        if st.button("💾 Salva email", key="save_email"):
+            get_buffer_scritture().registra(paziente_code, nuovo_evento("email", valore=nuova_email))
+            st.success("✅ Email salvata! Ora riceverai i promemoria dal tuo fisioterapista!")
+            st.rerun()
+    
+    st.divider()
+    # --------------------------------------------------
+    # LISTA ESERCIZI INTERATTIVI
+    # --------------------------------------------------
+    st.subheader("I tuoi esercizi")
+    
+    for idx, ex in enumerate(scheda):
+        st.fragment(mostra_card_esercizio, key=f"esercizio_{idx}")(paziente_code, idx, ex)
+    
+    # Messaggio finale
+    mostra_scheda_completata(paziente_code)
 
-        # ============ HEADER MODERNO ============
-        logo_path = os.path.join(BASE_DIR, "logo.png")
+# --------------------------------------------------
+# MODALITÀ FISIOTERAPISTA (creazione schede)
+# --------------------------------------------------
+def mostra_area_fisioterapista():
+    """Area fisioterapista: dashboard, creazione schede e gestione pazienti"""
+    # Header con logo per fisioterapista
+    logo_path = os.path.join(BASE_DIR, "logo.png")
+    if os.path.exists(logo_path):
+        col_logo, col_title = st.columns([1, 4])
+        with col_logo:
+            st.image(url_asset("logo", logo_path), width=120)
+        with col_title:
+            st.title("🏥 Riccardo Rispoli - Fisioterapia")
+            st.markdown("**Area Fisioterapista** · Crea schede personalizzate per i tuoi pazienti")
+            if not cache_pronte():
+                st.caption("⏳ Avvio in corso: i primi caricamenti possono essere più lenti")
+    else:
+        st.title("🏥 Programma esercizi personalizzato")
+        st.markdown("**Area Fisioterapista** - Crea schede per i tuoi pazienti")
+    
+    st.divider()
+    
+    if is_admin():
+        mostra_pannello_admin()
+
+    # Statistiche e promemoria leggono la stessa proiezione
+    db_riepilogo = carica_riepilogo(CAMPI_FISIOTERAPISTA)
+    
+    # --------------------------------------------------
+    # DASHBOARD STATISTICHE
+    # --------------------------------------------------
+    st.subheader("📊 Dashboard Statistiche")
+    
+    if db_riepilogo:
+        with traccia("dashboard_statistiche"):
+            # Calcola metriche
+            totale_pazienti = len(db_riepilogo)
         
-        if os.path.exists(logo_path):
-            logo = Image(logo_path, width=4*cm, height=4*cm, kind="proportional")
-            
-            # Info paziente a destra del logo
-            info_text = f"""
-            <para align="left" spaceBefore="0">
-            <font name="Helvetica-Bold" size="11" color="#1e3c72">PAZIENTE:</font>
-            <font name="Helvetica" size="11" color="#333333"> {nome_paziente}</font><br/>
-            <font name="Helvetica-Bold" size="11" color="#1e3c72">MOTIVO:</font>
-            <font name="Helvetica" size="11" color="#333333"> {motivo}</font><br/>
-            <font name="Helvetica-Bold" size="11" color="#1e3c72">DATA:</font>
-            <font name="Helvetica" size="11" color="#333333"> {datetime.now().strftime("%d/%m/%Y")}</font>
-            </para>
-            """
-            
-            info_box = Paragraph(info_text, styles["Normal"])
-            
-            header_table = Table(
-                [[logo, info_box]],
-                colWidths=[5*cm, 12*cm],
-                style=[
-                    ("VALIGN", (0,0), (-1,-1), "TOP"),
-                    ("LEFTPADDING", (0,0), (-1,-1), 0),
-                    ("RIGHTPADDING", (0,0), (-1,-1), 0),
-                ]
-            )
-            story.append(header_table)
-        else:
-            # Solo testo se non c'è logo
-            story.append(Paragraph("Programma Esercizi Personalizzato", styles["ModernTitle"]))
-            story.append(Paragraph(f"Paziente: {nome_paziente} | Motivo: {motivo}", styles["Subtitle"]))
+            # Compliance media
+            compliance_list = []
+            pazienti_inattivi = []
+            video_da_vedere = 0
         
-        # Linea separatore sotto header
-        story.append(Spacer(1, 10))
-        separator_line = Table(
-            [[""]],
-            colWidths=[17*cm],
-            style=[
-                ("LINEABOVE", (0,0), (-1,-1), 2, colors.HexColor("#2a5298")),
-                ("TOPPADDING", (0,0), (-1,-1), 0),
-                ("BOTTOMPADDING", (0,0), (-1,-1), 0)
-            ]
-        )
-        story.append(separator_line)
-        story.append(Spacer(1, 20))
-
-        # ============ ESERCIZI CON LAYOUT MODERNO ============
-        for idx, ex in enumerate(scheda):
-            # Numerazione esercizio
-            num_badge = Paragraph(
-                f'<para align="center"><font name="Helvetica-Bold" size="16" color="white">#{idx+1}</font></para>',
-                styles["Normal"]
-            )
-            
-            # Titolo esercizio
-            titolo = Paragraph(f"<b>{ex['nome']}</b>", styles["ExerciseTitle"])
-            
-            # Descrizione
-            descrizione = Paragraph(ex['descrizione'], styles["Description"])
-            
-            # Info serie e ripetizioni con icone
-            info_serie_rip = Paragraph(
-                f"""
-                <para>
-                <font name="Helvetica-Bold" size="10" color="#2a5298">Serie:</font> 
-                <font name="Helvetica-Bold" size="12" color="#1e3c72">{ex['serie']}</font>
-                &nbsp;&nbsp;&nbsp;&nbsp;
-                <font name="Helvetica-Bold" size="10" color="#2a5298">Ripetizioni:</font> 
-                <font name="Helvetica-Bold" size="12" color="#1e3c72">{ex['ripetizioni']}</font>
-                </para>
-                """,
-                styles["Normal"]
-            )
-            
-            # Difficoltà con badge colorato
-            difficolta = ex.get('difficoltà', 'N/A')
-            color_map = {
-                "Facile": "#4caf50",
-                "Medio": "#ff9800", 
-                "Difficile": "#f44336"
-            }
-            diff_color = color_map.get(difficolta, "#9e9e9e")
-            
-            badge_difficolta = Paragraph(
-                f'<para><font name="Helvetica-Bold" size="9" color="white" backColor="{diff_color}"> {difficolta.upper()} </font></para>',
-                styles["Normal"]
-            )
-            
-            # Immagine esercizio
-            img_path = trova_immagine(ex['nome'])
-            if img_path and os.path.exists(img_path):
-                esercizio_img = Image(img_path, width=5*cm, height=5*cm, kind="proportional")
-            else:
-                # Placeholder se non c'è immagine
-                esercizio_img = Paragraph(
-                    '<para align="center"><font size="40" color="#cccccc">📷</font><br/><font size="8" color="#999999">Immagine<br/>non disponibile</font></para>',
-                    styles["Normal"]
-                )
-            
-            # QR Code
-            qr = qrcode.QRCode(version=1, box_size=10, border=1)
-            qr.add_data(ex["link_video"])
-            qr.make(fit=True)
-            qr_img_pil = qr.make_image(fill_color="black", back_color="white")
-            qr_buf = io.BytesIO()
-            qr_img_pil.save(qr_buf, format='PNG')
-            qr_buf.seek(0)
-            qr_img = Image(qr_buf, width=3*cm, height=3*cm)
-            
-            # Label QR
-            qr_label = Paragraph(
-                '<para align="center"><font name="Helvetica" size="7" color="#666666">Scansiona per<br/>vedere il video</font></para>',
-                styles["Normal"]
-            )
-            
-            # Colonna sinistra: Badge numero + Info esercizio
-            left_content = [
-                [num_badge],
-                [titolo],
-                [descrizione],
-                [Spacer(1, 8)],
-                [info_serie_rip],
-                [Spacer(1, 4)],
-                [badge_difficolta]
-            ]
+            oggi = datetime.now()
+        
+            for codice, data in db_riepilogo.items():
+                # Compliance
+                tot_ex = len(data.get("scheda", []))
+                compl_ex = sum(1 for ex in data.get("scheda", []) if data.get("progressi", {}).get(ex["nome"], False))
+                if tot_ex > 0:
+                    compliance_list.append((compl_ex / tot_ex) * 100)
             
-            left_table = Table(
-                left_content,
-                colWidths=[9*cm],
-                style=[
-                    ("LEFTPADDING", (0,0), (-1,-1), 0),
-                    ("RIGHTPADDING", (0,0), (-1,-1), 0),
-                    ("TOPPADDING", (0,0), (-1,-1), 2),
-                    ("BOTTOMPADDING", (0,0), (-1,-1), 2),
-                    # Badge colorato
-                    ("BACKGROUND", (0,0), (0,0), colors.HexColor("#2a5298")),
-                    ("ALIGN", (0,0), (0,0), "CENTER"),
-                    ("VALIGN", (0,0), (0,0), "MIDDLE"),
-                    ("TOPPADDING", (0,0), (0,0), 8),
-                    ("BOTTOMPADDING", (0,0), (0,0), 8),
-                ]
-            )
+                # Inattività (nessun esercizio negli ultimi 7 giorni)
+                storico = data.get("storico", {})
+                tutte_date = []
+                for date_list in storico.values():
+                    tutte_date.extend(date_list)
             
-            # Colonna destra: Immagine + QR
-            right_content = [
-                [esercizio_img],
-                [Spacer(1, 8)],
-                [qr_img],
-                [qr_label]
-            ]
+                if tutte_date:
+                    date_obj = [datetime.strptime(d, "%d/%m/%Y") for d in tutte_date]
+                    ultima_data = max(date_obj)
+                    giorni_inattivo = (oggi - ultima_data).days
+                    if giorni_inattivo > 7:
+                        pazienti_inattivi.append((data.get('nome', 'N/A'), giorni_inattivo))
+                elif len(tutte_date) == 0 and data.get('data_creazione'):
+                    # Mai fatto esercizi
+                    pazienti_inattivi.append((data.get('nome', 'N/A'), 999))
             
-            right_table = Table(
-                right_content,
-                colWidths=[5*cm],
-                style=[
-                    ("ALIGN", (0,0), (-1,-1), "CENTER"),
-                    ("VALIGN", (0,0), (-1,-1), "TOP"),
-                    ("LEFTPADDING", (0,0), (-1,-1), 0),
-                    ("RIGHTPADDING", (0,0), (-1,-1), 0),
-                ]
-            )
+                # Video da vedere
+                video_pazienti = data.get("video_pazienti", {})
+                for ex_videos in video_pazienti.values():
+                    for video in ex_videos:
+                        if not video.get('feedback_fisio'):
+                            video_da_vedere += 1
+        
+            compliance_media = sum(compliance_list) / len(compliance_list) if compliance_list else 0
+        
+        # Mostra metriche
+        col_m1, col_m2, col_m3, col_m4 = st.columns(4)
+        with col_m1:
+            st.metric("👥 Totale pazienti", totale_pazienti)
+        with col_m2:
+            st.metric("📊 Compliance media", f"{compliance_media:.0f}%")
+        with col_m3:
+            st.metric("⚠️ Pazienti inattivi", len(pazienti_inattivi))
+        with col_m4:
+            st.metric("📹 Video da vedere", video_da_vedere)
+        
+        # Pazienti inattivi (se ci sono)
+        if pazienti_inattivi:
+            with st.expander(f"⚠️ Pazienti inattivi ({len(pazienti_inattivi)})"):
+                for nome, giorni in sorted(pazienti_inattivi, key=lambda x: x[1], reverse=True):
+                    if giorni == 999:
+                        st.markdown(f"- **{nome}**: Mai iniziato")
+                    else:
+                        st.markdown(f"- **{nome}**: Inattivo da {giorni} giorni")
+        
+        st.divider()
+    else:
+        st.info("Nessun paziente registrato ancora")
+    
+    st.divider()
+
+    # --------------------------------------------------
+    # GESTIONE PROMEMORIA EMAIL
+    # --------------------------------------------------
+    st.subheader("📧 Gestione Promemoria")
+
+    if db_riepilogo:
+        with traccia("dashboard_promemoria"):
+            # Separa pazienti con e senza email
+            pazienti_con_email = []
+            pazienti_senza_email = []
+    
+            for codice, data in db_riepilogo.items():
+                email = data.get("email", "")
+                nome = data.get("nome", "N/A")
+        
+                # Calcola ultimo accesso (ultima data esercizio)
+                storico = data.get("storico", {})
+                tutte_date = []
+                for date_list in storico.values():
+                    tutte_date.extend(date_list)
+        
+                if tutte_date:
+                    date_obj = [datetime.strptime(d, "%d/%m/%Y") for d in tutte_date]
+                    ultima_data = max(date_obj)
+                    giorni_inattivo = (datetime.now() - ultima_data).days
+                    ultimo_accesso_str = f"{giorni_inattivo} giorni fa" if giorni_inattivo > 0 else "oggi"
+                else:
+                    giorni_inattivo = 999
+                    ultimo_accesso_str = "mai"
+        
+                if email:
+                    pazienti_con_email.append({
+                        "codice": codice,
+                        "nome": nome,
+                        "email": email,
+                        "giorni_inattivo": giorni_inattivo,
+                        "ultimo_accesso": ultimo_accesso_str
+                    })
+                else:
+                    pazienti_senza_email.append({
+                        "codice": codice,
+                        "nome": nome
+                    })
+    
+        # Mostra pazienti con email
+        if pazienti_con_email:
+            st.markdown("**Pazienti con email configurata:**")
+        
+            # Filtri
+            col_filtro1, col_filtro2 = st.columns(2)
+            with col_filtro1:
+                mostra_tutti = st.checkbox("Mostra tutti", value=False)
+            with col_filtro2:
+                giorni_filtro = st.slider("Inattivi da almeno (giorni)", 0, 30, 2)
+        
+            # Lista pazienti
+            pazienti_selezionati = []
+        
+            for paz in sorted(pazienti_con_email, key=lambda x: x["giorni_inattivo"], reverse=True):
+                # Applica filtro
+                if not mostra_tutti and paz["giorni_inattivo"] < giorni_filtro:
+                    continue
             
-            # Card esercizio completa
-            exercise_card = Table(
-                [[left_table, right_table]],
-                colWidths=[9.5*cm, 5.5*cm],
-                style=[
-                    ("BOX", (0,0), (-1,-1), 1.5, colors.HexColor("#2a5298")),
-                    ("BACKGROUND", (0,0), (-1,-1), colors.HexColor("#f8f9fa")),
-                    ("VALIGN", (0,0), (-1,-1), "TOP"),
-                    ("LEFTPADDING", (0,0), (-1,-1), 12),
-                    ("RIGHTPADDING", (0,0), (-1,-1), 12),
-                    ("TOPPADDING", (0,0), (-1,-1), 12),
-                    ("BOTTOMPADDING", (0,0), (-1,-1), 12),
-                ]
-            )
+                # Icona status
+                if paz["giorni_inattivo"] == 0:
+                    icona = "✅"
+                    color = "green"
+                elif paz["giorni_inattivo"] <= 2:
+                    icona = "🟡"
+                    color = "orange"
+                else:
+                    icona = "🔴"
+                    color = "red"
             
-            story.append(KeepTogether([exercise_card]))
-            story.append(Spacer(1, 15))
+                # Checkbox per selezione
+                col_check, col_info = st.columns([1, 10])
+                with col_check:
+                    selected = st.checkbox(
+                        "",
+                        key=f"remind_{paz['codice']}",
+                        value=(paz["giorni_inattivo"] >= giorni_filtro)  # Pre-seleziona inattivi
+                    )
+                with col_info:
+                    st.markdown(f"{icona} **{paz['nome']}** - {paz['email']} - *ultimo accesso: {paz['ultimo_accesso']}*")
             
-            # PageBreak ogni 3 esercizi
-            if (idx + 1) % 3 == 0 and idx < len(scheda) - 1:
-                story.append(PageBreak())
+                if selected:
+                    pazienti_selezionati.append(paz)
+        
+            st.divider()
+        
+            # Pulsanti azione
+            col_btn1, col_btn2, col_btn3 = st.columns(3)
+        
+            with col_btn1:
+                if st.button(f"📧 Invia promemoria a {len(pazienti_selezionati)} pazienti", type="primary", disabled=len(pazienti_selezionati)==0):
+                    with st.spinner("Invio promemoria in corso..."):
+                        def invia(paz):
+                            # Recupera link paziente
+                            link_paziente = f"https://schede-pazienti-app.streamlit.app/?p={paz['codice']}"
+                            return invia_promemoria_paziente(paz["nome"], paz["email"], link_paziente)
 
-        # Build PDF
-        doc.build(
-            story,
-            onFirstPage=draw_background_and_footer,
-            onLaterPages=draw_background_and_footer
-        )
+                        # Email inviate in parallelo, con poche connessioni SMTP alla volta
+                        successi = sum(in_parallelo(invia, pazienti_selezionati, massimo=SMTP_CONNESSIONI_MAX))
+                    
+                        if successi == len(pazienti_selezionati):
+                            st.success(f"✅ {successi} promemoria inviati con successo!")
+                        else:
+                            st.warning(f"⚠️ Inviati {successi}/{len(pazienti_selezionati)} promemoria")
+        
+            with col_btn2:
+                if st.button("Seleziona tutti inattivi"):
+                    st.rerun()
+        
+            with col_btn3:
+                if st.button("Deseleziona tutti"):
+                    st.rerun()
+        
+        else:
+            st.info("Nessun paziente ha configurato l'email ancora")
+    
+        # Mostra pazienti senza email
+        if pazienti_senza_email:
+            with st.expander(f"⚠️ Pazienti SENZA email ({len(pazienti_senza_email)})"):
+                for paz in pazienti_senza_email:
+                    st.markdown(f"- **{paz['nome']}** - Modifica il paziente per aggiungere l'email")
+    
+        st.divider()
+    else:
+        st.info("Nessun paziente registrato")
+    
+    st.divider()
 
-        buffer.seek(0)
-        return buffer
+    # --------------------------------------------------
+    # INPUT PAZIENTE
+    # --------------------------------------------------
+    col1, col2 = st.columns(2)
 
-# --------------------------------------------------
-# BOTTONI AZIONI
-# --------------------------------------------------
-if scheda and nome_paziente:
-        col_btn1, col_btn2 = st.columns(2)
-        
-        with col_btn1:
-            if st.button("Genera PDF", type="primary"):
-                pdf = genera_pdf(scheda)
-                filename = f"{nome_paziente.replace(' ', '_')}_esercizi.pdf"
-                st.download_button(
-                    "⬇️ Scarica PDF",
-                    pdf,
-                    file_name=filename,
-                    mime="application/pdf"
+    with col1:
+        nome_paziente = st.text_input("Nome e cognome paziente", placeholder="Mario Rossi")
+
+    with col2:
+        motivo = st.text_input("🩺 Motivo della visita", placeholder="Lombalgia acuta")
+
+    email_paziente = st.text_input("📧 Email paziente (per promemoria)", placeholder="mario.rossi@gmail.com", help="Opzionale - serve per inviare promemoria automatici")
+
+    st.divider()
+
+    # --------------------------------------------------
+    # TEMPLATE SCHEDE
+    # --------------------------------------------------
+    st.subheader("Template Schede")
+
+
+    # Selectbox template
+    template_scelto = st.selectbox(
+            "Scegli un template o seleziona manualmente",
+            list(TEMPLATES.keys())
+    )
+
+    # Estrai dati template
+    template_data = TEMPLATES[template_scelto]
+    esercizi_template = template_data["esercizi"]
+    distretto_suggerito = template_data["distretto"]
+
+    if esercizi_template:
+            st.success(f"✅ Template '{template_scelto}' caricato! Distretto auto-selezionato: **{distretto_suggerito}**")
+
+            # Mostra preview template
+            with st.expander("👁️ Preview esercizi del template"):
+                for ex in esercizi_template:
+                    st.markdown(f"- **{ex['nome']}**: {ex['serie']} serie x {ex['ripetizioni']} rip")
+
+    st.divider()
+
+    # --------------------------------------------------
+    # SELEZIONE ESERCIZI
+    # --------------------------------------------------
+
+    # Auto-selezione distretto basata sul template
+    distretti_disponibili = sorted(df["distretto"].unique())
+
+    if distretto_suggerito and distretto_suggerito in distretti_disponibili:
+            # Pre-seleziona il distretto del template
+            index_distretto = distretti_disponibili.index(distretto_suggerito)
+    else:
+            # Default: primo distretto
+            index_distretto = 0
+
+    distretto = st.selectbox(
+            "Seleziona distretto",
+            distretti_disponibili,
+            index=index_distretto
+    )
+
+    # Mostra esercizi del distretto selezionato + esercizi "generale"
+    df_distretto = df[(df["distretto"] == distretto) | (df["distretto"] == "generale")]
+
+    # Se ha scelto un template, pre-seleziona SOLO gli esercizi disponibili nel distretto
+    if esercizi_template:
+            # Filtra solo esercizi che esistono nel distretto selezionato
+            esercizi_disponibili = df_distretto["nome"].tolist()
+            esercizi_template_nomi = [ex["nome"] for ex in esercizi_template if ex["nome"] in esercizi_disponibili]
+
+            if esercizi_template_nomi:
+                st.info(f"[INFO] {len(esercizi_template_nomi)} esercizi del template trovati nel distretto '{distretto}'")
+
+            # Mostra warning se alcuni esercizi del template non sono disponibili
+            esercizi_mancanti = [ex["nome"] for ex in esercizi_template if ex["nome"] not in esercizi_disponibili]
+            if esercizi_mancanti:
+                st.warning(f"[!] Alcuni esercizi del template non sono in questo distretto: {', '.join(esercizi_mancanti)}")
+    else:
+            esercizi_template_nomi = []
+
+    esercizi_scelti = st.multiselect(
+            "Seleziona esercizi",
+            df_distretto["nome"].tolist(),
+            default=esercizi_template_nomi
+    )
+
+    scheda = []
+    for nome in esercizi_scelti:
+            row = df_distretto[df_distretto["nome"] == nome].iloc[0]
+
+            # Cerca se questo esercizio è nel template per usare i suoi valori
+            template_ex = next((ex for ex in esercizi_template if ex["nome"] == nome), None)
+
+            if template_ex:
+                # Usa valori del template
+                default_serie = template_ex["serie"]
+                default_rip = template_ex["ripetizioni"]
+            else:
+                # Gestione sicura di serie e ripetizioni (possono essere vuote nel CSV)
+                try:
+                    default_serie = int(row.get("serie", 3)) if row.get("serie") and str(row.get("serie")).strip() else 3
+                except (ValueError, TypeError):
+                    default_serie = 3
+
+                try:
+                    default_rip = int(row.get("ripetizioni", 10)) if row.get("ripetizioni") and str(row.get("ripetizioni")).strip() else 10
+                except (ValueError, TypeError):
+                    default_rip = 10
+
+            c1, c2 = st.columns(2)
+            with c1:
+                serie = st.number_input(f"Serie – {nome}", 1, 10, default_serie, key=f"serie_{nome}")
+            with c2:
+                rip = st.number_input(f"Ripetizioni – {nome}", 1, 30, default_rip, key=f"rip_{nome}")
+
+            scheda.append({
+                "nome": row["nome"],
+                "descrizione": row["descrizione"],
+                "link_video": row["link_video"],
+                "video_embed": row["video_embed"],
+                "video_anteprima": row["video_anteprima"],
+                "difficoltà": row.get("difficoltà", ""),
+                "distretto": row["distretto"],
+                "serie": serie,
+                "ripetizioni": rip
+            })
+
+    st.divider()
+
+    # --------------------------------------------------
+    # BOTTONI AZIONI
+    # --------------------------------------------------
+    if scheda and nome_paziente:
+            col_btn1, col_btn2 = st.columns(2)
+
+            with col_btn1:
+                if st.button("Genera PDF", type="primary"):
+                    pdf = genera_pdf_in_cache(scheda, nome_paziente, motivo)
+                    filename = f"{nome_paziente.replace(' ', '_')}_esercizi.pdf"
+                    st.download_button(
+                        "⬇️ Scarica PDF",
+                        pdf,
+                        file_name=filename,
+                        mime="application/pdf"
+                    )
+
+            with col_btn2:
+                if st.button("Crea link paziente", type="primary"):
+                    # Salva nel database
+                    codice = genera_codice_paziente(nome_paziente)
+
+                    # Calcola scadenza (4 settimane dalla creazione)
+                    data_creazione_dt = datetime.now()
+                    data_scadenza_dt = data_creazione_dt + timedelta(weeks=4)
+
+                    nuovo_paziente = {
+                        "nome": nome_paziente,
+                        "motivo": motivo,
+                        "email": email_paziente if email_paziente else "",
+                        "data_creazione": data_creazione_dt.strftime("%d/%m/%Y"),
+                        "data_scadenza": data_scadenza_dt.strftime("%d/%m/%Y"),
+                        "scheda": scheda,
+                        "progressi": {},
+                        "note": {},
+                        "video_pazienti": {},
+                        "storico": {}
+                    }
+
+                    try:
+                        get_storage().upsert_paziente(codice, nuovo_paziente)
+                        invalida_paziente(codice, nuovo_paziente)
+                    except Exception as e:
+                        st.error(f"Errore salvataggio paziente: {e}")
+                        st.stop()
+
+                    # Mostra link con parametro corto per PWA
+                    app_url = "https://schede-pazienti-app.streamlit.app"
+                    link_paziente = f"{app_url}?p={codice}"
+                    link_completo = f"{app_url}?paziente={codice}"  # Backup
+
+                    st.success(f"✅ Scheda creata per {nome_paziente}!")
+
+                    # Link principale (corto per installazione)
+                    st.markdown("### 📱 Link per il paziente:")
+                    st.code(link_paziente, language=None)
+                    st.markdown("""
+                    **Come inviare al paziente:**
+                    1. Copia il link qui sopra
+                    2. Invialo via WhatsApp/SMS/Email
+                    3. Il paziente può **aggiungerlo alla Home** del telefono:
+                       - **iPhone**: Safari → Condividi → "Aggiungi a Home"
+                       - **Android**: Chrome → ⋮ → "Installa app"
+                    """)
+
+                    # Link alternativo lungo
+                    with st.expander("🔗 Link alternativo (lungo)"):
+                        st.code(link_completo, language=None)
+
+                    # QR Code per il link
+                    st.image(qr_png(link_paziente, border=4), caption="QR Code per accesso rapido", width=300)
+
+    # --------------------------------------------------
+    # GESTIONE PAZIENTI ESISTENTI
+    # --------------------------------------------------
+    st.divider()
+    st.subheader("Pazienti registrati")
+
+    # Stessa proiezione già in memoria: si rilegge solo per includere un paziente appena creato
+    db = carica_riepilogo(CAMPI_FISIOTERAPISTA)
+
+    if db:
+            for codice, riepilogo in db.items():
+                # Scheda, storico e video si caricano solo quando il paziente viene aperto
+                espansore = st.expander(
+                    f"👤 {riepilogo.get('nome', '')} - {riepilogo.get('motivo', '')} ({riepilogo.get('data_creazione', '')})",
+                    key=f"paziente_{codice}",
+                    on_change="rerun"
                 )
-        
-        with col_btn2:
-            if st.button("Crea link paziente", type="primary"):
-                # Salva nel database
-                db = carica_database()
-                codice = genera_codice_paziente(nome_paziente)
-                
-                # Calcola scadenza (4 settimane dalla creazione)
-                data_creazione_dt = datetime.now()
-                data_scadenza_dt = data_creazione_dt + timedelta(weeks=4)
-                
-                db[codice] = {
-                    "nome": nome_paziente,
-                    "motivo": motivo,
-                    "email": email_paziente if email_paziente else "",
-                    "data_creazione": data_creazione_dt.strftime("%d/%m/%Y"),
-                    "data_scadenza": data_scadenza_dt.strftime("%d/%m/%Y"),
-                    "scheda": scheda,
-                    "progressi": {},
-                    "note": {},
-                    "video_pazienti": {},
-                    "storico": {}
-                }
-                
-                salva_database(db)
-                
-                # Mostra link con parametro corto per PWA
-                app_url = "https://schede-pazienti-app.streamlit.app"
-                link_paziente = f"{app_url}?p={codice}"
-                link_completo = f"{app_url}?paziente={codice}"  # Backup
-                
-                st.success(f"✅ Scheda creata per {nome_paziente}!")
-                
-                # Link principale (corto per installazione)
-                st.markdown("### 📱 Link per il paziente:")
-                st.code(link_paziente, language=None)
-                st.markdown("""
-                **Come inviare al paziente:**
-                1. Copia il link qui sopra
-                2. Invialo via WhatsApp/SMS/Email
-                3. Il paziente può **aggiungerlo alla Home** del telefono:
-                   - **iPhone**: Safari → Condividi → "Aggiungi a Home"
-                   - **Android**: Chrome → ⋮ → "Installa app"
-                """)
-                
-                # Link alternativo lungo
-                with st.expander("🔗 Link alternativo (lungo)"):
-                    st.code(link_completo, language=None)
-                
-                # QR Code per il link
-                qr = qrcode.make(link_paziente)
-                qr_buf = io.BytesIO()
-                qr.save(qr_buf, format="PNG")
-                qr_buf.seek(0)
-                st.image(qr_buf, caption="QR Code per accesso rapido", width=300)
+                data = carica_paziente(codice) if espansore.open else None
+                if data is None:
+                    continue
+                with espansore:
+                    st.markdown(f"**Codice:** `{codice}`")
+
+                    totale = len(data["scheda"])
+                    completati = sum(1 for ex in data["scheda"] if data.get("progressi", {}).get(ex["nome"], False))
+                    progresso = int((completati / totale) * 100) if totale > 0 else 0
+
+                    st.progress(progresso / 100)
+                    st.markdown(f"**Progresso:** {completati}/{totale} esercizi completati ({progresso}%)")
+
+                    # Link paziente
+                    app_url = "https://schede-pazienti-app.streamlit.app"
+                    link_paziente = f"{app_url}?p={codice}"
+                    st.code(link_paziente, language=None)
+
+                    # Ottieni URL dinamicamente
+                    app_url = st.get_option("browser.serverAddress") or "https://schede-pazienti-app.streamlit.app" 
+
+                    # Dettaglio esercizi con note e statistiche
+                    st.markdown("---")
+                    st.markdown("### 📋 Dettaglio esercizi:")
+
+                    # URL firmati di tutti i video del paziente, richiesti insieme
+                    url_video = get_video_urls(
+                        video_data.get('blob_name') for ex in data["scheda"]
+                        for video_data in data.get("video_pazienti", {}).get(ex["nome"], [])
+                    )
+
+                    for idx, ex in enumerate(data["scheda"]):
+                        nome_ex = ex["nome"]
+                        is_done = data.get("progressi", {}).get(nome_ex, False)
+                        nota_paziente = data.get("note", {}).get(nome_ex, "")
+
+                        # Storico esercizio
+                        storico_esercizio = data.get("storico", {}).get(nome_ex, [])
+                        volte_fatto = len(storico_esercizio)
+
+                        # Status icon basato su storico
+                        if volte_fatto > 0:
+                            icon = "✅"
+                            status_text = f"(fatto {volte_fatto} {'volta' if volte_fatto == 1 else 'volte'})"
+                        else:
+                            icon = "⬜"
+                            status_text = "(non ancora fatto)"
+
+                        st.markdown(f"**{idx+1}. {icon} {nome_ex}** {status_text}")
+                        st.markdown(f"   • **Serie:** {ex['serie']} | **Ripetizioni:** {ex['ripetizioni']}")
+
+                        # Mostra ultime date se presente
+                        if volte_fatto > 0:
+                            ultima_volta = storico_esercizio[-1]
+                            st.markdown(f"   • Ultima volta: **{ultima_volta}**")
+
+                            # Mostra tutte le date in un expander
+                            if volte_fatto > 1:
+                                with st.expander(f"   📊 Tutte le date ({volte_fatto} volte)"):
+                                    ultimi_date = storico_esercizio[::-1]  # Dal più recente
+                                    for data_es in ultimi_date:
+                                        st.markdown(f"   • {data_es}")
+
+                        # Mostra note del paziente se presenti
+                        if nota_paziente:
+                            st.info(f"**Nota del paziente:** {nota_paziente}")
+
+                        # Mostra video caricati dal paziente
+                        video_list = data.get("video_pazienti", {}).get(nome_ex, [])
+                        if video_list:
+                            with st.expander(f"   📹 Video caricati dal paziente ({len(video_list)})"):
+                                for vid_idx, video_data in enumerate(video_list):
+                                    st.markdown(f"**Video {vid_idx + 1}** - Caricato il {video_data['data']} ({video_data.get('size_mb', 'N/A')} MB)")
+
+                                    # Mostra video
+                                    if video_data.get('blob_name'):
+                                        video_url = url_video.get(video_data['blob_name'])
+                                        if video_url:
+                                            st.video(video_url)
+                                        else:
+                                            st.warning("Video non disponibile")
+
+                                    if video_data.get('commento'):
+                                        st.markdown(f"💬 *\"{video_data['commento']}\"*")
+
+                                    # Feedback del fisioterapista
+                                    current_feedback = video_data.get('feedback_fisio', '')
+                                    feedback = st.text_area(
+                                        "Il tuo feedback:",
+                                        value=current_feedback,
+                                        key=f"feedback_{codice}_{nome_ex}_{vid_idx}",
+                                        height=80,
+                                        placeholder="Es: Ottima esecuzione! Presta attenzione all'allineamento del ginocchio..."
+                                    )
+
+                                    if st.button("Salva feedback", key=f"save_fb_{codice}_{nome_ex}_{vid_idx}"):
+                                        get_buffer_scritture().registra(codice, nuovo_evento(
+                                            "video_feedback",
+                                            nome_ex,
+                                            {"blob_name": video_data.get('blob_name', ''), "feedback": feedback}
+                                        ))
+                                        st.success("✓ Feedback salvato! Il paziente lo vedrà.")
+
+                                    st.markdown("---")
+
+                        st.markdown("")  # Spazio
+
+                    # Bottone elimina
+                    st.markdown("---")
+                    if st.button(f"Elimina paziente", key=f"del_{codice}"):
+                        try:
+                            get_storage().elimina_paziente(codice)
+                            invalida_paziente(codice, None)
+                        except Exception as e:
+                            st.error(f"Errore eliminazione paziente: {e}")
+                            st.stop()
+                        st.rerun()
+    else:
+            st.info("Nessun paziente registrato ancora")
 
 # --------------------------------------------------
-# GESTIONE PAZIENTI ESISTENTI
+# RISCALDAMENTO CACHE (una volta per processo, in background)
 # --------------------------------------------------
-st.divider()
-st.subheader("Pazienti registrati")
+class Riscaldamento:
+    """Porta in memoria client, database, catalogo e immagini prima che servano.
 
-db = carica_database()
+    Parte al primo run dello script del processo; le pagine non lo aspettano:
+    i caricamenti condivisi (snapshot single-flight, cache_resource) vengono
+    riusati da chi arriva nel frattempo. pronto dice quando le cache sono calde.
+    """
 
-if db:
-        for codice, data in db.items():
-            with st.expander(f"👤 {data['nome']} - {data['motivo']} ({data['data_creazione']})"):
-                st.markdown(f"**Codice:** `{codice}`")
-                
-                totale = len(data["scheda"])
-                completati = sum(1 for ex in data["scheda"] if data.get("progressi", {}).get(ex["nome"], False))
-                progresso = int((completati / totale) * 100) if totale > 0 else 0
-                
-                st.progress(progresso / 100)
-                st.markdown(f"**Progresso:** {completati}/{totale} esercizi completati ({progresso}%)")
-                
-                # Link paziente
-                app_url = "https://schede-pazienti-app.streamlit.app"
-                link_paziente = f"{app_url}?p={codice}"
-                st.code(link_paziente, language=None)
-                
-                # Ottieni URL dinamicamente
-                import streamlit as st
-                app_url = st.get_option("browser.serverAddress") or "https://schede-pazienti-app.streamlit.app" 
+    def __init__(self):
+        self.pronto = threading.Event()
+        self.fasi = {}  # fase -> secondi impiegati, o "errore: ..."
 
-                # Dettaglio esercizi con note e statistiche
-                st.markdown("---")
-                st.markdown("### 📋 Dettaglio esercizi:")
-                
-                for idx, ex in enumerate(data["scheda"]):
-                    nome_ex = ex["nome"]
-                    is_done = data.get("progressi", {}).get(nome_ex, False)
-                    nota_paziente = data.get("note", {}).get(nome_ex, "")
-                    
-                    # Storico esercizio
-                    storico_esercizio = data.get("storico", {}).get(nome_ex, [])
-                    volte_fatto = len(storico_esercizio)
-                    
-                    # Status icon basato su storico
-                    if volte_fatto > 0:
-                        icon = "✅"
-                        status_text = f"(fatto {volte_fatto} {'volta' if volte_fatto == 1 else 'volte'})"
-                    else:
-                        icon = "⬜"
-                        status_text = "(non ancora fatto)"
-                    
-                    st.markdown(f"**{idx+1}. {icon} {nome_ex}** {status_text}")
-                    st.markdown(f"   • **Serie:** {ex['serie']} | **Ripetizioni:** {ex['ripetizioni']}")
-                    
-                    # Mostra ultime date se presente
-                    if volte_fatto > 0:
-                        ultima_volta = storico_esercizio[-1]
-                        st.markdown(f"   • Ultima volta: **{ultima_volta}**")
-                        
-                        # Mostra tutte le date in un expander
-                        if volte_fatto > 1:
-                            with st.expander(f"   📊 Tutte le date ({volte_fatto} volte)"):
-                                ultimi_date = storico_esercizio[::-1]  # Dal più recente
-                                for data_es in ultimi_date:
-                                    st.markdown(f"   • {data_es}")
-                    
-                    # Mostra note del paziente se presenti
-                    if nota_paziente:
-                        st.info(f"**Nota del paziente:** {nota_paziente}")
-                    
-                    # Mostra video caricati dal paziente
-                    video_list = data.get("video_pazienti", {}).get(nome_ex, [])
-                    if video_list:
-                        with st.expander(f"   📹 Video caricati dal paziente ({len(video_list)})"):
-                            for vid_idx, video_data in enumerate(video_list):
-                                st.markdown(f"**Video {vid_idx + 1}** - Caricato il {video_data['data']} ({video_data.get('size_mb', 'N/A')} MB)")
-                                
-                                # Mostra video
-                                if video_data.get('blob_name'):
-                                    video_url = get_video_url(video_data['blob_name'])
-                                    if video_url:
-                                        st.video(video_url)
-                                    else:
-                                        st.warning("Video non disponibile")
-                                
-                                if video_data.get('commento'):
-                                    st.markdown(f"💬 *\"{video_data['commento']}\"*")
-                                
-                                # Feedback del fisioterapista
-                                current_feedback = video_data.get('feedback_fisio', '')
-                                feedback = st.text_area(
-                                    "Il tuo feedback:",
-                                    value=current_feedback,
-                                    key=f"feedback_{codice}_{nome_ex}_{vid_idx}",
-                                    height=80,
-                                    placeholder="Es: Ottima esecuzione! Presta attenzione all'allineamento del ginocchio..."
-                                )
-                                
-                                if st.button("Salva feedback", key=f"save_fb_{codice}_{nome_ex}_{vid_idx}"):
-                                    data["video_pazienti"][nome_ex][vid_idx]["feedback_fisio"] = feedback
-                                    db[codice] = data
-                                    salva_database(db)
-                                    st.success("✓ Feedback salvato! Il paziente lo vedrà.")
-                                
-                                st.markdown("---")
-                    
-                    st.markdown("")  # Spazio
-                
-                # Bottone elimina
-                st.markdown("---")
-                if st.button(f"Elimina paziente", key=f"del_{codice}"):
-                    del db[codice]
-                    salva_database(db)
-                    st.rerun()
+    def fasi_da_eseguire(self):
+        return [
+            ("storage", get_storage),
+            ("database", self._database),
+            ("catalogo", load_csv),
+            ("immagini", self._immagini),
+            ("qr_catalogo", self._qr_catalogo),
+            ("pdf", lambda: _componi_pdf([], "", "")),
+            ("cloud_storage", _client_cloud_storage),
+        ]
+
+    @staticmethod
+    def _database():
+        get_indice_codici().contiene(get_snapshot_database().leggi(), "")
+
+    @staticmethod
+    def _immagini():
+        trova_immagine("")
+        get_mappa_asset()
+
+    @staticmethod
+    def _qr_catalogo():
+        for link in load_csv()["link_video"].unique():
+            if link:
+                qr_png(link)
+
+    def esegui(self):
+        for nome, fase in self.fasi_da_eseguire():
+            inizio = time.perf_counter()
+            try:
+                with traccia(f"riscaldamento.{nome}"):
+                    fase()
+                self.fasi[nome] = round(time.perf_counter() - inizio, 3)
+            except Exception as e:
+                # Una fase fallita non blocca le altre: la pagina la rifarà al primo uso
+                self.fasi[nome] = f"errore: {e}"
+        self.pronto.set()
+
+@st.cache_resource
+def get_riscaldamento():
+    riscaldamento = Riscaldamento()
+    threading.Thread(target=riscaldamento.esegui, name="riscaldamento", daemon=True).start()
+    return riscaldamento
+
+def cache_pronte():
+    """True quando il riscaldamento del processo è terminato"""
+    return get_riscaldamento().pronto.is_set()
+
+get_riscaldamento()
+
+# --------------------------------------------------
+# AVVIO: una sola delle due aree viene eseguita
+# --------------------------------------------------
+if paziente_code:
+    mostra_area_paziente(paziente_code)
 else:
-        st.info("Nessun paziente registrato ancora")
+    mostra_area_fisioterapista()
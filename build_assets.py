@@ -0,0 +1,157 @@
+"""Pipeline degli asset statici: immagini ridimensionate, compresse e con hash nel nome.
+
+Genera in static/assets le versioni ottimizzate di logo, sfondo e immagini degli
+esercizi, le icone PWA 192/512 e static/manifest.json. Il nome di ogni file
+contiene l'hash del contenuto, quindi un URL non cambia mai contenuto (file
+uguali, come sfondo.png e background.png, diventano un solo asset).
+
+Streamlit serve /app/static con ETag ma senza Cache-Control: da solo il browser
+rivalida ogni asset (304, senza riscaricarlo). La cache a tempo indeterminato
+c'è solo dove la si imposta: il service worker (cache-first, ma solo per le
+pagine sotto /app/static/, cioè avvio.html) o un reverse proxy davanti all'app
+che aggiunga "Cache-Control: public, max-age=31536000, immutable" su
+/app/static/assets/.
+
+Uso: python build_assets.py [--forza]
+L'app la richiama anche all'avvio e ricostruisce solo se le sorgenti sono cambiate.
+"""
+import os
+import io
+import sys
+import re
+import json
+import hashlib
+import unicodedata
+from PIL import Image
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_DIR = os.path.join(BASE_DIR, "images")
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+ASSET_DIR = os.path.join(STATIC_DIR, "assets")
+MAPPA_ASSET = os.path.join(ASSET_DIR, "assets.json")
+MANIFEST_SORGENTE = os.path.join(BASE_DIR, "manifest.json")
+MANIFEST_STATICO = os.path.join(STATIC_DIR, "manifest.json")
+
+VERSIONE_PIPELINE = 1  # da incrementare quando cambia il modo di generare gli asset
+COLORE_TEMA = "#1e3c72"
+QUALITA_WEBP = 80
+LARGHEZZA_ESERCIZI = 800
+
+# Nome logico -> (file sorgente, larghezza massima in px)
+ASSET = {
+    "logo": ("logo.png", 300),          # mostrato a 150px: 300 copre gli schermi 2x
+    "sfondo": ("background.png", 1200),
+}
+ICONE = {"icona-192": 192, "icona-512": 512}
+ESTENSIONI_IMMAGINI = (".png", ".jpg", ".jpeg", ".webp")
+
+def chiave_esercizio(nome):
+    """Nome logico dell'immagine di un esercizio (stessa normalizzazione di trova_immagine)"""
+    return "esercizio:" + nome.strip().lower().replace(" ", "")
+
+def _sorgenti():
+    """Nome logico -> (percorso sorgente, larghezza massima)"""
+    sorgenti = {nome: (os.path.join(BASE_DIR, file), larghezza) for nome, (file, larghezza) in ASSET.items()}
+    if os.path.isdir(IMAGE_DIR):
+        for file in sorted(os.listdir(IMAGE_DIR)):
+            stem, ext = os.path.splitext(file)
+            if ext.lower() in ESTENSIONI_IMMAGINI:
+                sorgenti[chiave_esercizio(stem)] = (os.path.join(IMAGE_DIR, file), LARGHEZZA_ESERCIZI)
+    return {nome: v for nome, v in sorgenti.items() if os.path.exists(v[0])}
+
+def _firma(sorgenti):
+    """Impronta di percorsi, dimensioni e date delle sorgenti: se non cambia non si ricostruisce"""
+    h = hashlib.sha256(json.dumps([VERSIONE_PIPELINE, QUALITA_WEBP, ICONE, sorted(sorgenti.items())]).encode())
+    for percorso in sorted({p for p, _ in sorgenti.values()} | {MANIFEST_SORGENTE}):
+        if os.path.exists(percorso):
+            info = os.stat(percorso)
+            h.update(f"{percorso}:{info.st_size}:{info.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+def _slug(nome):
+    """Nome di file ASCII sicuro negli URL ("esercizio:mobilitàcaviglia" -> "esercizio-mobilitacaviglia")"""
+    ascii_ = unicodedata.normalize("NFKD", nome).encode("ascii", "ignore").decode("ascii")
+    return re.sub(r"[^a-z0-9]+", "-", ascii_.lower()).strip("-") or "asset"
+
+def _scrivi_atomico(percorso, dati):
+    """Scrive passando da un file temporaneo: chi legge non vede mai un file a metà"""
+    temporaneo = f"{percorso}.{os.getpid()}.tmp"
+    with open(temporaneo, "wb") as f:
+        f.write(dati)
+    os.replace(temporaneo, percorso)
+
+def _salva(img, nome, formato):
+    """Codifica l'immagine e la scrive come <nome>.<hash>.<ext>; ritorna il percorso relativo a static/"""
+    buffer = io.BytesIO()
+    if formato == "WEBP":
+        img.save(buffer, "WEBP", quality=QUALITA_WEBP, method=6)
+    else:
+        img.save(buffer, "PNG", optimize=True)
+    dati = buffer.getvalue()
+    file = f"{_slug(nome)}.{hashlib.sha256(dati).hexdigest()[:12]}.{formato.lower()}"
+    percorso = os.path.join(ASSET_DIR, file)
+    if not os.path.exists(percorso):
+        _scrivi_atomico(percorso, dati)
+    return f"assets/{file}"
+
+def _ridimensiona(img, larghezza):
+    """Riduce alla larghezza massima mantenendo le proporzioni (mai ingrandisce)"""
+    img = img.convert("RGBA") if img.mode in ("P", "LA", "RGBA") else img.convert("RGB")
+    if img.width > larghezza:
+        img = img.resize((larghezza, round(img.height * larghezza / img.width)), Image.LANCZOS)
+    return img
+
+def _icona(logo, lato):
+    """Icona quadrata maskable: logo nell'80% centrale su fondo del colore del tema"""
+    icona = Image.new("RGBA", (lato, lato), COLORE_TEMA)
+    interno = int(lato * 0.8)
+    logo = logo.convert("RGBA")
+    logo.thumbnail((interno, interno), Image.LANCZOS)
+    icona.alpha_composite(logo, ((lato - logo.width) // 2, (lato - logo.height) // 2))
+    return icona.convert("RGB")
+
+def _scrivi_manifest(mappa):
+    """Manifest PWA servito da static/, con le icone generate"""
+    manifest = {}
+    if os.path.exists(MANIFEST_SORGENTE):
+        with open(MANIFEST_SORGENTE, encoding="utf-8") as f:
+            manifest = json.load(f)
+    manifest["icons"] = [
+        {"src": mappa[nome], "sizes": f"{lato}x{lato}", "type": "image/png", "purpose": "any maskable"}
+        for nome, lato in ICONE.items() if nome in mappa
+    ]
+    _scrivi_atomico(MANIFEST_STATICO, json.dumps(manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+
+def costruisci_asset(forza=False):
+    """Genera gli asset se le sorgenti sono cambiate; ritorna nome logico -> percorso sotto static/"""
+    sorgenti = _sorgenti()
+    firma = _firma(sorgenti)
+    if not forza and os.path.exists(MAPPA_ASSET):
+        with open(MAPPA_ASSET, encoding="utf-8") as f:
+            esistente = json.load(f)
+        if esistente.get("firma") == firma:
+            return esistente["asset"]
+
+    os.makedirs(ASSET_DIR, exist_ok=True)
+    mappa = {}
+    for nome, (percorso, larghezza) in sorgenti.items():
+        with Image.open(percorso) as img:
+            mappa[nome] = _salva(_ridimensiona(img, larghezza), nome, "WEBP")
+            if nome == "logo":
+                for icona, lato in ICONE.items():
+                    mappa[icona] = _salva(_icona(img, lato), icona, "PNG")
+
+    _scrivi_manifest(mappa)
+    _scrivi_atomico(MAPPA_ASSET, json.dumps({"firma": firma, "asset": mappa}, ensure_ascii=False, indent=2).encode("utf-8"))
+
+    # Elimina le versioni precedenti non più referenziate
+    attivi = {os.path.basename(p) for p in mappa.values()} | {os.path.basename(MAPPA_ASSET)}
+    for file in os.listdir(ASSET_DIR):
+        if file not in attivi and not file.endswith(".tmp"):
+            os.remove(os.path.join(ASSET_DIR, file))
+    return mappa
+
+if __name__ == "__main__":
+    mappa = costruisci_asset(forza="--forza" in sys.argv)
+    for nome, percorso in sorted(mappa.items()):
+        print(f"{nome:45} {percorso} ({os.path.getsize(os.path.join(STATIC_DIR, percorso)) // 1024} KB)")
@@ -0,0 +1,76 @@
+// Service worker della PWA (scope /app/static/).
+// Streamlit serve questo file da static/ e non permette uno scope più ampio:
+// controlla la pagina di avvio offline (avvio.html) e gli asset statici.
+// - asset con hash nel nome: cache-first, il contenuto di un URL non cambia mai
+//   (vale solo per le pagine nello scope: la pagina principale dell'app è fuori
+//   e usa la cache HTTP del browser, vedi build_assets.py)
+// - pagina di avvio e manifest: dalla cache subito, aggiornati in background
+// - video: sempre dalla rete (richieste Range, troppo grandi per la cache)
+
+const VERSIONE = "rrfisio-v1";
+const BASE = "/app/static/";
+const SHELL = [BASE + "avvio.html", BASE + "manifest.json"];
+
+self.addEventListener("install", (event) => {
+  event.waitUntil((async () => {
+    const cache = await caches.open(VERSIONE);
+    await cache.addAll(SHELL);
+    // Precarica gli asset generati da build_assets.py (icone, logo, immagini esercizi)
+    try {
+      const risposta = await fetch(BASE + "assets/assets.json", { cache: "no-store" });
+      const mappa = (await risposta.json()).asset || {};
+      await cache.addAll(Object.values(mappa).map((percorso) => BASE + percorso));
+    } catch (e) {
+      // Asset non ancora generati: verranno messi in cache al primo uso
+    }
+    await self.skipWaiting();
+  })());
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil((async () => {
+    for (const nome of await caches.keys()) {
+      if (nome !== VERSIONE) await caches.delete(nome);
+    }
+    await self.clients.claim();
+  })());
+});
+
+self.addEventListener("fetch", (event) => {
+  const richiesta = event.request;
+  const url = new URL(richiesta.url);
+  if (richiesta.method !== "GET" || url.origin !== self.location.origin || !url.pathname.startsWith(BASE)) {
+    return;
+  }
+  if (url.pathname.startsWith(BASE + "videos/") || richiesta.headers.has("range")) {
+    return;
+  }
+  if (url.pathname.startsWith(BASE + "assets/") && url.pathname !== BASE + "assets/assets.json") {
+    event.respondWith(primaCache(richiesta));
+  } else {
+    event.respondWith(cacheEAggiorna(event, richiesta));
+  }
+});
+
+async function primaCache(richiesta) {
+  const cache = await caches.open(VERSIONE);
+  const salvata = await cache.match(richiesta);
+  if (salvata) return salvata;
+  const risposta = await fetch(richiesta);
+  if (risposta.ok) cache.put(richiesta, risposta.clone());
+  return risposta;
+}
+
+async function cacheEAggiorna(event, richiesta) {
+  const cache = await caches.open(VERSIONE);
+  const salvata = await cache.match(richiesta, { ignoreSearch: true });
+  const rete = fetch(richiesta).then((risposta) => {
+    if (risposta.ok) cache.put(richiesta, risposta.clone());
+    return risposta;
+  });
+  if (salvata) {
+    event.waitUntil(rete.catch(() => {}));
+    return salvata;
+  }
+  return rete;
+}
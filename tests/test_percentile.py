@@ -0,0 +1,46 @@
+"""Test del percentile nearest-rank usato dal pannello prestazioni (p50/p95)."""
+import importlib
+import os
+import sys
+
+import pytest
+
+RADICE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    # app.py esegue la pagina all'import (bare mode): backend SQLite usa e getta,
+    # e cartella corrente = radice del progetto per esercizi.csv
+    cartella = tmp_path_factory.mktemp("db")
+    precedente = os.getcwd()
+    ambiente = {"STORAGE_BACKEND": "sqlite", "SQLITE_PATH": str(cartella / "pazienti.db")}
+    salvato = {chiave: os.environ.get(chiave) for chiave in ambiente}
+    os.environ.update(ambiente)
+    sys.path.insert(0, RADICE)
+    os.chdir(RADICE)
+    try:
+        yield importlib.import_module("app")
+    finally:
+        os.chdir(precedente)
+        for chiave, valore in salvato.items():
+            if valore is None:
+                os.environ.pop(chiave, None)
+            else:
+                os.environ[chiave] = valore
+
+
+@pytest.mark.parametrize("p, atteso", [(50, 5), (90, 9), (95, 10), (100, 10), (10, 1), (1, 1)])
+def test_percentile_dieci_valori(app, p, atteso):
+    assert app.percentile(list(range(1, 11)), p) == atteso
+
+
+@pytest.mark.parametrize("p, atteso", [(50, 50), (7, 7), (95, 95), (99, 99), (100, 100), (1, 1)])
+def test_percentile_cento_valori(app, p, atteso):
+    assert app.percentile(list(range(1, 101)), p) == atteso
+
+
+def test_percentile_casi_limite(app):
+    assert app.percentile([], 95) == 0
+    assert app.percentile([7], 50) == 7
+    assert app.percentile([7], 0) == 7